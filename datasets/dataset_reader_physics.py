@@ -14,8 +14,10 @@ msgpack_numpy.patch()
 import h5py
 import random
 from collections import deque
+import multiprocessing
+import traceback
 from multiprocessing import Process, Manager
-from queue import Empty
+from queue import Empty, Full
 
 from datasets import column_gen, free_fall_gen
 
@@ -94,8 +96,11 @@ class DatasetGroup:
                  test=None,
                  split="train",
                  regen=False,
+                 cache_mb=1024,
                  **dataset_cfg):
         self.name = dataset_cfg.pop("name")
+        # decoded scenes are shared between the train, valid and test splits
+        self.cache = SceneCache(max_bytes=cache_mb * 2 ** 20) if cache_mb else None
         if 'dataset_path' not in dataset_cfg:
             # no path => generate data
 
@@ -124,20 +129,21 @@ class DatasetGroup:
                 if not os.path.exists(os.path.join(path, "train")):
                     raise FileNotFoundError()
                 self.train = Dataset(dataset_path=os.path.join(path, "train"),
+                                     cache=self.cache,
                                      **dataset_cfg)
 
             if os.path.exists(os.path.join(path, "valid")):
-                self.valid = Dataset(dataset_path=os.path.join(path, "valid"), **dataset_cfg)
+                self.valid = Dataset(dataset_path=os.path.join(path, "valid"), cache=self.cache, **dataset_cfg)
             else:
-                self.valid = Dataset(dataset_path=path, **dataset_cfg)
+                self.valid = Dataset(dataset_path=path, cache=self.cache, **dataset_cfg)
 
             if split != "valid":
                 if os.path.exists(os.path.join(path, "test")):
                     self.test = Dataset(dataset_path=os.path.join(
-                        path, "test"), **dataset_cfg)
+                        path, "test"), cache=self.cache, **dataset_cfg)
                 else:
                     try:
-                        self.test = Dataset(dataset_path=path, **dataset_cfg)
+                        self.test = Dataset(dataset_path=path, cache=self.cache, **dataset_cfg)
                     except AssertionError:
                         self.test = self.valid
 
@@ -160,12 +166,12 @@ class DatasetGroup:
                           'rb') as f:
                     data = msgpack.unpackb(decompressor.decompress(f.read()),
                                            raw=False)
-                data = Dataset(data)
+                data = Dataset(data, cache=self.cache)
                 return data
 
         print("no cache found or seed not set, generate data")
         data = func(**cfg)
-        data = Dataset(data)
+        data = Dataset(data, cache=self.cache)
 
         if seed is not None:
             print("data generated, store in cache: %s" % cache_dir)
@@ -178,13 +184,201 @@ class DatasetGroup:
         return data
 
 
+def scene_nbytes(data):
+    """Approximate memory footprint of a scene."""
+    if isinstance(data, ColumnarScene):
+        return data.nbytes
+    nbytes = 0
+    for frame in data:
+        for v in frame.values():
+            nbytes += v.nbytes if isinstance(v, np.ndarray) else sys.getsizeof(v)
+    return nbytes
+
+
+class SceneCache:
+    """Byte-budgeted LRU cache of decoded scenes, keyed by file path (or data and scene index)."""
+
+    def __init__(self, max_bytes=2 ** 30):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        nbytes = scene_nbytes(data)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        while self.entries and self.nbytes + nbytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.nbytes -= evicted
+            self.evictions += 1
+        self.entries[key] = (data, nbytes)
+        self.nbytes += nbytes
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'mbytes': self.nbytes / 2 ** 20
+        }
+
+    def __getstate__(self):
+        # worker processes start with an empty cache instead of a copy
+        state = self.__dict__.copy()
+        state['entries'] = collections.OrderedDict()
+        state['nbytes'] = 0
+        return state
+
+
+SCENE_MAGIC = b'SPHSCN01'
+SCENE_ALIGN = 64
+SCENE_FIELDS = ['pos', 'vel', 'grav', 'm', 'viscosity']
+SCENE_STATIC_FIELDS = ['box', 'box_normals']
+
+
+def _align(offset, alignment=SCENE_ALIGN):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def scene_arrays(data):
+    """Stacks a decoded scene (list of frame dicts) into one float32 array per field."""
+    arrays = {}
+    for k in SCENE_FIELDS:
+        if data[0].get(k, None) is not None:
+            arrays[k] = np.stack([np.asarray(frame[k], dtype=np.float32) for frame in data], 0)
+    for k in SCENE_STATIC_FIELDS:
+        if data[0].get(k, None) is not None:
+            arrays[k] = np.reshape(np.asarray(data[0][k], dtype=np.float32), (-1, 3))
+    return arrays
+
+
+def write_scene(path, data):
+    """Writes a decoded scene (list of frame dicts) in the columnar layout.
+
+    The file starts with a magic, the length of a json index header and the
+    header itself. It is followed by one contiguous float32 array per field
+    ([T, ...] for the per-frame fields, a single copy of the box), so that
+    every field can be opened with np.memmap.
+    """
+    arrays = scene_arrays(data)
+
+    index = {
+        'scene_id': str(data[0].get('scene_id', '')),
+        'frame_id': [int(frame.get('frame_id', i)) for i, frame in enumerate(data)],
+        'arrays': {}
+    }
+    offset = 0
+    for k, v in arrays.items():
+        index['arrays'][k] = {'offset': offset, 'shape': list(v.shape), 'dtype': 'float32'}
+        offset = _align(offset + v.nbytes)
+
+    header = json.dumps(index).encode()
+    data_start = _align(len(SCENE_MAGIC) + 8 + len(header))
+    with open(path, 'wb') as f:
+        f.write(SCENE_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for k, v in arrays.items():
+            f.seek(data_start + index['arrays'][k]['offset'])
+            f.write(np.ascontiguousarray(v).tobytes())
+
+
+class ColumnarScene:
+    """Scene stored as one [T, ...] array per field and a single box.
+
+    The arrays are either memory-mapped from a file written by write_scene
+    (see open) or stacked once from a decoded msgpack scene (see
+    from_frames). Indexing returns frame dicts of views like a decoded
+    msgpack scene, while window() slices a range of frames without copying.
+    """
+
+    def __init__(self, arrays, frame_id, scene_id):
+        self.arrays = arrays
+        self.frame_id = np.asarray(frame_id)
+        self.scene_id = scene_id
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            magic = f.read(len(SCENE_MAGIC))
+            if magic != SCENE_MAGIC:
+                raise ValueError("%s is not a columnar scene file" % path)
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len))
+
+        data_start = _align(len(SCENE_MAGIC) + 8 + header_len)
+        arrays = {}
+        for k, v in header['arrays'].items():
+            shape = tuple(v['shape'])
+            if np.prod(shape) == 0:
+                arrays[k] = np.empty(shape, dtype=v['dtype'])
+            else:
+                arrays[k] = np.memmap(path, dtype=v['dtype'], mode='r',
+                                      offset=data_start + v['offset'], shape=shape)
+        return cls(arrays, header['frame_id'], header['scene_id'])
+
+    @classmethod
+    def from_frames(cls, data):
+        return cls(scene_arrays(data),
+                   [frame.get('frame_id', i) for i, frame in enumerate(data)],
+                   str(data[0].get('scene_id', '')))
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self.arrays.values())
+
+    def __len__(self):
+        return len(self.frame_id)
+
+    def __getitem__(self, idx):
+        frame = {'frame_id': self.frame_id[idx], 'scene_id': self.scene_id}
+        for k, v in self.arrays.items():
+            frame[k] = v if k in SCENE_STATIC_FIELDS else v[idx]
+        return frame
+
+    def window(self, start, length, stride=1):
+        """Returns the sample dict of `length` frames starting at `start`.
+
+        Per-frame fields are views of shape [length, ...], fields missing in
+        the scene are [None]. The box is not replicated over time, it has a
+        leading axis of size 1 and the same box is used for all frames.
+        """
+        stop = start + (length - 1) * stride + 1
+        sample = {}
+        for k in SCENE_FIELDS:
+            sample[k] = self.arrays[k][start:stop:stride] if k in self.arrays else [None]
+        for k in SCENE_STATIC_FIELDS:
+            sample[k] = self.arrays[k][None] if k in self.arrays else np.empty((1, 0, 3), dtype=np.float32)
+        sample['frame_id'] = self.frame_id[start:stop:stride]
+        sample['scene_id'] = np.full(len(sample['frame_id']), self.scene_id)
+        return sample
+
+
 class Dataset:
-    def __init__(self, data=None, dataset_path=None):
+    def __init__(self, data=None, dataset_path=None, cache=None):
         self.data = None
         self.files = None
+        self.cache = cache
         if dataset_path is not None:
             self.files = sorted(
                 glob(os.path.join(dataset_path, '*.msgpack.zst')))
+            if not len(self.files):
+                self.files = sorted(
+                    glob(os.path.join(dataset_path, '*.scene')))
             assert len(self.files), "List of files must not be empty"
             print(self.files[0:20], '...' if len(self.files) > 20 else '')
         elif data is not None:
@@ -200,13 +394,33 @@ class Dataset:
 
     def __getitem__(self, idx):
         if self.data is not None:
-            return self.data[idx]
+            # the stacked arrays copy the frames, so only keep them within the cache budget
+            scene = self.cache.get((id(self.data), idx)) if self.cache is not None else None
+            if scene is None:
+                scene = ColumnarScene.from_frames(self.data[idx])
+                if self.cache is not None:
+                    self.cache.put((id(self.data), idx), scene)
+            return scene
+
+        if self.files[idx].endswith('.scene'):
+            # memory-mapped, nothing to decode or cache
+            return ColumnarScene.open(self.files[idx])
+
+        if self.cache is not None:
+            data = self.cache.get(self.files[idx])
+            if data is not None:
+                return data
 
         # read all data from file
         decompressor = zstd.ZstdDecompressor()
         with open(self.files[idx], 'rb') as f:
-            return msgpack.unpackb(decompressor.decompress(f.read()),
+            data = msgpack.unpackb(decompressor.decompress(f.read()),
                                    raw=False)
+        data = ColumnarScene.from_frames(data)
+
+        if self.cache is not None:
+            self.cache.put(self.files[idx], data)
+        return data
 
 
 def get_rng(obj=None):
@@ -242,6 +456,9 @@ class PhysicsSimDataFlow:
                  translate=None,
                  scale=None,
                  grav_eqvar=None,
+                 seed=None,
+                 worker_id=0,
+                 num_workers=1,
                  **kwargs):
         assert window >= 0
         self.dataset = dataset
@@ -251,13 +468,18 @@ class PhysicsSimDataFlow:
         self.pre_frames = pre_frames
         self.stride = stride
         self.augment = augment
-        self.translate = translate
-        self.grav_eqvar = grav_eqvar
-        self.scale = scale
+        # float32, so the transformed windows keep the dtype of the scene
+        self.translate = np.asarray(translate, dtype=np.float32) if translate is not None else None
+        self.grav_eqvar = np.asarray(grav_eqvar, dtype=np.float32) if grav_eqvar is not None else None
+        self.scale = np.asarray(scale, dtype=np.float32) if scale is not None else None
         self.sample_cnt = sample_cnt
-        self.rng = get_rng(self)
+        # each worker only reads its own shard of the files
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.rng = get_rng(self) if seed is None else np.random.RandomState(seed)
 
     def transform(self, data):
+        # the windows are views of the (cached) scene, never modify them in-place
         for mode, config in self.augment.items():
             if config is None:
                 config = {}
@@ -266,7 +488,7 @@ class PhysicsSimDataFlow:
                 for k in ['box', 'box_normals', 'pos', 'vel']:
                     data[k] = np.matmul(data[k], rand_R)
                 if data['grav'][0] is not None:
-                    data[k] = np.matmul(data['grav'], rand_R)
+                    data['grav'] = np.matmul(data['grav'], rand_R)
 
             # elif mode == "shuffle":
             #     idx = np.arange(data['pos'].shape[1])
@@ -281,10 +503,11 @@ class PhysicsSimDataFlow:
 
             elif mode == "jitter":
                 for k, v in config.get("channels", {"pos", 1e-5}).items():
-                    data[k] += self.rng.normal(scale=v, size=data[k].shape)
+                    data[k] = data[k] + self.rng.normal(scale=v, size=data[k].shape).astype(np.float32)
 
             elif mode == "jitter_inp":
                 for k, v in config.get("channels", {"pos", 1e-5}).items():
+                    data[k] = np.array(data[k])
                     data[k][0] += self.rng.normal(scale=v,
                                                   size=data[k][0].shape)
 
@@ -292,20 +515,20 @@ class PhysicsSimDataFlow:
                 raise NotImplementedError
 
         if self.translate is not None:
-            data['pos'] += self.translate
-            data['box'] += self.translate
+            data['pos'] = data['pos'] + self.translate
+            data['box'] = data['box'] + self.translate
         if self.scale is not None:
-            data['pos'] *= self.scale
-            data['box'] *= self.scale
-            data['vel'] *= self.scale
+            data['pos'] = data['pos'] * self.scale
+            data['box'] = data['box'] * self.scale
+            data['vel'] = data['vel'] * self.scale
 
             if data['grav'][0] is not None:
-                data['grav'] *= self.scale
+                data['grav'] = data['grav'] * self.scale
 
         if self.grav_eqvar is not None:
             # WARNING: assuming same gravity for all particles for one sequence
-            R = align_vector(self.grav_eqvar, data['grav'][0, 0])
-            data['orig_grav'] = data['grav'][0, 0]
+            grav = np.reshape(data['grav'][0], (-1, 3))[0]
+            R = align_vector(self.grav_eqvar, grav)
             for k in ['box', 'box_normals', 'pos', 'vel', 'grav']:
                 data[k] = np.matmul(data[k], R)
 
@@ -313,14 +536,16 @@ class PhysicsSimDataFlow:
 
     def __iter__(self):
         # returns a list of dictioniaries, shape: (b, t, n, 3)
-        files_idxs = np.arange(len(self.dataset))
+        # the box is not replicated over time, shape: (b, 1, m, 3)
+        # gravity is a vector per frame, shape: (b, t, 3)
+        files_idxs = np.arange(len(self.dataset))[self.worker_id::self.num_workers]
         if self.shuffle:
             self.rng.shuffle(files_idxs)
 
         for file_i in files_idxs:
-            data = self.dataset[file_i]
+            scene = self.dataset[file_i]
             data_idxs = np.arange(
-                len(data) - (self.window - 1 + self.pre_frames) * self.stride)
+                len(scene) - (self.window - 1 + self.pre_frames) * self.stride)
             assert (len(data_idxs) > 0)
             if self.shuffle:
                 self.rng.shuffle(data_idxs)
@@ -329,43 +554,25 @@ class PhysicsSimDataFlow:
                 data_idxs = data_idxs[:self.sample_cnt]
 
             for data_i in data_idxs:
-                sample = {}
-                sample['pre'] = np.random.randint(self.pre_frames + 1)
-
-                for k in ['pos', 'vel', 'grav', 'm', 'viscosity']:
-                    if k in data[data_i]:
-                        sample[k] = np.stack([
-                            data[data_i + i * self.stride].get(
-                                k, None).astype("float32")
-                            for i in range(sample['pre'] + self.window)
-                        ], 0)
-                    else:
-                        sample[k] = [None]
-
-                for k in ['box', 'box_normals']:
-                    if k in data[0]:
-                        sample[k] = np.stack([
-                            data[0].get(k, None).astype("float32")
-                            for i in range(sample['pre'] + self.window)
-                        ], 0)
-                    else:
-                        sample[k] = [np.empty((0, 3))]
-                    sample[k] = np.reshape(sample[k], (len(sample[k]), -1, 3))
-
-                for k in ['frame_id', 'scene_id']:
-                    sample[k] = np.stack([
-                        data[data_i + i * self.stride].get(k, None)
-                        for i in range(sample['pre'] + self.window)
-                    ], 0)
-
-                if sample['grav'][0] is not None:
-                    sample['grav'] = np.full_like(sample['vel'],
-                                                  np.expand_dims(
-                                                      sample['grav'],
-                                                      1))  # / 100
-
-                sample = self.transform(sample)
-                yield sample
+                pre = np.random.randint(self.pre_frames + 1)
+                yield self.load((int(file_i), int(data_i), int(pre), self.window), scene)
+
+    def load(self, ref, scene=None):
+        """Returns the sample of a reference (file, frame offset, warm-up frames, window).
+
+        The reference is kept in 'ref', so a sample can be loaded again
+        later without keeping its arrays. Augmentations are drawn anew.
+        """
+        file_i, data_i, pre, window = ref
+        if scene is None:
+            scene = self.dataset[file_i]
+        sample = scene.window(data_i, pre + window, self.stride)
+        sample['pre'] = pre
+        sample['ref'] = ref
+        return self.transform(sample)
+
+    def load_batch(self, refs):
+        return next(batch_data_generator(map(self.load, refs), len(refs)))
 
 
 def get_rollout(dataset,
@@ -399,7 +606,10 @@ def get_rollout(dataset,
         merge = {}
         for k in ['pos', 'vel', 'grav', 'm', 'viscosity', 'frame_id', 'scene_id', 'box', 'box_normals']:
             l = [data[k] for data in rollout[i]]
-            if len(l) == len(rollout[i]) and len(l) > 0:
+            if k in SCENE_STATIC_FIELDS and len(l) > 0:
+                # static for the whole sequence, keep a single copy
+                merge[k] = l[0]
+            elif len(l) == len(rollout[i]) and len(l) > 0:
                 merge[k] = np.concatenate(l, 0)
             # else:
             #     print(k)
@@ -458,16 +668,140 @@ def batch_data_generator(data_iter, batch_size):
         yield batch
 
 
+def build_batch_flow(dataset, batch_size=1, repeat=False, shuffle_buffer=None, **kwargs):
+    data_flow = PhysicsSimDataFlow(dataset=dataset,
+                                   shuffle=bool(shuffle_buffer),
+                                   **kwargs)
+
+    if repeat:
+        data_flow = repeat_iter(data_flow)
+    if shuffle_buffer:
+        data_flow = ShuffleIterator(data_flow, shuffle_buffer)
+
+    return batch_data_generator(data_flow, batch_size)
+
+
+class _WorkerDone:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+
+
+class _WorkerError:
+    def __init__(self, worker_id, trace):
+        self.worker_id = worker_id
+        self.trace = trace
+
+
+def _prefetch_worker(queue, stop_event, worker_id, num_workers, seed, kwargs):
+    try:
+        # seed all generators used by the data flow (np.random for the warm-up
+        # length, random for the shuffle buffer) deterministically per worker
+        np.random.seed(seed + worker_id)
+        random.seed(seed + worker_id)
+        data_flow = build_batch_flow(seed=seed + worker_id,
+                                     worker_id=worker_id,
+                                     num_workers=num_workers,
+                                     **kwargs)
+        for batch in data_flow:
+            while True:
+                if stop_event.is_set():
+                    return
+                try:
+                    queue.put(batch, timeout=0.1)
+                    break
+                except Full:
+                    continue
+        queue.put(_WorkerDone(worker_id))
+    except Exception:
+        queue.put(_WorkerError(worker_id, traceback.format_exc()))
+
+
+class PrefetchLoader:
+    """Runs the data flow in worker processes.
+
+    Each worker decodes its own shard of the files, assembles batches and puts
+    them into a bounded queue, so reading the next batch only blocks if the
+    workers fall behind the training loop.
+    """
+
+    def __init__(self, dataset, num_workers=2, prefetch_size=None, seed=None, **kwargs):
+        num_workers = min(num_workers, len(dataset))
+        if prefetch_size is None:
+            prefetch_size = 2 * num_workers
+        if seed is None:
+            # derived from the global seed, so runs stay reproducible
+            seed = np.random.randint(2 ** 31 - num_workers)
+
+        ctx = multiprocessing.get_context()
+        self.queue = ctx.Queue(maxsize=prefetch_size)
+        self.stop_event = ctx.Event()
+        self.workers = []
+        for worker_id in range(num_workers):
+            worker = ctx.Process(target=_prefetch_worker,
+                                 args=(self.queue, self.stop_event, worker_id, num_workers, seed,
+                                       dict(dataset=dataset, **kwargs)),
+                                 daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.active = num_workers
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.active > 0:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except Empty:
+                if not any(w.is_alive() for w in self.workers):
+                    self.close()
+                    raise RuntimeError("Data loader workers exited unexpectedly")
+                continue
+            if isinstance(item, _WorkerDone):
+                self.active -= 1
+            elif isinstance(item, _WorkerError):
+                self.close()
+                raise RuntimeError("Data loader worker %d failed:\n%s" % (item.worker_id, item.trace))
+            else:
+                return item
+        self.close()
+        raise StopIteration
+
+    def qsize(self):
+        try:
+            return self.queue.qsize()
+        except NotImplementedError:
+            return -1
+
+    def close(self):
+        if not getattr(self, 'workers', None):
+            return
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(timeout=1.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.active = 0
+        self.queue.cancel_join_thread()
+
+    def __del__(self):
+        self.close()
+
+
 def get_dataloader(dataset, batch_size=1, window=1, repeat=False, shuffle_buffer=None, cache_data=False,
-                   is2d=False, pre_frames=0, stride=1, translate=None, scale=None, augment={}, **kwargs):
+                   is2d=False, pre_frames=0, stride=1, translate=None, scale=None, augment={}, num_workers=0,
+                   prefetch_size=None, seed=None, **kwargs):
     # caching makes only sense if the data is finite
     if cache_data:
         assert repeat == False
         assert not augment
 
-    data_flow = PhysicsSimDataFlow(
+    flow_cfg = dict(
         dataset=dataset,
-        shuffle=bool(shuffle_buffer),
+        batch_size=batch_size,
+        repeat=repeat,
+        shuffle_buffer=shuffle_buffer,
         window=window,
         is2d=is2d,
         pre_frames=pre_frames,
@@ -478,12 +812,10 @@ def get_dataloader(dataset, batch_size=1, window=1, repeat=False, shuffle_buffer
         **kwargs
     )
 
-    if repeat:
-        data_flow = repeat_iter(data_flow)
-    if shuffle_buffer:
-        data_flow = ShuffleIterator(data_flow, shuffle_buffer)
+    if num_workers > 0 and not cache_data:
+        return PrefetchLoader(num_workers=num_workers, prefetch_size=prefetch_size, seed=seed, **flow_cfg)
 
-    data_flow = batch_data_generator(data_flow, batch_size)
+    data_flow = build_batch_flow(seed=seed, **flow_cfg)
 
     if cache_data:
         data_flow = list(data_flow)
@@ -498,3 +830,41 @@ def write_results(path, name, data):
             dset = grp.create_dataset(props['name'], data=d)
             dset.attrs["type"] = props.get("type", "DENSITY")
             dset.attrs["dim"] = d.shape
+
+
+class ResultStream:
+    """Incremental version of `write_results`.
+
+    Datasets created by `append` grow by one frame per call and are stored
+    chunked per frame and compressed, so frames can be written as they are
+    produced.
+    """
+
+    def __init__(self, path, name, compression="gzip"):
+        self.file = h5py.File(path, "w")
+        self.grp = self.file.create_group(name)
+        self.compression = compression
+
+    def write(self, name, data, typ="DENSITY"):
+        dset = self.grp.create_dataset(name,
+                                       data=data,
+                                       compression=self.compression)
+        dset.attrs["type"] = typ
+
+    def append(self, name, frame, typ="DENSITY"):
+        if name not in self.grp:
+            dset = self.grp.create_dataset(name,
+                                           shape=(0, ) + frame.shape,
+                                           maxshape=(None, ) + frame.shape,
+                                           chunks=(1, ) + frame.shape,
+                                           dtype=frame.dtype,
+                                           compression=self.compression)
+            dset.attrs["type"] = typ
+        dset = self.grp[name]
+        dset.resize(dset.shape[0] + 1, axis=0)
+        dset[-1] = frame
+
+    def close(self):
+        for dset in self.grp.values():
+            dset.attrs["dim"] = dset.shape
+        self.file.close()
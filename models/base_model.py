@@ -38,6 +38,10 @@ class BaseModel(ABC, tf.keras.Model):
         **kwargs: Configuration of the model as keyword arguments.
     """
 
+    # True if the model only uses per-particle and fixed radius neighborhood
+    # operations, i.e. several scenes can be packed into one particle set
+    supports_batching = False
+
     def __init__(self,
                  name,
                  timestep,
@@ -119,6 +123,26 @@ class BaseModel(ABC, tf.keras.Model):
 
         return [pos, vel, acc, feats, box, bfeats]
 
+    def boundary_context(self, data):
+        """Precomputes the quantities of a scene which only depend on its boundary.
+
+        The result is passed back to the model as `boundary` keyword argument
+        for all steps of the same scene.
+        """
+        d = self.transform(data, training=False)
+        return self.build_boundary(d[4], d[5])
+
+    def build_boundary(self, box, bfeats):
+        return {}
+
+    def receptive_field(self):
+        """Radius around a particle (in model units) which determines its next state.
+
+        Used to size the halo regions of tiled rollouts. None if the model
+        has non-local operations and can not be tiled.
+        """
+        return None
+
     def inv_transform(self, prev, data, **kwargs):
         pos, vel = prev
 
@@ -281,7 +305,7 @@ class BaseModel(ABC, tf.keras.Model):
         return pos, vel
 
     def calculate_boundary_mass(self, box, query_radii, rest_dens):
-        add_sum = compute_kernel_sum(box, radius=query_radii).numpy()
+        add_sum = tf.stop_gradient(compute_kernel_sum(box, radius=query_radii))
         box_masses = rest_dens / add_sum
         return box_masses
 
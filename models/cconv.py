@@ -47,6 +47,13 @@ class CConv(PBFNet):
                                           activation=None)
             self.denses.append(dense)
 
+    def receptive_field(self):
+        if any(s != 1 for s in self.strides) or self.equivar:
+            return None
+        # density features, input convolutions and the hidden convolutions
+        hops = 1 + len(self.convs) + (1 if self.dens_feats or self.pres_feats else 0)
+        return hops * max(self.particle_radii[0], self.dens_radius[0])
+
     def forward(self, prev, data, training=True, **kwargs):
         pos, feats = prev[:2]
         pos = pos[0]
@@ -58,7 +65,8 @@ class CConv(PBFNet):
         ans_convs = [feats]
         for conv, dense in zip(self.convs, self.denses):
             feats = relu(ans_convs[-1])
-            ans_conv = conv(feats, pos, pos, filter_extent, None)
+            ans_conv = conv(feats, pos, pos, filter_extent, None,
+                            fixed_radius_search_hash_table=self.get_hash_table('pos', pos, filter_extent))
             ans_dense = dense(feats)
             if ans_dense.shape[-1] == ans_convs[-1].shape[-1]:
                 ans = ans_conv + ans_dense + ans_convs[-1]
@@ -1,10 +1,9 @@
-import functools
 import numpy as np
 import tensorflow as tf
+import open3d.ml.tf as o3dml
 import graph_nets as gn
 import sonnet as snt
 from typing import Callable
-from sklearn import neighbors
 from utils.tools.losses import get_loss
 from .base_model import BaseModel
 
@@ -127,7 +126,7 @@ class GNS(BaseModel):
 
         # Get connectivity of the graph.
         (senders, receivers, n_edge
-         ) = compute_connectivity_for_batch_pyfunc(
+         ) = compute_connectivity_for_batch(
             most_recent_position, n_node, self._connectivity_radius)
 
         # Collect node features.
@@ -346,24 +345,13 @@ class EncodeProcessDecode(snt.Module):
         return self._decoder_network(latent_graph.nodes)
 
 
-def compute_connectivity_for_batch_pyfunc(
+def compute_connectivity_for_batch(
         positions, n_node, radius, add_self_edges=True):
-    """`_compute_connectivity_for_batch` wrapped in a pyfunc."""
-    partial_fn = functools.partial(
-        _compute_connectivity_for_batch, add_self_edges=add_self_edges)
-    senders, receivers, n_edge = tf.py_function(
-        partial_fn,
-        [positions, n_node, radius],
-        [tf.int32, tf.int32, tf.int32])
-    senders.set_shape([None])
-    receivers.set_shape([None])
-    n_edge.set_shape(n_node.get_shape())
-    return senders, receivers, n_edge
-
+    """Radius connectivity for a batch of graphs, computed in-graph.
 
-def _compute_connectivity_for_batch(
-        positions, n_node, radius, add_self_edges):
-    """`compute_connectivity` for a batch of graphs.
+    Runs a single batched fixed radius search, the row splits keep the
+    graphs separate. Neighbor indices refer to the concatenated positions, so
+    no per-graph offsets have to be added.
 
     Args:
       positions: Positions of nodes in the batch of graphs. Shape:
@@ -379,64 +367,21 @@ def _compute_connectivity_for_batch(
       number of edges per graph [num_graphs_in_batch]
 
     """
-
-    # TODO(alvarosg): Consider if we want to support batches here or not.
-    # Separate the positions corresponding to particles in different graphs.
-    positions_per_graph_list = np.split(positions, np.cumsum(n_node[:-1]), axis=0)
-    receivers_list = []
-    senders_list = []
-    n_edge_list = []
-    num_nodes_in_previous_graphs = 0
-
-    # Compute connectivity for each graph in the batch.
-    for positions_graph_i in positions_per_graph_list:
-        senders_graph_i, receivers_graph_i = _compute_connectivity(
-            positions_graph_i, radius, add_self_edges)
-
-        num_edges_graph_i = len(senders_graph_i)
-        n_edge_list.append(num_edges_graph_i)
-
-        # Because the inputs will be concatenated, we need to add offsets to the
-        # sender and receiver indices according to the number of nodes in previous
-        # graphs in the same batch.
-        receivers_list.append(receivers_graph_i + num_nodes_in_previous_graphs)
-        senders_list.append(senders_graph_i + num_nodes_in_previous_graphs)
-
-        num_nodes_graph_i = len(positions_graph_i)
-        num_nodes_in_previous_graphs += num_nodes_graph_i
-
-    # Concatenate all of the results.
-    senders = np.concatenate(senders_list, axis=0).astype(np.int32)
-    receivers = np.concatenate(receivers_list, axis=0).astype(np.int32)
-    n_edge = np.stack(n_edge_list).astype(np.int32)
-
+    row_splits = tf.concat(
+        [tf.zeros([1], tf.int64),
+         tf.cumsum(tf.cast(n_node, tf.int64))], axis=0)
+    fixed_radius_search = o3dml.layers.FixedRadiusSearch(
+        ignore_query_point=not add_self_edges, return_distances=False)
+    neighbors_index, neighbors_row_splits, _ = fixed_radius_search(
+        positions,
+        positions,
+        radius,
+        points_row_splits=row_splits,
+        queries_row_splits=row_splits)
+
+    senders = tf.cast(
+        tf.ragged.row_splits_to_segment_ids(neighbors_row_splits), tf.int32)
+    receivers = tf.cast(neighbors_index, tf.int32)
+    edge_splits = tf.gather(neighbors_row_splits, row_splits)
+    n_edge = tf.cast(edge_splits[1:] - edge_splits[:-1], tf.int32)
     return senders, receivers, n_edge
-
-
-def _compute_connectivity(positions, radius, add_self_edges):
-    """Get the indices of connected edges with radius connectivity.
-
-    Args:
-      positions: Positions of nodes in the graph. Shape:
-        [num_nodes_in_graph, num_dims].
-      radius: Radius of connectivity.
-      add_self_edges: Whether to include self edges or not.
-
-    Returns:
-      senders indices [num_edges_in_graph]
-      receiver indices [num_edges_in_graph]
-
-    """
-    tree = neighbors.KDTree(positions)
-    receivers_list = tree.query_radius(positions, r=radius)
-    num_nodes = len(positions)
-    senders = np.repeat(range(num_nodes), [len(a) for a in receivers_list])
-    receivers = np.concatenate(receivers_list, axis=0)
-
-    if not add_self_edges:
-        # Remove self edges.
-        mask = senders != receivers
-        senders = senders[mask]
-        receivers = receivers[mask]
-
-    return senders, receivers
@@ -89,7 +89,10 @@ class HRNet(PBFNet):
                                           axis=-1)
                     ans_conv = self.convs[layer][scale][0][inp_scale](
                         feats * importance, pos[inp_scale], pos[scale], ext,
-                        None)
+                        None,
+                        fixed_radius_search_hash_table=self.get_hash_table(
+                            (inp_scale, max(inp_scale, scale)), pos[inp_scale],
+                            ext))
                     if layer < len(self.denses):
                         if scale == inp_scale:
                             ans_conv += self.denses[layer][scale][0][
@@ -120,7 +123,9 @@ class HRNet(PBFNet):
                 for i in range(1, len(self.convs[layer][scale])):
                     ans_conv = self.convs[layer][scale][i][0](
                         ans[-1] * importance, pos[scale], pos[scale], ext,
-                        None)
+                        None,
+                        fixed_radius_search_hash_table=self.get_hash_table(
+                            (scale, max(inp_scale, scale)), pos[scale], ext))
                     ans_dens = self.denses[layer][scale][i][0](ans[-1])
                     ans_conv += ans_dens
                     if len(ans_convs[-1]) > scale and ans_conv.shape[
@@ -53,6 +53,7 @@ class PBFNet(BaseModel):
                  sample_pad=0,
                  sample_hyst=0.1,
                  part_scale=1.0,
+                 conv_memory_budget=None,
                  **kwargs):
         super().__init__(name=name,
                          timestep=timestep,
@@ -99,6 +100,8 @@ class PBFNet(BaseModel):
         self.use_bnds = use_bnds
 
         self.part_scale = part_scale
+        # MB of per neighbor pair intermediates of the convolutions, None for no chunking
+        self.conv_memory_budget = conv_memory_budget
 
         # loss setup
         self.num_fluid_neighbors = 1
@@ -198,17 +201,37 @@ class PBFNet(BaseModel):
             window_function=get_window_func(window_func),
             radius_search_ignore_query_points=ignore_query_points,
             use_dense_layer_for_center=False,
+            memory_budget=self.conv_memory_budget,
             **kwargs)
 
         self._all_convs.append((name, conv))
         return conv
 
+    def get_hash_table(self, key, points, extent):
+        """Returns the spatial hash table of `points` for filters of the given extent.
+
+        Tables are built once per step and point set / scale (`key`) and
+        reused by all layers which search the same points.
+        """
+        if key not in self.hash_tables:
+            self.hash_tables[key] = o3dml.ops.build_spatial_hash_table(
+                points,
+                radius=0.5 * extent,
+                points_row_splits=tf.stack([0, tf.shape(points, out_type=tf.int64)[0]]),
+                hash_table_size_factor=1 / 64)
+            self.hash_table_builds += 1
+        return self.hash_tables[key]
+
     def preprocess(self,
                    data,
                    training=True,
                    vel_corr=None,
                    tape=None,
                    **kwargs):
+        # the point sets change every step
+        self.hash_tables = {}
+        self.hash_table_builds = 0
+
         #
         # advection step
         #
@@ -7,12 +7,14 @@ from utils.tools.losses import get_loss, compute_density, compute_pressure, get_
     compute_transformed_dx
 from utils.convolutions import ContinuousConv, PointSampling
 from utils.tools.losses import get_window_func
-from utils.tools.neighbor import combine_nns, reduce_subarrays_sum_multi
+from utils.tools.neighbor import combine_nns, reduce_subarrays_sum_multi, drop_self, NeighborList
 
 from .base_model import BaseModel
 
 
 class PBFReal(BaseModel):
+    supports_batching = True
+
     def __init__(self,
                  name="PBFReal",
                  particle_radii=[0.025],
@@ -33,6 +35,8 @@ class PBFReal(BaseModel):
                  viscosity=0.02,
                  vorticity_fac=0.00001,
                  window_dens='cubic',
+                 neighbor_skin=0.0,
+                 conv_memory_budget=None,
                  **kwargs):
         super().__init__(name=name,
                          timestep=timestep,
@@ -43,6 +47,10 @@ class PBFReal(BaseModel):
                          **kwargs)
         self.query_radii = particle_radii[0] * 4 if query_radii is None else query_radii
         self.m_neighborSearch = o3dml.layers.FixedRadiusSearch(ignore_query_point=True, return_distances=True)
+        # neighbor lists shared by the solver, convolutions, density features and loss
+        self.neighbors = NeighborList(skin=neighbor_skin)
+        # MB of edge intermediates per conv chunk, large scenes are processed in receiver chunks
+        self.conv_memory_budget = conv_memory_budget
         self.m_density0 = density0
         diameter = 2.0 * particle_radii[0]
         volume = diameter * diameter * diameter
@@ -58,18 +66,37 @@ class PBFReal(BaseModel):
                     v["radius"] = self.query_radii
             self.loss_fn[l] = get_loss(**v)
 
+    def build_boundary(self, box, bfeats):
+        hash_table = o3dml.ops.build_spatial_hash_table(box,
+                                                        radius=self.query_radii,
+                                                        points_row_splits=tf.stack(
+                                                            [0, tf.shape(box, out_type=tf.int64)[0]]),
+                                                        hash_table_size_factor=1 / 64)
+        return {
+            'masses': self.calculate_boundary_mass(box, self.query_radii, self.m_density0),
+            'hash_table': hash_table
+        }
+
+    def receptive_field(self):
+        # density and position update of every solver iteration, XSPH viscosity
+        return (2 * self.m_maxIter + 1) * self.query_radii
+
     def preprocess(self,
                    data,
                    training=True,
                    vel_corr=None,
                    tape=None,
+                   boundary=None,
                    **kwargs):
         #
         # advection step
         #
         _pos, _vel, acc, feats, box, bfeats = data
 
-        solid_masses = self.calculate_boundary_mass(box, self.query_radii, self.m_density0)
+        if boundary is not None:
+            solid_masses = boundary['masses']
+        else:
+            solid_masses = self.calculate_boundary_mass(box, self.query_radii, self.m_density0)
 
         if vel_corr is not None:
             vel = tf.stop_gradient(vel_corr)
@@ -79,12 +106,13 @@ class PBFReal(BaseModel):
 
         return [pos, vel, solid_masses]
 
-    def forward(self, prev, data, training=True, **kwargs):
+    def forward(self, prev, data, training=True, boundary=None, **kwargs):
         pos, vel, solid_masses = prev
         _pos, _vel, acc, feats, box, bfeats = data
 
-        fluid_nns = self.m_neighborSearch(pos, pos, self.query_radii)
-        solid_nns = self.m_neighborSearch(box, pos, self.query_radii)
+        fluid_nns, solid_nns = self.neighbors(pos, box, self.query_radii, num_queries=tf.shape(pos)[0],
+                                              hash_table=boundary['hash_table'] if boundary is not None else None)
+        fluid_nns = drop_self(fluid_nns)
 
         group_neighbors = combine_nns(fluid_nns, solid_nns)
         group_masses = tf.concat([self.fluid_mass * tf.ones_like(pos[:, 0]), solid_masses], axis=0)
@@ -148,6 +176,7 @@ class PBFReal(BaseModel):
                         num_solid_neighbors=num_solid_neighbors,
                         input=data[0],
                         target_prev=data[2],
-                        pre_steps=data[3])
+                        pre_steps=data[3],
+                        particle_weights=data[4] if len(data) > 4 else None)
 
         return loss
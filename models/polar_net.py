@@ -3,47 +3,53 @@ from scipy.spatial import cKDTree
 import open3d.ml.tf as o3dml
 import numpy as np
 from utils.tools.losses import get_window_func, compute_density, compute_pressure
-from utils.tools.neighbor import reduce_subarrays_sum_multi
+from utils.tools.neighbor import reduce_subarrays_sum_multi, combine_nns, drop_self, slice_neighbors, \
+    aggregate_basis, apply_basis_kernel, budget_edges, map_receiver_chunks, slice_receivers
 
 from .pbf_real import PBFReal
 
 
 class PolarConv(tf.keras.layers.Layer):
-    def __init__(self, filters, radius_search_ignore_query_points=True, activation=None, **kwargs):
+    def __init__(self, filters, radius_search_ignore_query_points=True, activation=None, memory_budget=None,
+                 **kwargs):
         super(PolarConv, self).__init__(**kwargs)
         self.out_dims = filters
         self.activation = activation
+        # MB of edge intermediates per chunk of receivers, None to process all edges at once
+        self.memory_budget = memory_budget
         self.fixed_radius_search = o3dml.layers.FixedRadiusSearch(ignore_query_point=radius_search_ignore_query_points)
 
     def build(self, inp_features_shape):
         # 创建权重矩阵，这里假设权重是可学习的
         self.kernel = self.add_weight("kernel", shape=[4, inp_features_shape[-1], self.out_dims])
 
-    def call(self, inp_features, inp_positions, out_positions, extents):
+    def call(self, inp_features, inp_positions, out_positions, extents, neighbors=None):
         # 这里我们只是简单地计算每个输出点的邻居
         # 您可能需要定义一个更复杂的函数来找到正确的邻居
-        nns = self.fixed_radius_search(inp_positions, out_positions, extents)
+        nns = self.fixed_radius_search(inp_positions, out_positions, extents) if neighbors is None else neighbors
         neighbors_index, neighbors_row_splits, _ = nns
         neighbors_index = tf.cast(neighbors_index, tf.int32)
         neighbors_row_splits = tf.cast(neighbors_row_splits, tf.int32)
-        # 获取每个query点的邻居数
-        neighbors_counts = neighbors_row_splits[1:] - neighbors_row_splits[:-1]
-        # 对query进行扩展以匹配neighbors_index的形状
-        expanded_query = tf.repeat(out_positions, neighbors_counts, axis=0)
-        # 确保diff的维度和xyz对应
-        diff = tf.gather(inp_positions, neighbors_index) - expanded_query
-
-        # 这里我们只是简单地计算极坐标和权重
-        # 您可能需要定义一个更复杂的函数来计算正确的极坐标和权重
-        polar_coords = self.cartesian_to_polar(diff, extents)  # [N, 4]
-        # weights = self.calculate_weights(polar_coords, self.kernel)  # [N, in, out]
-        # 使用tf.gather收集输入特征
-        # inp_features_gather = tf.gather(inp_features, neighbors_index)  # [N, in_dims]
-        # 使用einsum一步完成乘法和求和操作
-        weighted_features = tf.einsum('nx,xio,ni->no', polar_coords, self.kernel,
-                                      tf.gather(inp_features, neighbors_index))  # [N, out]
-        # 如果需要，再进行额外的reduce操作
-        out_features = reduce_subarrays_sum_multi(weighted_features, neighbors_row_splits)
+
+        def aggregate(start, end, inp_features, inp_positions, out_positions):
+            index, row_splits = slice_receivers(neighbors_index, neighbors_row_splits, start, end)
+            # 获取每个query点的邻居数
+            neighbors_counts = row_splits[1:] - row_splits[:-1]
+            # 对query进行扩展以匹配neighbors_index的形状
+            expanded_query = tf.repeat(out_positions[start:end], neighbors_counts, axis=0)
+            # 确保diff的维度和xyz对应
+            diff = tf.gather(inp_positions, index) - expanded_query
+
+            # 这里我们只是简单地计算极坐标和权重
+            # 您可能需要定义一个更复杂的函数来计算正确的极坐标和权重
+            polar_coords = self.cartesian_to_polar(diff, extents)  # [N, 4]
+            return aggregate_basis(tf.gather(inp_features, index), polar_coords, row_splits)
+
+        # aggregate per receiver first, then apply the kernel as one matmul
+        max_edges = budget_edges(self.memory_budget, 4 * (2 * inp_features.shape[-1] + 14))
+        aggregated = map_receiver_chunks(aggregate, neighbors_row_splits, max_edges,
+                                         args=(inp_features, inp_positions, out_positions))
+        out_features = apply_basis_kernel(aggregated, self.kernel)  # [N_out, out]
 
         if self.activation:
             out_features = self.activation(out_features)
@@ -173,11 +179,27 @@ class PolarNet(PBFReal):
             name=name,
             activation=activation,
             radius_search_ignore_query_points=ignore_query_points,
+            memory_budget=self.conv_memory_budget,
             **kwargs)
 
         self._all_convs.append((name, conv))
         return conv
 
+    def build_boundary(self, box, bfeats):
+        boundary = super(PolarNet, self).build_boundary(box, bfeats)
+        box_feats = [tf.ones_like(box[:, :1])]
+        if self.use_mass:
+            box_feats.append(1.2 * boundary['masses'][:, tf.newaxis])
+        if self.use_box_feats:
+            box_feats.append(bfeats)
+        boundary['feats'] = tf.concat(box_feats, axis=-1)
+        return boundary
+
+    def receptive_field(self):
+        # density features, input convolutions and the hidden convolutions
+        hops = 1 + len(self.convs) + (1 if self.dens_feats or self.pres_feats else 0)
+        return hops * self.query_radii
+
     def preprocess(self,
                    data,
                    training=True,
@@ -186,29 +208,34 @@ class PolarNet(PBFReal):
                    **kwargs):
         pos, vel, solid_masses = super(PolarNet, self).preprocess(data, training, vel_corr, tape, **kwargs)
         _pos, _vel, acc, feats, box, bfeats = data
+        boundary = kwargs.get('boundary')
         self.solid_masses = 1.2 * solid_masses
         #
         # preprocess features
         #
         # compute the extent of the filters (the diameter)
         fluid_feats = [tf.ones_like(pos[:, :1])]
-        box_feats = [tf.ones_like(box[:, :1])]
+        box_feats = [tf.ones_like(box[:, :1])] if boundary is None else [boundary['feats']]
         if self.use_mass:
             fluid_feats.append(fluid_feats[0] * self.fluid_mass)
-            box_feats.append(self.solid_masses[:, tf.newaxis])
+            if boundary is None:
+                box_feats.append(self.solid_masses[:, tf.newaxis])
         if self.use_vel:
             fluid_feats.append(vel)
         if self.use_acc:
             fluid_feats.append(acc)
         if self.use_feats:
             fluid_feats.append(feats)
-        if self.use_box_feats:
+        if self.use_box_feats and boundary is None:
             box_feats.append(bfeats)
 
         all_pos = tf.concat([pos, box], axis=0)
         self.all_pos = all_pos
+        f_nns, s_nns = self.neighbors(pos, box, self.query_radii,
+                                      hash_table=boundary['hash_table'] if boundary is not None else None)
         if self.dens_feats or self.pres_feats:
-            dens = compute_density(all_pos, all_pos, self.query_radii)
+            dens = compute_density(all_pos, all_pos, self.query_radii,
+                                   nns=combine_nns(f_nns, s_nns, num_fluid=tf.shape(pos)[0]))
             if self.dens_feats:
                 fluid_feats.append(tf.expand_dims(dens[:tf.shape(pos)[0]], -1))
                 box_feats.append(tf.expand_dims(dens[tf.shape(pos)[0]:], -1))
@@ -231,10 +258,13 @@ class PolarNet(PBFReal):
             tape.watch(self.inp_feats)
             tape.watch(self.inp_bfeats)
 
-        ans_conv, f_nns = self.fluid_convs(fluid_feats, pos, all_pos, self.query_radii)
+        if self.ignore_query_points:
+            f_nns, s_nns = drop_self(f_nns), drop_self(s_nns)
+
+        ans_conv, f_nns = self.fluid_convs(fluid_feats, pos, all_pos, self.query_radii, neighbors=f_nns)
         ans_dense = self.fluid_dense(fluid_feats)
 
-        ans_obs, s_nns = self.obs_convs(box_feats, box, all_pos, self.query_radii)
+        ans_obs, s_nns = self.obs_convs(box_feats, box, all_pos, self.query_radii, neighbors=s_nns)
         ans_dense_obs = self.obs_dense(box_feats)
 
         ans_dense = tf.concat([ans_dense, ans_dense_obs], axis=0)
@@ -249,10 +279,13 @@ class PolarNet(PBFReal):
         _pos, _vel, acc, _feats, box, bfeats = data
         feats = feats[:tf.shape(pos)[0]]
 
+        # fluid-fluid neighbors of the preprocessing, shared by all layers
+        nns = slice_neighbors(self.fluid_nns, tf.shape(pos)[0])
+
         ans_convs = [feats]
         for conv, dense in zip(self.convs, self.denses):
             feats = tf.keras.activations.relu(ans_convs[-1])
-            ans_conv, nns = conv(feats, pos, pos, self.query_radii)
+            ans_conv, nns = conv(feats, pos, pos, self.query_radii, neighbors=nns)
             ans_dense = dense(feats)
             if ans_dense.shape[-1] == ans_convs[-1].shape[-1]:
                 ans = ans_conv + ans_dense + ans_convs[-1]
@@ -286,7 +319,12 @@ class PolarNet(PBFReal):
         _pos, _vel, acc, feats, box, bfeats = data
 
         group_position = tf.concat([pos, box], axis=0)
-        group_neighbors = self.radius_search(group_position, pos, self.query_radii)
+        group_neighbors = self.neighbors.lookup(pos, box, self.query_radii, num_queries=tf.shape(pos)[0])
+        if group_neighbors is not None:
+            fluid_nns, solid_nns = group_neighbors
+            group_neighbors = combine_nns(drop_self(fluid_nns), solid_nns, num_fluid=tf.shape(pos)[0])
+        else:
+            group_neighbors = self.radius_search(group_position, pos, self.query_radii)
         group_masses = tf.concat([self.fluid_mass * tf.ones_like(pos[:, 0]), self.solid_masses], axis=0)
         self.densities = compute_density(pos, group_position, self.query_radii, mass=group_masses, nns=group_neighbors)
 
@@ -322,7 +360,8 @@ class PolarNet(PBFReal):
                         num_solid_neighbors=num_solid_neighbors,
                         input=data[0],
                         target_prev=data[2],
-                        pos_correction=self.pos_correction)
+                        pos_correction=self.pos_correction,
+                        particle_weights=data[4] if len(data) > 4 else None)
         return loss
 
     def loss_keys(self):
@@ -1,7 +1,8 @@
 import tensorflow as tf
 import open3d.ml.tf as ml3d
 from utils.tools.losses import get_window_func, compute_density, compute_pressure
-from utils.tools.neighbor import reduce_subarrays_sum_multi, combine_nns
+from utils.tools.neighbor import reduce_subarrays_sum_multi, combine_nns, drop_self, aggregate_basis, \
+    apply_basis_kernel, budget_edges, map_receiver_chunks, slice_receivers
 
 from .pbf_real import PBFReal
 
@@ -14,6 +15,7 @@ class SPHeroConv(tf.keras.layers.Layer):
             use_bias=True,
             radius_search_ignore_query_points=True,
             sym=False,
+            memory_budget=None,
             **kwargs):
         super(SPHeroConv, self).__init__(**kwargs)
         self.filters = filters
@@ -23,6 +25,8 @@ class SPHeroConv(tf.keras.layers.Layer):
         self.fixed_radius_search = ml3d.layers.FixedRadiusSearch(ignore_query_point=radius_search_ignore_query_points,
                                                                  dtype=tf.int32)
         self.sym = sym
+        # MB of edge intermediates per chunk of receivers, None to process all edges at once
+        self.memory_budget = memory_budget
 
     def build(self, input_shape):
         self.in_channels = input_shape[-1]
@@ -57,18 +61,23 @@ class SPHeroConv(tf.keras.layers.Layer):
         neighbors_row_splits = neighbors_row_splits[:output_num + 1]
         neighbors_index = neighbors_index[:neighbors_row_splits[-1]]
 
-        # 计算极坐标和权重
-        spherical_coords = self.cartesian_to_spherical(
-            tf.gather(input_positions, neighbors_index) -
-            tf.repeat(output_positions, neighbors_row_splits[1:] - neighbors_row_splits[:-1], axis=0),
-            extents)  # [_, 4]
-        if self.sym:
-            spherical_coords = spherical_coords[:, :2]
+        num_basis = 2 if self.sym else 4
 
-        out_features = reduce_subarrays_sum_multi(tf.reduce_sum(
-            tf.gather(input_features, neighbors_index)[..., None] * tf.tensordot(spherical_coords,
-                                                                                 self.kernel, axes=1),
-            axis=1), neighbors_row_splits)  # [N_out, C_out]
+        def aggregate(start, end, input_features, input_positions, output_positions):
+            index, row_splits = slice_receivers(neighbors_index, neighbors_row_splits, start, end)
+            # 计算极坐标和权重
+            spherical_coords = self.cartesian_to_spherical(
+                tf.gather(input_positions, index) -
+                tf.repeat(output_positions[start:end], row_splits[1:] - row_splits[:-1], axis=0),
+                extents)  # [_, 4]
+            return aggregate_basis(tf.gather(input_features, index), spherical_coords[:, :num_basis], row_splits)
+
+        # aggregate per receiver first, memory scales with edges x C_in
+        # gathered and weighted features, basis, positions and offsets per edge
+        max_edges = budget_edges(self.memory_budget, 4 * (2 * input_features.shape[-1] + num_basis + 10))
+        aggregated = map_receiver_chunks(aggregate, neighbors_row_splits, max_edges,
+                                         args=(input_features, input_positions, output_positions))
+        out_features = apply_basis_kernel(aggregated, self.kernel)  # [N_out, C_out]
 
         if self.use_bias:
             out_features += self.bias
@@ -212,11 +221,29 @@ class SPHeroNet(PBFReal):
             activation=activation,
             radius_search_ignore_query_points=ignore_query_points,
             sym=sym,
+            memory_budget=self.conv_memory_budget,
             **kwargs)
 
         self._all_convs.append((name, conv))
         return conv
 
+    def build_boundary(self, box, bfeats):
+        boundary = super(SPHeroNet, self).build_boundary(box, bfeats)
+        box_feats = [tf.ones_like(box[:, :1])]
+        if self.use_mass:
+            box_feats.append(tf.expand_dims(boundary['masses'], axis=-1))
+        if self.use_box_feats:
+            box_feats.append(bfeats)
+        boundary['feats'] = tf.concat(box_feats, axis=-1)
+        return boundary
+
+    def receptive_field(self):
+        # density features, input convolutions and the hidden convolutions
+        hops = 1 + sum(layer.get('conv') is not None for layer in self.all_layers[1:])
+        if self.dens_feats or self.pres_feats:
+            hops += 1
+        return hops * self.query_radii
+
     def preprocess(self,
                    data,
                    training=True,
@@ -225,6 +252,7 @@ class SPHeroNet(PBFReal):
                    **kwargs):
         pos, vel, solid_masses = super(SPHeroNet, self).preprocess(data, training, vel_corr, tape, **kwargs)
         _pos, _vel, acc, feats, box, bfeats = data
+        boundary = kwargs.get('boundary')
         self.fluid_masses = self.fluid_mass * tf.ones_like(pos[:, :1])
         self.solid_masses = tf.expand_dims(solid_masses, axis=-1)
         #
@@ -232,23 +260,27 @@ class SPHeroNet(PBFReal):
         #
         # compute the extent of the filters (the diameter)
         fluid_feats = [tf.ones_like(pos[:, :1])]
-        box_feats = [tf.ones_like(box[:, :1])]
+        box_feats = [tf.ones_like(box[:, :1])] if boundary is None else [boundary['feats']]
         if self.use_mass:
             fluid_feats.append(self.fluid_masses)
-            box_feats.append(self.solid_masses)
+            if boundary is None:
+                box_feats.append(self.solid_masses)
         if self.use_vel:
             fluid_feats.append(vel)
         if self.use_acc:
             fluid_feats.append(acc)
         if self.use_feats:
             fluid_feats.append(feats)
-        if self.use_box_feats:
+        if self.use_box_feats and boundary is None:
             box_feats.append(bfeats)
 
         all_pos = tf.concat([pos, box], axis=0)
+        f_nns, s_nns = self.neighbors(pos, box, self.query_radii,
+                                      hash_table=boundary['hash_table'] if boundary is not None else None)
         if self.dens_feats or self.pres_feats:
             dens = compute_density(all_pos, all_pos, self.query_radii,
-                                   mass=tf.concat([self.fluid_masses, self.solid_masses], axis=0))
+                                   mass=tf.concat([self.fluid_masses, self.solid_masses], axis=0),
+                                   nns=combine_nns(f_nns, s_nns, num_fluid=tf.shape(pos)[0]))
             if self.dens_feats:
                 fluid_feats.append(tf.expand_dims(dens[:tf.shape(pos)[0]], -1))
                 box_feats.append(tf.expand_dims(dens[tf.shape(pos)[0]:], -1))
@@ -270,10 +302,13 @@ class SPHeroNet(PBFReal):
             tape.watch(self.inp_feats)
             tape.watch(self.inp_bfeats)
 
-        ans_conv, f_nns = self.fluid_convs(fluid_feats, pos, all_pos, self.query_radii)
+        if self.ignore_query_points:
+            f_nns, s_nns = drop_self(f_nns), drop_self(s_nns)
+
+        ans_conv, f_nns = self.fluid_convs(fluid_feats, pos, all_pos, self.query_radii, neighbors=f_nns)
         ans_dense = self.fluid_dense(fluid_feats)
 
-        ans_obs, s_nns = self.obs_convs(box_feats, box, all_pos, self.query_radii)
+        ans_obs, s_nns = self.obs_convs(box_feats, box, all_pos, self.query_radii, neighbors=s_nns)
         ans_dense_obs = self.obs_dense(box_feats)
 
         ans_dense = tf.concat([ans_dense, ans_dense_obs], axis=0)
@@ -296,9 +331,6 @@ class SPHeroNet(PBFReal):
             dense = self.all_layers[i].get('dense')
             if i == 1:
                 nns = combine_nns(self.fluid_nns, self.solid_nns)
-                if training == True and tf.shape(nns[-1])[0] > 670000:
-                    raise tf.errors.ResourceExhaustedError(None, None,
-                                                           f"Neighbor count {tf.shape(nns[-1])[0].numpy()} too large")
                 ans_conv, _ = conv(feats, all_pos, pos, self.query_radii, neighbors=nns)
                 ans_dense = dense(feats[:tf.shape(pos)[0]])
                 ans = ans_conv + ans_dense
@@ -348,7 +380,10 @@ class SPHeroNet(PBFReal):
 
         all_pos = tf.concat([pos, box], axis=0)
         mass = tf.concat([self.fluid_masses, self.solid_masses], axis=0)
-        density = compute_density(out_pos=pos, in_pos=all_pos, radius=self.query_radii, mass=mass,
+        nns = self.neighbors.lookup(pos, box, self.query_radii, num_queries=fluid_num)
+        if nns is not None:
+            nns = combine_nns(*nns, num_fluid=fluid_num)
+        density = compute_density(out_pos=pos, in_pos=all_pos, radius=self.query_radii, mass=mass, nns=nns,
                                   ignore_neighbors_grad=True)
 
         for n, l in self.loss_fn.items():
@@ -360,5 +395,6 @@ class SPHeroNet(PBFReal):
                 num_solid_neighbors=num_solid_neighbors,
                 pred_dens=density,
                 density0=self.m_density0,
+                particle_weights=data[4] if len(data) > 4 else None,
             )
         return loss
@@ -64,6 +64,8 @@ class SymNet(HRNet):
         for conv in self.sym_convs:
             ans = tf.keras.activations.relu(ans)
             ans = conv(ans * self.part_scale, self.all_pos, self.all_pos, ext,
-                       None)
+                       None,
+                       fixed_radius_search_hash_table=self.get_hash_table(
+                           'all_pos', self.all_pos, ext))
 
         return self.act(ans)
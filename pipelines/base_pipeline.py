@@ -46,6 +46,7 @@ class BasePipeline(ABC):
 
         self.model = model
         self.dataset = dataset
+        self.config = config
 
         make_dir(self.cfg.main_log_dir)
         dataset_name = dataset.name if dataset is not None else ''
@@ -0,0 +1,174 @@
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class OOMController:
+    """Chooses the memory mitigations of a step from the size of its input.
+
+    A step which runs out of memory is retried with the next mitigation
+    level (e.g. edge chunking, split batch, recomputation, shorter window).
+    The level which succeeded is remembered per size bucket (powers of two
+    of the particle count), and steps of the same or larger size start at
+    that level, so expensive failures are not repeated. After
+    `relax_every` successes of a bucket the next step probes one level
+    lower again.
+
+    Args:
+        relax_every: Number of successes after which a lower level is probed.
+    """
+
+    def __init__(self, relax_every=200):
+        self.relax_every = relax_every
+        self.levels = {}
+        self.successes = {}
+        self.failures = []
+
+    @staticmethod
+    def bucket(size):
+        return int(np.log2(max(size, 1)))
+
+    def start_level(self, kind, size):
+        """Lowest level which is expected to fit a step of the given size."""
+        b = self.bucket(size)
+        levels = self.levels.setdefault(kind, {})
+        level = max([l for k, l in levels.items() if k <= b], default=0)
+        if level > 0 and self.successes.get((kind, b), 0) >= self.relax_every:
+            self.successes[(kind, b)] = 0
+            level -= 1
+            log.info("%s: probing mitigation level %d for %d particles" % (kind, level, size))
+        return level
+
+    def failure(self, kind, size, level, neighbors=None):
+        self.failures.append((kind, size, neighbors, level))
+        log.info("%s: out of memory at level %d with %d particles%s" %
+                 (kind, level, size, "" if neighbors is None else ", %d neighbors" % neighbors))
+
+    def success(self, kind, size, level):
+        b = self.bucket(size)
+        levels = self.levels.setdefault(kind, {})
+        if levels.get(b, 0) != level and (level > 0 or b in levels):
+            log.info("%s: mitigation level %d for up to %d particles" % (kind, level, 2 ** (b + 1)))
+            levels[b] = level
+        self.successes[(kind, b)] = self.successes.get((kind, b), 0) + 1
+
+    def stats(self):
+        return {
+            'failures': len(self.failures),
+            'levels': {k: dict(sorted(v.items())) for k, v in self.levels.items() if v}
+        }
+
+
+class ReplayBuffer:
+    """Byte bounded buffer of hard training batches, prioritized by loss.
+
+    Entries are grouped into buckets of powers of two of their loss. A
+    bucket is drawn with probability proportional to its size times its
+    loss and an entry uniformly within it, and entries are removed by
+    swapping with the last one of their bucket, so insert, remove and
+    sample do not depend on the number of entries. If the budget is
+    exceeded, entries of the lowest bucket are evicted first.
+
+    Batches with references of their samples ('ref', see
+    `PhysicsSimDataFlow.load`) only store the references and are loaded
+    again by `load` when sampled, other batches are stored as they are.
+
+    Args:
+        budget_mb: Memory budget in MB.
+        load: Returns the batch of a list of sample references.
+        ref_bytes: Memory estimate of one sample reference.
+    """
+
+    def __init__(self, budget_mb=64, load=None, ref_bytes=256):
+        self.budget = budget_mb * 2 ** 20
+        self.load = load
+        self.ref_bytes = ref_bytes
+        self.nbytes = 0
+        self.entries = {}
+        self.buckets = {}
+        self.added = 0
+        self.evicted = 0
+        self.sampled = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(data):
+        refs = data.get('ref')
+        return tuple(refs) if refs is not None else id(data)
+
+    @staticmethod
+    def bucket(loss):
+        return int(np.floor(np.log2(max(float(loss), 1e-30))))
+
+    def entry_bytes(self, data):
+        if data.get('ref') is not None:
+            return self.ref_bytes * len(data['ref'])
+        return sum(getattr(x, 'nbytes', 0) for v in data.values() for x in v)
+
+    def add(self, data, loss):
+        """Adds or updates a batch, returns False if it did not fit the budget."""
+        key = self.key(data)
+        if key in self.entries:
+            self._remove(key)
+        refs = data.get('ref')
+        payload = {'ref': list(refs)} if refs is not None and self.load is not None else data
+        size = self.entry_bytes(payload)
+        b = self.bucket(loss)
+        while self.entries and self.nbytes + size > self.budget:
+            lowest = min(self.buckets)
+            if lowest > b:
+                return False
+            self._remove(self.buckets[lowest][-1])
+            self.evicted += 1
+        if size > self.budget:
+            return False
+
+        keys = self.buckets.setdefault(b, [])
+        self.entries[key] = [b, len(keys), payload, size]
+        keys.append(key)
+        self.nbytes += size
+        self.added += 1
+        return True
+
+    def remove(self, data):
+        key = self.key(data)
+        if key in self.entries:
+            self._remove(key)
+
+    def _remove(self, key):
+        b, pos, _, size = self.entries.pop(key)
+        keys = self.buckets[b]
+        last = keys.pop()
+        if last != key:
+            keys[pos] = last
+            self.entries[last][1] = pos
+        if not keys:
+            del self.buckets[b]
+        self.nbytes -= size
+
+    def sample(self, rng=np.random):
+        """Draws a batch, None if the buffer is empty."""
+        if not self.entries:
+            return None
+        buckets = list(self.buckets)
+        top = max(buckets)
+        p = np.array([len(self.buckets[b]) * 2.0 ** (b - top) for b in buckets])
+        keys = self.buckets[buckets[rng.choice(len(buckets), p=p / p.sum())]]
+        payload = self.entries[keys[rng.randint(len(keys))]][2]
+        self.sampled += 1
+        if 'pos' not in payload:
+            return self.load(payload['ref'])
+        return payload
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'MB': round(self.nbytes / 2 ** 20, 3),
+            'added': self.added,
+            'evicted': self.evicted,
+            'sampled': self.sampled
+        }
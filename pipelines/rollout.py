@@ -0,0 +1,372 @@
+import logging
+import os
+import queue
+import threading
+from collections import OrderedDict
+from glob import glob
+
+import numpy as np
+import tensorflow as tf
+
+from datasets.dataset_reader_physics import ResultStream
+from utils.hdf5_to_npz import init_npz, save_npz
+
+log = logging.getLogger(__name__)
+
+
+class SceneBatch:
+    """Packs several scenes into one particle set for a single model call.
+
+    Fluid and boundary particles of all scenes are concatenated (fluid
+    first, then boundary, each in scene order) and every scene is moved to
+    its own cell of a grid, so one neighbor search over the packed set never
+    connects particles of different scenes. The cell spacing is twice the
+    largest scene extent, which leaves a gap of one full extent between
+    scenes. Only models whose computations are local to particle
+    neighborhoods can be batched this way (see `BaseModel.supports_batching`).
+
+    Args:
+        inputs: List of per-scene model inputs [pos, vel, acc, feats, box, bfeats].
+        axes: Boolean mask of the axes which can be used for offsets.
+    """
+
+    def __init__(self, inputs, axes=(True, True, True)):
+        self.num_scenes = len(inputs)
+        self.fluid_cnt = [int(x[0].shape[0]) for x in inputs]
+        self.box_cnt = [int(x[4].shape[0]) for x in inputs]
+
+        lo, hi = [], []
+        for x in inputs:
+            p = np.concatenate(
+                [x[0].numpy().reshape(-1, 3), x[4].numpy().reshape(-1, 3)])
+            lo.append(p.min(0))
+            hi.append(p.max(0))
+        lo, hi = np.stack(lo), np.stack(hi)
+        extent = np.max(hi - lo, 0)
+        spacing = extent + np.max(extent)
+
+        # lay scenes out on a grid which is as compact as possible, to keep
+        # the packed coordinates (and the float32 round-off) small
+        axes = np.flatnonzero(axes)
+        k = int(np.ceil(self.num_scenes**(1.0 / len(axes)) - 1e-6))
+        cell = np.zeros((self.num_scenes, 3))
+        for i, a in enumerate(axes):
+            cell[:, a] = np.arange(self.num_scenes) // k**i % k
+        shift = (cell * spacing - lo).astype(np.float32)
+
+        self.fluid_shift = tf.constant(np.repeat(shift, self.fluid_cnt, 0))
+        self.box_shift = tf.constant(np.repeat(shift, self.box_cnt, 0))
+        self.static = [x[3:] for x in inputs]
+
+    def pack(self, inputs):
+        """Concatenates per-scene inputs into a single model input."""
+
+        def cat(i):
+            if inputs[0][i] is None:
+                return None
+            return tf.concat([x[i] for x in inputs], axis=0)
+
+        return [
+            cat(0) + self.fluid_shift,
+            cat(1),
+            cat(2),
+            cat(3),
+            cat(4) + self.box_shift,
+            cat(5)
+        ]
+
+    def unpack(self, data):
+        """Splits a packed state back into per-scene states."""
+        pos, vel, acc = data[:3]
+        pos = tf.split(pos - self.fluid_shift, self.fluid_cnt)
+        vel = tf.split(vel, self.fluid_cnt)
+        acc = tf.split(acc, self.fluid_cnt) if acc is not None else [
+            None
+        ] * self.num_scenes
+        return [[pos[i], vel[i], acc[i]] + list(self.static[i])
+                for i in range(self.num_scenes)]
+
+
+def group_by_grav(inputs):
+    """Groups scene indices by their (per-sequence constant) gravity."""
+    groups = {}
+    for i, x in enumerate(inputs):
+        key = None if x[2] is None or x[2].shape[0] == 0 else tuple(
+            np.round(x[2][0].numpy(), 6))
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+class CompiledInference:
+    """Bounded cache of graph compiled inference steps.
+
+    One `tf.function` is traced per model and input layout (which inputs
+    are given, their dtypes and trailing dimensions, and the layout of the
+    boundary context). The particle count is left unspecified in the input
+    signature, so changing N (e.g. inflow) does not retrace.
+
+    Args:
+        max_size: Maximum number of traced functions to keep.
+    """
+
+    def __init__(self, max_size=4):
+        self.max_size = max_size
+        self.fns = OrderedDict()
+        self.traces = 0
+
+    @staticmethod
+    def signature(data):
+        return tuple(
+            None if x is None else tf.TensorSpec([None] + list(x.shape[1:]),
+                                                 x.dtype) for x in data)
+
+    def get(self, model, data, boundary=None):
+        sig = self.signature(data)
+        boundary_sig = None if boundary is None else tf.nest.map_structure(
+            lambda x: tf.TensorSpec([None] + list(x.shape[1:]), x.dtype),
+            boundary)
+        key = (id(model), sig, str(boundary_sig))
+        if key in self.fns:
+            self.fns.move_to_end(key)
+            return self.fns[key]
+
+        given = [i for i, s in enumerate(sig) if s is not None]
+
+        def step(*args):
+            self.traces += 1
+            log.info("tracing inference step (%d traces)" % self.traces)
+            boundary = args[-1] if boundary_sig is not None else None
+            inputs = [None] * len(sig)
+            for i, x in zip(given, args):
+                inputs[i] = x
+            return model(inputs, training=False, boundary=boundary)
+
+        input_signature = [sig[i] for i in given]
+        if boundary_sig is not None:
+            input_signature.append(boundary_sig)
+        fn = tf.function(step, input_signature=input_signature)
+        self.fns[key] = (fn, given)
+        while len(self.fns) > self.max_size:
+            self.fns.popitem(last=False)
+        return self.fns[key]
+
+    def __call__(self, model, data, boundary=None):
+        fn, given = self.get(model, data, boundary)
+        args = [data[i] for i in given]
+        if boundary is not None:
+            args.append(boundary)
+        return fn(*args)
+
+
+class BoundaryCache:
+    """Count-bounded LRU cache of per-scene boundary contexts."""
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, boundary):
+        self.entries[key] = boundary
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries)
+        }
+
+
+class RolloutWriter:
+    """Writes test rollouts from a background thread while they are produced.
+
+    Ground truth and boundary of a scene are written when its first frame
+    arrives, predicted frames are appended to the hdf5 output and saved as
+    npz one by one. At most `max_pending` frames are queued, so memory stays
+    bounded and writing overlaps with the rollout.
+
+    Args:
+        out_dirs: Output directory of every scene.
+        file_name: Name of the hdf5 files, other hdf5 files in the output
+            directories are removed on close.
+        name: Group name in the hdf5 files.
+        data: Rollout data of the scenes.
+        max_pending: Maximum number of queued frames.
+    """
+
+    def __init__(self, out_dirs, file_name, name, data, max_pending=16):
+        self.out_dirs = out_dirs
+        self.file_name = file_name
+        self.name = name
+        self.data = data
+        self.streams = {}
+        self.folders = {}
+        self.error = None
+        self.queue = queue.Queue(max_pending)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, i, t, state):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((i, t, np.asarray(state[0])))
+
+    def _open(self, i):
+        out_dir = self.out_dirs[i]
+        os.makedirs(out_dir, exist_ok=True)
+        gt, bnd = self.data[i]['pos'], self.data[i]['box'][0]
+
+        stream = ResultStream(os.path.join(out_dir, self.file_name), self.name)
+        stream.write('gt', gt, 'PARTICLE')
+        stream.write('bnd', bnd, 'PARTICLE')
+        self.streams[i] = stream
+
+        gt_folder, self.folders[i] = init_npz(out_dir, bnd)
+        for t in range(gt.shape[0]):
+            save_npz(gt_folder, 'fluid_{0:04d}'.format(t), pos=gt[t])
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            i, t, pos = item
+            try:
+                if i not in self.streams:
+                    self._open(i)
+                self.streams[i].append('pred', pos, 'PARTICLE')
+                save_npz(self.folders[i], 'fluid_{0:04d}'.format(t), pos=pos)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for i, stream in self.streams.items():
+            stream.close()
+            current = os.path.join(self.out_dirs[i], self.file_name)
+            for f in glob(os.path.join(self.out_dirs[i], '*.hdf5')):
+                if f != current:
+                    log.info("Remove %s" % f)
+                    os.remove(f)
+        if self.error is not None:
+            raise self.error
+
+
+class DomainDecomposition:
+    """Splits a scene into a grid of spatial tiles with halo regions.
+
+    Every fluid particle is owned by the tile which contains it, the tiles
+    at the border of the domain extend to infinity. A tile is simulated
+    with all particles within the halo around it and only the states of
+    its own particles are kept, so the halo must cover the receptive field
+    of one model step. Ownership is reassigned from the positions of every
+    step. The boundary of a tile is selected once with twice the halo,
+    which also covers boundary quantities that depend on neighboring
+    boundary particles.
+
+    Args:
+        points: Particles which define the extent of the domain.
+        box: Boundary particles.
+        tiles: Number of tiles along each axis.
+        halo: Receptive field of one step.
+    """
+
+    def __init__(self, points, box, tiles, halo):
+        self.tiles = np.asarray(tiles, dtype=np.int64)
+        self.lo = points.min(0)
+        self.size = np.maximum(points.max(0) - self.lo, 1e-6) / self.tiles
+        self.halo = halo
+        self.box_idx = [
+            self.select(box, k, 2 * halo) for k in range(self.num_tiles)
+        ]
+
+    @property
+    def num_tiles(self):
+        return int(np.prod(self.tiles))
+
+    def owner(self, pos):
+        cell = np.floor((pos - self.lo) / self.size).astype(np.int64)
+        cell = np.clip(cell, 0, self.tiles - 1)
+        return np.ravel_multi_index(cell.T, self.tiles)
+
+    def bounds(self, k):
+        cell = np.array(np.unravel_index(k, self.tiles))
+        lo = np.where(cell == 0, -np.inf, self.lo + cell * self.size)
+        hi = np.where(cell == self.tiles - 1, np.inf,
+                      self.lo + (cell + 1) * self.size)
+        return lo, hi
+
+    def select(self, points, k, halo):
+        lo, hi = self.bounds(k)
+        return np.flatnonzero(
+            np.all((points >= lo - halo) & (points <= hi + halo), axis=1))
+
+    def split(self, pos, margin=0.0):
+        """Returns (tile, particle indices, owned mask) of all tiles with particles.
+
+        `margin` widens the halo by the distance particles move before the
+        neighbor search of the step (advection).
+        """
+        owner = self.owner(pos)
+        tiles = []
+        for k in np.unique(owner):
+            idx = self.select(pos, k, self.halo + margin)
+            tiles.append((k, idx, owner[idx] == k))
+        return tiles
+
+
+_tile_worker = {}
+
+
+def init_tile_worker(model_spec, weights, boxes, threads=None):
+    """Builds the model of a tiled rollout worker process."""
+    import importlib
+
+    tf.config.set_visible_devices([], 'GPU')
+    if threads:
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    module, name, kwargs = model_spec
+    model = getattr(importlib.import_module(module), name)(**kwargs)
+    _tile_worker.update(model=model,
+                        weights=weights,
+                        boxes=boxes,
+                        boundaries={})
+
+
+def run_tile(task):
+    """Runs one model step on a tile in a worker process."""
+    key, pos, vel, grav = task
+    model = _tile_worker['model']
+    box, box_normals = _tile_worker['boxes'][key]
+    inputs = [
+        tf.convert_to_tensor(pos),
+        tf.convert_to_tensor(vel),
+        None if grav is None else tf.convert_to_tensor(grav), None,
+        tf.convert_to_tensor(box),
+        tf.convert_to_tensor(box_normals)
+    ]
+    if _tile_worker['weights'] is not None:
+        # the variables are created by the first call
+        model(inputs, training=False)
+        model.set_weights(_tile_worker['weights'])
+        _tile_worker['weights'] = None
+
+    boundaries = _tile_worker['boundaries']
+    if key not in boundaries:
+        boundaries[key] = model.boundary_context(inputs) or None
+    pos, vel = model(inputs, training=False, boundary=boundaries[key])
+    return pos.numpy(), vel.numpy()
@@ -7,6 +7,10 @@ from tqdm import tqdm
 import re
 import os
 import time
+import hashlib
+import multiprocessing
+import gc
+from contextlib import contextmanager
 from glob import glob
 import time
 
@@ -19,11 +23,13 @@ from .base_pipeline import BasePipeline
 
 from o3d.utils import make_dir, PIPELINE, LogRecord, get_runid, code2md
 
-from datasets.dataset_reader_physics import get_dataloader, get_rollout, write_results
+from datasets.dataset_reader_physics import get_dataloader, get_rollout, PhysicsSimDataFlow
+from .rollout import SceneBatch, CompiledInference, BoundaryCache, RolloutWriter, DomainDecomposition, \
+    group_by_grav, init_tile_worker, run_tile
+from .memory import OOMController, ReplayBuffer
 
 from utils.tools.losses import density_loss, get_window_func, compute_density, get_window_func, emd_loss, boundary_loss
-from utils.evaluation_helper import compare_dist, chamfer_distance, distance, merge_dicts
-from utils.hdf5_to_npz import write_npz
+from utils.evaluation_helper import distance, merge_dicts, sequence_metrics, GroundTruthCache
 import warnings
 
 warnings.filterwarnings('ignore')
@@ -56,20 +62,166 @@ class Simulator(BasePipeline):
                          device=device,
                          split=split,
                          **kwargs)
+        self.compiled_inference = CompiledInference(
+            self.cfg.get('compile_cache_size', 4)) if self.cfg.get(
+                'compile_inference', False) else None
+        self.boundary_cache = BoundaryCache(self.cfg.get(
+            'boundary_cache_size', 16)) if self.cfg.get(
+                'boundary_cache_size', 16) else None
+        self.gt_cache = GroundTruthCache(self.cfg.get('metric_cache_dir', None))
+        self.oom = OOMController(self.cfg.get('oom_relax_every', 200))
+        # pipeline options overridden by the active memory mitigations
+        self.overrides = {}
+
+    def option(self, key, default=None):
+        return self.overrides.get(key, self.cfg.get(key, default))
+
+    @contextmanager
+    def mitigations(self, names):
+        """
+        Applies memory mitigations for the duration of a step.
+
+        'chunk' sets the memory budget of the convolutions (`oom_conv_budget`
+        MB), 'split' trains every sample as its own micro-batch, 'recompute'
+        enables `recompute_steps` and every 'window' halves the window.
+        """
+        overrides = dict(self.overrides)
+        budgets = []
+        for name in names:
+            if name == 'chunk':
+                budget = self.cfg.get('oom_conv_budget', 256)
+                # the budget is read when tracing, so chunked steps must not reuse a compiled step
+                self.overrides['conv_budget'] = budget
+                for conv in self.chunked_convs():
+                    budgets.append((conv, conv.memory_budget))
+                    conv.memory_budget = min(conv.memory_budget or budget, budget)
+            elif name == 'split':
+                self.overrides['grad_accum_steps'] = np.iinfo(np.int32).max
+            elif name == 'recompute':
+                self.overrides['recompute_steps'] = True
+            elif name == 'window':
+                self.overrides['window_shift'] = self.overrides.get('window_shift', 0) + 1
+        try:
+            yield
+        finally:
+            self.overrides = overrides
+            for conv, budget in reversed(budgets):
+                conv.memory_budget = budget
+
+    def can_compile_train(self, data):
+        """Compiled train steps need gravity in every sample and no active mitigations."""
+        return not self.overrides and all(g[0] is not None for g in data['grav'])
+
+    def chunked_convs(self):
+        return [conv for _, conv in getattr(self.model, '_all_convs', []) if hasattr(conv, 'memory_budget')]
+
+    def run_guarded(self, kind, size, fn, mitigations):
+        """
+        Runs `fn` and retries it with more mitigations while it runs out of memory.
+
+        The mitigation level to start with is learned per input size by the
+        `OOMController`.
+
+        Args:
+            kind: Name of the step, levels are learned per kind.
+            size: Number of particles of the input.
+            fn: Function running the step.
+            mitigations: Mitigations in the order they are enabled.
+        Returns:
+            Returns the result of `fn`, or None if it ran out of memory with
+            all mitigations.
+        """
+        level = min(self.oom.start_level(kind, size), len(mitigations))
+        while True:
+            try:
+                with self.mitigations(mitigations[:level]):
+                    result = fn()
+            except tf.errors.ResourceExhaustedError as e:
+                self.oom.failure(kind, size, level, self.neighbor_count())
+                gc.collect()
+                if level >= len(mitigations):
+                    log.warning("%s: out of memory with all mitigations %s, skipping the sample: %s" %
+                                (kind, mitigations, e.message))
+                    return None
+                level += 1
+                log.info("%s: retrying with %s" % (kind, mitigations[:level]))
+                continue
+            self.oom.success(kind, size, level)
+            return result
+
+    def neighbor_count(self):
+        nns = getattr(self.model, 'fluid_nns', None)
+        try:
+            return int(nns[1][-1])
+        except (TypeError, IndexError, ValueError):
+            return None
+
+    def train_mitigations(self, data, time_weights):
+        mitigations = []
+        if self.chunked_convs():
+            mitigations.append('chunk')
+        if len(data['pos']) > 1:
+            mitigations.append('split')
+        if not self.cfg.get('recompute_steps', False):
+            mitigations.append('recompute')
+        mitigations += ['window'] * int(np.ceil(np.log2(max(int(time_weights.shape[0]), 1))))
+        return mitigations
+
+    @staticmethod
+    def particle_grav(grav, pos):
+        """Broadcasts the gravity vector of a frame to all particles."""
+        if grav is None:
+            return None
+        return tf.broadcast_to(tf.convert_to_tensor(grav, tf.float32), tf.shape(pos))
+
+    def boundary_context(self, inputs, scene_id=None):
+        """
+        Returns the boundary context of a scene, built once and cached.
+
+        The key includes a hash of the boundary and gravity, so the entry is
+        rebuilt whenever the boundary of a scene changes (e.g. augmentation).
 
-    # @tf.function(experimental_relax_shapes=True)
-    def run_inference(self, inputs):
+        Args:
+            inputs: Model inputs of a scene.
+            scene_id: Id of the scene.
+        Returns:
+            Returns the boundary context, or None if caching is disabled.
+        """
+        if self.boundary_cache is None or not tf.executing_eagerly():
+            return None
+
+        grav = inputs[2][:1] if inputs[2] is not None else None
+        digest = hashlib.blake2b(digest_size=16)
+        for x in [grav, inputs[4], inputs[5]]:
+            if x is not None:
+                digest.update(np.ascontiguousarray(x).tobytes())
+        key = (id(self.model), str(scene_id), digest.hexdigest())
+
+        boundary = self.boundary_cache.get(key)
+        if boundary is None:
+            boundary = self.model.boundary_context(inputs)
+            self.boundary_cache.put(key, boundary)
+        return boundary if boundary else None
+
+    def run_inference(self, inputs, boundaries=None):
         """
         Run inference on a given data.
 
+        Uses the graph compiled step if `compile_inference` is enabled.
+
         Args:
             data: A raw data.
+            boundaries: Optional boundary contexts of the scenes.
         Returns:
             Returns the inference results.
         """
         results = []
         for bi in range(len(inputs)):
-            pos, vel = self.model(inputs[bi], training=False)
+            boundary = boundaries[bi] if boundaries is not None else None
+            if self.compiled_inference is not None:
+                pos, vel = self.compiled_inference(self.model, inputs[bi], boundary)
+            else:
+                pos, vel = self.model(inputs[bi], training=False, boundary=boundary)
             results.append([pos, vel] + inputs[bi][2:])
         return results
 
@@ -82,39 +234,340 @@ class Simulator(BasePipeline):
         Returns:
             Returns the inference results.
         """
+        results = [[] for _ in range(len(inputs))]
+        for states in self.iter_rollout(inputs, timesteps):
+            for i, state in enumerate(states):
+                results[i].append(state)
+        return results
+
+    def iter_rollout(self, inputs, timesteps=2):
+        """
+        Run rollout on a given data, step by step.
+
+        Only the current state of every scene is kept, so memory does not
+        grow with the rollout length.
+
+        Args:
+            data: A raw data.
+        Returns:
+            Yields the states of all scenes for every time step, starting
+            with the initial state.
+        """
 
+        scene_ids = [data['scene_id'][0] for data in inputs]
         inputs = [[
             tf.convert_to_tensor(data['pos'][0]),
             tf.convert_to_tensor(data['vel'][0]),
-            tf.convert_to_tensor(data["grav"][0])
-            if data["grav"][0] is not None else None, None,
+            self.particle_grav(data["grav"][0], data['pos'][0]), None,
             tf.convert_to_tensor(data["box"][0]),
             tf.convert_to_tensor(data["box_normals"][0])
         ] for data in inputs]
-        results = [[] for _ in range(len(inputs))]
+        yield list(inputs)
+
+        if self.cfg.get('rollout_tiles', None):
+            if self.model.receptive_field() is not None:
+                yield from self.iter_tiled_rollout(inputs, timesteps, scene_ids)
+                return
+            log.info("%s has non-local operations, rollout is not tiled" %
+                     self.model.__class__.__name__)
+
+        step = 1
+        if self.cfg.get('batch_rollout', False) and getattr(
+                self.model, 'supports_batching', False):
+            try:
+                for states in self.iter_batched_rollout(inputs, timesteps, scene_ids):
+                    inputs = states
+                    step += 1
+                    yield states
+                return
+            except tf.errors.ResourceExhaustedError:
+                log.info("batched rollout exhausted resources, "
+                         "falling back to per-scene rollout")
+
+        boundaries = [self.boundary_context(x, i) for x, i in zip(inputs, scene_ids)]
 
         # dummy init
-        self.run_inference(inputs[:1])
+        self.run_inference(inputs[:1], boundaries[:1])
 
         timing = []
-        for i in range(len(inputs)):
-            results[i].append(inputs[i])
-        log.info("rollout total:", str(timesteps))
-        for t in tqdm(range(timesteps - 1), "rollout"):
+        log.info("rollout total: %d" % timesteps)
+        for t in tqdm(range(step, timesteps), "rollout"):
             start = time.time()
             for i in range(len(inputs)):
-                inputs[i] = self.run_inference(inputs[i:i + 1])[0]
+                inputs[i] = self.run_inference(inputs[i:i + 1], boundaries[i:i + 1])[0]
             end = time.time()
             timing.append(end - start)
-            for i in range(len(inputs)):
-                results[i].append(inputs[i])
-        log.info("Average runtime: %.05f" % (np.mean(timing) / len(inputs)))
+            yield list(inputs)
+        if timing:
+            log.info("Average runtime: %.05f" % (np.mean(timing) / len(inputs)))
+        self.log_rollout_stats()
 
-        return results
+    def iter_batched_rollout(self, inputs, timesteps=2, scene_ids=None):
+        """
+        Run rollout on all scenes at once.
+
+        Scenes with the same gravity are packed into one particle set, so
+        each time step needs a single model call per group instead of one
+        per scene.
+
+        Args:
+            inputs: List of per-scene model inputs.
+            scene_ids: Ids of the scenes.
+        Returns:
+            Yields the per-scene states after every time step.
+        """
+        axes = np.ones(3, dtype=bool)
+        if "scale" in self.model.transformation:
+            axes = np.array(self.model.transformation["scale"]) != 0
+
+        groups = group_by_grav(inputs)
+        batches = [SceneBatch([inputs[i] for i in g], axes) for g in groups]
+        states = [b.pack([inputs[i] for i in g])
+                  for g, b in zip(groups, batches)]
+        if scene_ids is None:
+            scene_ids = list(range(len(inputs)))
+        boundaries = [
+            self.boundary_context(state, tuple(str(scene_ids[i]) for i in g))
+            for g, state in zip(groups, states)
+        ]
+        log.info("batched rollout: %d scenes in %d model calls per step" %
+                 (len(inputs), len(groups)))
+
+        # dummy init
+        self.run_inference(states[:1], boundaries[:1])
+
+        timing = []
+        log.info("rollout total: %d" % timesteps)
+        for t in tqdm(range(timesteps - 1), "rollout"):
+            start = time.time()
+            states = self.run_inference(states, boundaries)
+            end = time.time()
+            timing.append(end - start)
+            out = [None] * len(inputs)
+            for g, b, state in zip(groups, batches, states):
+                for i, data in zip(g, b.unpack(state)):
+                    out[i] = data
+            yield out
+        if timing:
+            log.info("Average runtime: %.05f" % (np.mean(timing) / len(inputs)))
+        self.log_rollout_stats()
+
+    def iter_tiled_rollout(self, inputs, timesteps=2, scene_ids=None):
+        """
+        Run rollout with every scene split into spatial tiles.
+
+        Each step the fluid particles are assigned to the tile which contains
+        them, and every tile is simulated with the particles in a halo of the
+        model's receptive field (see `DomainDecomposition`). The tiles run in
+        `tile_workers` processes, or one after another in this process. For
+        the first `tile_check_steps` steps the tiled result is compared
+        against a monolithic step.
+
+        Args:
+            inputs: List of per-scene model inputs.
+            scene_ids: Ids of the scenes.
+        Returns:
+            Yields the per-scene states after every time step.
+        """
+        cfg = self.cfg
+        model = self.model
+        if scene_ids is None:
+            scene_ids = list(range(len(inputs)))
+
+        # the receptive field is given in model units
+        halo = model.receptive_field()
+        if "scale" in model.transformation:
+            scale = np.abs(np.array(model.transformation["scale"], dtype=np.float64))
+            halo /= np.min(scale[scale > 0])
+
+        decomps = [
+            DomainDecomposition(
+                np.concatenate([x[0].numpy(), x[4].numpy()]), x[4].numpy(),
+                cfg.rollout_tiles, halo) for x in inputs
+        ]
+        log.info("tiled rollout: %d tiles per scene, halo %.4f" %
+                 (decomps[0].num_tiles, halo))
+
+        pool = None
+        num_workers = cfg.get('tile_workers', 0)
+        if num_workers > 1 and self.config is None:
+            log.info("tile workers need the model config, running tiles in process")
+        elif num_workers > 1:
+            boxes = {(i, k): (x[4].numpy()[d.box_idx[k]], x[5].numpy()[d.box_idx[k]])
+                     for i, (x, d) in enumerate(zip(inputs, decomps))
+                     for k in range(d.num_tiles)}
+            model_spec = (type(model).__module__, type(model).__name__,
+                          self.config.model.to_dict())
+            threads = max(multiprocessing.cpu_count() // num_workers, 1)
+            pool = multiprocessing.get_context('spawn').Pool(
+                num_workers, init_tile_worker,
+                (model_spec, model.get_weights(), boxes, threads))
+
+        check_steps = cfg.get('tile_check_steps', 0)
+        check_tol = cfg.get('tile_check_tol', 1e-4)
 
-    def run_test(self, epoch=None, test_dataset=None):
+        timing = []
+        log.info("rollout total: %d" % timesteps)
+        try:
+            for t in tqdm(range(timesteps - 1), "rollout"):
+                start = time.time()
+                states = [
+                    self.run_tiles(x, d, i, scene_ids[i], pool)
+                    for i, (x, d) in enumerate(zip(inputs, decomps))
+                ]
+                end = time.time()
+                timing.append(end - start)
+
+                if t < check_steps:
+                    ref = self.run_inference(inputs)
+                    err = max(
+                        float(np.max(np.abs(a[0].numpy() - b[0].numpy()), initial=0))
+                        for a, b in zip(states, ref))
+                    log.info("tiled step %d: max position deviation %.3e" % (t, err))
+                    if err > check_tol:
+                        log.warning("tiled rollout deviates from the monolithic one "
+                                    "(%.3e > %.3e), the halo may be too small" % (err, check_tol))
+
+                inputs = states
+                yield list(inputs)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        if timing:
+            log.info("Average runtime: %.05f" % (np.mean(timing) / len(inputs)))
+        self.log_rollout_stats()
+
+    def run_tiles(self, inputs, decomp, index, scene_id, pool=None):
+        """Runs one step of a scene tile by tile and reassembles the particles."""
+        pos, vel = inputs[0].numpy(), inputs[1].numpy()
+        grav = inputs[2].numpy() if inputs[2] is not None else None
+
+        # particles move by up to dt * |v| + dt^2 / 2 * |g| before the neighbor search
+        dt = self.model.timestep
+        margin = dt * np.max(np.linalg.norm(vel, axis=-1), initial=0)
+        if grav is not None:
+            margin += 0.5 * dt**2 * np.max(np.linalg.norm(grav, axis=-1), initial=0)
+        tiles = decomp.split(pos, 2 * margin)
+
+        if pool is not None:
+            outputs = pool.map(run_tile, [
+                ((index, k), pos[idx], vel[idx], None if grav is None else grav[idx])
+                for k, idx, _ in tiles
+            ])
+        else:
+            box, box_normals = inputs[4], inputs[5]
+            outputs = []
+            for k, idx, _ in tiles:
+                tile = [
+                    tf.gather(inputs[0], idx),
+                    tf.gather(inputs[1], idx),
+                    None if inputs[2] is None else tf.gather(inputs[2], idx), None,
+                    tf.gather(box, decomp.box_idx[k]),
+                    tf.gather(box_normals, decomp.box_idx[k])
+                ]
+                boundary = self.boundary_context(tile, (scene_id, 'tile', int(k)))
+                out = self.run_inference([tile], [boundary])[0]
+                outputs.append((out[0].numpy(), out[1].numpy()))
+
+        new_pos, new_vel = np.empty_like(pos), np.empty_like(vel)
+        for (k, idx, own), (tile_pos, tile_vel) in zip(tiles, outputs):
+            new_pos[idx[own]] = tile_pos[own]
+            new_vel[idx[own]] = tile_vel[own]
+        return [tf.convert_to_tensor(new_pos), tf.convert_to_tensor(new_vel)] + list(inputs[2:])
+
+    def log_rollout_stats(self):
+        if self.compiled_inference is not None:
+            log.info("compiled inference traces: %d" %
+                     self.compiled_inference.traces)
+        if hasattr(self.model, 'neighbors'):
+            log.info("neighbor list builds: %d" % self.model.neighbors.builds)
+        if hasattr(self.model, 'hash_table_builds'):
+            log.info("hash table builds per step: %d" % self.model.hash_table_builds)
+
+    def run_shared_rollout(self, splits, sinks=None):
+        """
+        Run the rollouts of several data splits at once.
+
+        Sequences which start from the same state (same scene and start
+        frame of the same dataset files) are rolled out only once, for the
+        longest of the requested lengths, and shared by all splits.
+
+        Args:
+            splits: List of (dataset, rollout data) pairs.
+            sinks: Optional callbacks `sink(i, t, state)` per split. The
+                states of splits with a sink are passed to it while rolling
+                out instead of being kept.
+        Returns:
+            Returns the inference results of every split, as `run_rollout`
+            (None for splits with a sink).
+        """
+        if sinks is None:
+            sinks = [None] * len(splits)
+        seqs, lengths, keep, consumers = [], [], [], []
+        unique = {}
+        for s, (dataset, data) in enumerate(splits):
+            files = tuple(getattr(dataset, 'files', None) or ()) or id(dataset)
+            timesteps = data[0]["pos"].shape[0] if len(data) else 0
+            for i, d in enumerate(data):
+                key = (files, str(d.get('scene_id', [None])[0]),
+                       int(d['frame_id'][0]))
+                j = unique.get(key)
+                if j is None or not (
+                        np.array_equal(seqs[j]['pos'][0], d['pos'][0]) and
+                        np.array_equal(seqs[j]['vel'][0], d['vel'][0])):
+                    j = len(seqs)
+                    seqs.append(d)
+                    lengths.append(0)
+                    keep.append(0)
+                    consumers.append([])
+                    unique.setdefault(key, j)
+                lengths[j] = max(lengths[j], timesteps)
+                if sinks[s] is None:
+                    keep[j] = max(keep[j], timesteps)
+                consumers[j].append((s, i, timesteps))
+
+        log.info("shared rollout: %d of %d sequences" %
+                 (len(seqs), sum(len(c) for c in consumers)))
+
+        # one rollout per required length
+        results = [[] for _ in seqs]
+        for timesteps in sorted(set(lengths)):
+            idx = [j for j in range(len(seqs)) if lengths[j] == timesteps]
+            for t, states in enumerate(
+                    self.iter_rollout([seqs[j] for j in idx], timesteps)):
+                for j, state in zip(idx, states):
+                    if t < keep[j]:
+                        results[j].append(state)
+                    for s, i, n in consumers[j]:
+                        if sinks[s] is not None and t < n:
+                            sinks[s](i, t, state)
+
+        out = [[None] * len(data) for _, data in splits]
+        for j, consumer in enumerate(consumers):
+            for s, i, n in consumer:
+                out[s][i] = results[j][:n]
+        return [o if sink is None else None for o, sink in zip(out, sinks)]
+
+    def test_writer(self, epoch, test_data):
+        """
+        Returns a writer streaming the test outputs of the given epoch.
+        """
+        out_dirs = [
+            os.path.join(self.cfg.out_dir, "visual", "%04d" % i)
+            for i in range(len(test_data))
+        ]
+        return RolloutWriter(out_dirs, '%04d.hdf5' % epoch, self.model.name,
+                             test_data,
+                             self.cfg.get('writer_queue_size', 16))
+
+    def run_test(self, epoch=None, test_dataset=None, test_data=None, results=None, writer=None):
         """
         Run test with test data split.
+
+        Rollout data and results can be passed in, e.g. from
+        `run_shared_rollout`. If a writer is given, the rollout has already
+        been streamed into it.
         """
         model = self.model
         dataset = self.dataset
@@ -127,52 +580,33 @@ class Simulator(BasePipeline):
         log.info("Logging in file : {}".format(log_file_path))
         log.addHandler(logging.FileHandler(log_file_path))
 
-        if not test_dataset:
-            test_dataset = dataset.test
-        test_data = get_rollout(test_dataset, **cfg.data_generator,
-                                **cfg.data_generator.test)
+        if test_data is None:
+            if not test_dataset:
+                test_dataset = dataset.test
+            test_data = get_rollout(test_dataset, **cfg.data_generator,
+                                    **cfg.data_generator.test)
 
         if epoch is None:
             epoch = self.load_ckpt(model.cfg.ckpt_path)
 
         log.info("Started testing")
 
-        results = self.run_rollout(test_data, test_data[0]["pos"].shape[0])
-
-        for i in tqdm(range(len(results)), desc='write out'):
-            data = test_data[i]
-            pos = np.stack(r[0] for r in results[i])
-
-            out_dir = os.path.join(self.cfg.out_dir, "visual", "%04d" % i)
-            if not os.path.exists(out_dir):
-                os.makedirs(out_dir)
-
-            output = [(pos, {
-                "name": "pred",
-                "type": "PARTICLE"
-            }), (data['pos'], {
-                "name": "gt",
-                "type": "PARTICLE"
-            }), (data['box'][0], {
-                "name": "bnd",
-                "type": "PARTICLE"
-            })]
-
-            write_results(os.path.join(out_dir, '%04d.hdf5' % epoch),
-                          self.model.name, output)
-
-            write_npz(out_dir, data={'pred': pos, 'gt': data['pos'], 'bnd': data['box'][0]})
-
-            for f in glob(os.path.join(out_dir, '*.hdf5')):
-                if f != os.path.join(out_dir, '%04d.hdf5' % epoch):
-                    log.info("Remove %s" %
-                             os.path.join(out_dir, '%04d.hdf5' % epoch))
-                    os.remove(f)
+        if writer is None:
+            # frames are written in the background while rolling out
+            writer = self.test_writer(epoch, test_data)
+            if results is None:
+                steps = self.iter_rollout(test_data, test_data[0]["pos"].shape[0])
+            else:
+                steps = zip(*results)
+            for t, states in enumerate(steps):
+                for i, state in enumerate(states):
+                    writer(i, t, state)
+        writer.close()
 
         if cfg.get('test_compute_metric', False):
             self.run_valid(epoch)
 
-    def run_valid(self, epoch=None):
+    def run_valid(self, epoch=None, valid_data=None, results=None):
         model = self.model
         dataset = self.dataset
         cfg = self.cfg
@@ -183,87 +617,101 @@ class Simulator(BasePipeline):
         log.info("Logging in file : {}".format(log_file_path))
         log.addHandler(logging.FileHandler(log_file_path))
 
-        valid_data = get_rollout(dataset.valid, **cfg.data_generator,
-                                 **cfg.data_generator.valid)  # [batch, timesteps, 6]
+        if valid_data is None:
+            valid_data = get_rollout(dataset.valid, **cfg.data_generator,
+                                     **cfg.data_generator.valid)  # [batch, timesteps, 6]
 
         if epoch is None:
             epoch = self.load_ckpt(model.cfg.ckpt_path)
 
         log.info("Started validation")
 
-        results = self.run_rollout(valid_data, valid_data[0]["pos"].shape[0])  # [batch, timesteps, 6]
-
+        if results is None:
+            results = self.run_rollout(valid_data, valid_data[0]["pos"].shape[0])  # [batch, timesteps, 6]
+
+        emd_backend = cfg.get('emd_backend', 'approx')
+        emd_kwargs = dict(cfg.get('emd_kwargs', None) or {})
+        emd_check_size = cfg.get('emd_check_size', 0)
+        full = cfg.split != "train"
+        stride = cfg.data_generator.valid.get("eval_stride", 1)
+
+        radius = model.particle_radii[0]
+        files = getattr(dataset.valid, 'files', None)
+        dataset_path = os.path.dirname(files[0]) if files else None
+
+        # metrics of all evaluated frames of a sequence in one job, the
+        # ground truth terms are taken from the cache when available
+        frames, jobs, gt_keys = [], [], []
+        for i, data in enumerate(valid_data):
+            fr = [
+                t for t in range(1, min(data["pos"].shape[0], len(results[i])))
+                if t % stride == 0
+            ]
+            frames.append(fr)
+            if len(fr) == 0:
+                continue
+            gt_key = self.gt_cache.key(dataset_path, radius, 'poly6',
+                                       data["pos"][fr],
+                                       data["box"][0]) if full else None
+            gt_keys.append(gt_key)
+            jobs.append(
+                (data["pos"][fr], data["vel"][fr],
+                 np.stack([np.asarray(results[i][t][0]) for t in fr]),
+                 np.stack([np.asarray(results[i][t][1]) for t in fr]),
+                 data["box"][0], radius, full,
+                 None if emd_backend == 'approx' else emd_backend, emd_kwargs,
+                 emd_check_size,
+                 self.gt_cache.get(gt_key) if full else None))
+
+        num_workers = min(cfg.get('valid_workers', 0), len(jobs))
+        if num_workers > 1:
+            with multiprocessing.get_context().Pool(num_workers) as pool:
+                seq_metrics = pool.starmap(sequence_metrics, jobs)
+        else:
+            seq_metrics = [
+                sequence_metrics(*job)
+                for job in tqdm(jobs, desc='validation metrics')
+            ]
+        for gt_key, (_, _, gt) in zip(gt_keys, seq_metrics):
+            if gt is not None:
+                self.gt_cache.put(gt_key, gt)
+        seq_metrics = iter(seq_metrics)
+
+        emd_errors = []
         losses = []
         for i in tqdm(range(len(valid_data)), desc='validation'):
             data = valid_data[i]
             target_pos, target_vel = data["pos"], data["vel"]
+            if len(frames[i]) == 0:
+                continue
+            frame_losses, errors, _ = next(seq_metrics)
+            emd_errors.extend(errors)
 
             loss_seq = []
-            for t in range(1, min(target_pos.shape[0], len(results[i]))):  # for every particle
-                # eval for complete sequence
-                pos, vel = results[i][t][:2]
-                loss = {}
-
-                if t % cfg.data_generator.valid.get("eval_stride", 1) == 0:
+            for t, loss in zip(frames[i], frame_losses):
+                if full and emd_backend == 'approx':
+                    pos = results[i][t][0]
                     if data["box"][0].shape[0] > 0:
                         pos = tf.clip_by_value(pos,
                                                np.min(data["box"][0], axis=0),
                                                np.max(data["box"][0], axis=0))
-                    loss['mse_val'] = np.mean(distance(target_pos[t], pos))
-                    loss['chamfer_val'] = np.mean(
-                        chamfer_distance(target_pos[t],
-                                         pos).astype(np.float32))
-
-                    if cfg.split != "train":
-                        loss['dens_val'] = np.mean(
-                            density_loss(target_pos[t],
-                                         pos,
-                                         tf.concat([pos, data["box"][0]],
-                                                   axis=0),
-                                         tf.concat(
-                                             [target_pos[t], data["box"][0]],
-                                             axis=0),
-                                         radius=model.particle_radii[0],
-                                         win=get_window_func("poly6")).numpy())
-                        loss['max_dens_val'] = density_loss(
-                            pos,
-                            target_pos[t],
-                            tf.concat([pos, data["box"][0]], axis=0),
-                            tf.concat([target_pos[t], data["box"][0]], axis=0),
-                            radius=model.particle_radii[0],
-                            win=get_window_func(model.window_dens),
-                            use_max=True).numpy()
-                        loss['chamfer_val_2'] = np.mean(
-                            chamfer_distance(pos,
-                                             target_pos[t]).astype(np.float32))
-                        loss['emd'] = np.mean(
-                            emd_loss(target_pos[t:t + 1], tf.expand_dims(
-                                pos, 0)).numpy().astype(np.float32))
-
-                        loss['vel_diff_val'] = compare_dist(target_vel[t], vel)
-                        loss['vel_diff_val_2'] = compare_dist(
-                            vel, target_vel[t])
-
-                        loss['weight_mse_val'] = boundary_loss(target_pos[t], pos, data['box'],
-                                                               radius=model.particle_radii[0])
-                        np.mean(distance(target_pos[t], pos))
-
-                    # mse for single step only
-                    try:
-                        pos_sub = self.model(
-                            [target_pos[t - 1], target_vel[t - 1]] +
-                            results[i][t][2:])[0]
-                    except tf.errors.ResourceExhaustedError as e:
-                        logging.info(f"ResourceExhaustedError: {e.message}")
-                        tf.keras.backend.clear_session()
-                        tf.compat.v1.reset_default_graph()
-                        continue
-
-                    loss['mse_single_val'] = np.mean(
-                        distance(target_pos[t], pos_sub))
-
-                    losses.append(loss)
-                    loss_seq.append(loss)
+                    loss['emd'] = np.mean(
+                        emd_loss(target_pos[t:t + 1], tf.expand_dims(
+                            pos, 0)).numpy().astype(np.float32))
+
+                # mse for single step only
+                pos_sub = self.run_guarded(
+                    'eval', target_pos.shape[1] + data["box"][0].shape[0],
+                    lambda: self.model([target_pos[t - 1], target_vel[t - 1]] + results[i][t][2:])[0],
+                    ['chunk'] if self.chunked_convs() else [])
+                if pos_sub is None:
+                    continue
+
+                loss['mse_single_val'] = np.mean(
+                    distance(target_pos[t], pos_sub))
+
+                losses.append(loss)
+                loss_seq.append(loss)
 
             loss_m = merge_dicts(loss_seq, lambda x, y: x + y / len(loss_seq))
 
@@ -284,6 +732,15 @@ class Simulator(BasePipeline):
         loss["loss"] = sum_loss
 
         log.info(desc)
+        if emd_errors:
+            log.info("emd (%s) relative error vs. exact: mean %.4f, max %.4f (%d frames)" %
+                     (emd_backend, np.mean(emd_errors), np.max(emd_errors),
+                      len(emd_errors)))
+        if getattr(dataset, 'cache', None) is not None:
+            log.info("scene cache: %s" % dataset.cache.stats())
+        if self.boundary_cache is not None:
+            log.info("boundary cache: %s" % self.boundary_cache.stats())
+        log.info("ground truth metric cache: %s" % self.gt_cache.stats())
 
         self.valid_loss = loss
 
@@ -319,7 +776,13 @@ class Simulator(BasePipeline):
         window_idx, warmup_idx, iteration_idx = 0, 0, 0
         log.info("Started training")
 
-        error_samples = []
+        compile_train = cfg.get('compile_train', False)
+        train_built = False
+        self.train_steps = {}
+
+        # hard samples are kept by reference and loaded again when replayed
+        replay_flow = PhysicsSimDataFlow(dataset.train, **cfg.data_generator, **cfg.data_generator.train)
+        error_samples = ReplayBuffer(cfg.get('replay_budget_mb', 64), load=replay_flow.load_batch)
         for epoch in range(start_epoch, cfg.max_epoch + 1):
             log.info(f'=== EPOCH {epoch}/{cfg.max_epoch} ===')
             process_bar = tqdm(range(cfg.iter), desc='training')
@@ -346,6 +809,9 @@ class Simulator(BasePipeline):
                         loader_updated = True
 
                     if loader_updated:
+                        # stop the workers of the previous loader before starting new ones
+                        if hasattr(train_loader, 'close'):
+                            train_loader.close()
                         train_loader = get_dataloader(
                             dataset.train,
                             batch_size=cfg.batch_size,
@@ -363,19 +829,29 @@ class Simulator(BasePipeline):
                     data_fetch_latency = time.time() - data_fetch_start
                 else:
                     data_fetch_start = time.time()
-                    data = random.choice(error_samples) if error_samples else next(train_loader)
+                    data = error_samples.sample() if error_samples else next(train_loader)
                     time_weights = self.calculate_time_weights(cfg, data, step, window_idx)
 
                     data_fetch_latency = time.time() - data_fetch_start
                 self.log_scalar_every_n_minutes(self.writer, step, 5, 'DataLatency', data_fetch_latency)
-
-                try:
-                    loss, pre_steps = self.train_step(model, cfg, self.optimizer, data, time_weights)
-                except tf.errors.ResourceExhaustedError as e:
-                    logging.info(f"ResourceExhaustedError: {e.message}")
-                    tf.keras.backend.clear_session()
-                    tf.compat.v1.reset_default_graph()
+                if hasattr(train_loader, 'qsize'):
+                    self.log_scalar_every_n_minutes(self.writer, step, 5, 'DataQueueSize', train_loader.qsize())
+
+                def run_step():
+                    # a shrunk window trains on the first frames of the sample
+                    weights = time_weights[:max(int(time_weights.shape[0]) >> self.option('window_shift', 0), 1)]
+                    # the first step runs eagerly to build the model and optimizer variables,
+                    # mitigations change python options of the step and run eagerly as well
+                    if compile_train and train_built and self.can_compile_train(data):
+                        return self.compiled_train_step(data, weights) + (weights,)
+                    return self.train_step(model, cfg, self.optimizer, data, weights) + (weights,)
+
+                size = sum(np.shape(p)[1] + np.shape(b)[1] for p, b in zip(data['pos'], data['box']))
+                result = self.run_guarded('train', size, run_step, self.train_mitigations(data, time_weights))
+                if result is None:
                     continue
+                loss, pre_steps, time_weights = result
+                train_built = True
 
                 if iteration == 0 and epoch == start_epoch:
                     self.log_param_count()
@@ -383,12 +859,11 @@ class Simulator(BasePipeline):
                 # 在主代码中使用新的函数
                 loss_values, desc = self.log_and_generate_description(model, loss, time_weights, data, pre_steps)
                 if iteration < 0.8 * cfg.iter and loss_values['loss'] >= target_loss:
-                    if not any(data is item for item in error_samples):
+                    if error_samples.add(data, loss_values['loss']):
                         logging.info("loss: {} >= target_loss: {}, add to error_samples".format(loss_values['loss'],
                                                                                                 target_loss))
-                        error_samples.append(data)
                 elif iteration >= 0.8 * cfg.iter and loss_values['loss'] < target_loss:
-                    error_samples[:] = [item for item in error_samples if data is not item]
+                    error_samples.remove(data)
                     logging.info("loss: {} < target_loss: {}, remove from error_samples".format(loss_values['loss'],
                                                                                                 target_loss))
                 process_bar.set_description(desc)
@@ -396,15 +871,30 @@ class Simulator(BasePipeline):
 
                 self.save_logs(self.writer, step, [loss_values], "train")
 
+            log.info("memory mitigations: %s" % self.oom.stats())
+            log.info("error samples: %s" % error_samples.stats())
             if epoch % cfg.save_ckpt_freq == 0:
                 self.save_ckpt(epoch)
 
             # 运行验证和测试
             # --------------------- validation
-            self.run_valid(epoch)
+            # valid and test often cover the same scenes, roll them out once
+            valid_data = get_rollout(dataset.valid, **cfg.data_generator,
+                                     **cfg.data_generator.valid)
+            test_data = get_rollout(dataset.test, **cfg.data_generator,
+                                    **cfg.data_generator.test)
+            test_writer = self.test_writer(epoch, test_data)
+            valid_results, _ = self.run_shared_rollout(
+                [(dataset.valid, valid_data), (dataset.test, test_data)],
+                sinks=[None, test_writer])
+
+            self.run_valid(epoch, valid_data, valid_results)
             self.save_logs(self.writer, epoch, [self.valid_loss], "valid")
 
-            self.run_test(epoch)
+            self.run_test(epoch, test_data=test_data, writer=test_writer)
+
+        if hasattr(train_loader, 'close'):
+            train_loader.close()
 
     def calculate_time_weights(self, cfg, data, step, window_idx):
         time_weights = np.ones((np.min([d.shape[0] - 1 - p for d, p in zip(data['pos'], data['pre'])])),
@@ -416,24 +906,196 @@ class Simulator(BasePipeline):
                 time_weights[-diff:] = np.clip(alpha - np.arange(diff) / diff, 0.0, 1.0)
         return tf.convert_to_tensor(list(time_weights))
 
-    # @tf.function(experimental_relax_shapes=True)
+    def compiled_train_step(self, data, time_weights):
+        """
+        Run a train step as a traced tf.function.
+
+        One function is traced per batch size and window length, so retracing
+        only happens when `windows` changes at the `window_bnds`.
+
+        Args:
+            data: A batch from the train loader.
+            time_weights: Loss weights of the time steps in the window.
+        Returns:
+            Returns the loss and the number of warm-up steps per sample.
+        """
+        keys = ['pos', 'vel', 'grav', 'box', 'box_normals']
+        batch = {k: [tf.convert_to_tensor(x, tf.float32) for x in data[k]] for k in keys}
+        batch['pre'] = [tf.constant(p, tf.int32) for p in data['pre']]
+
+        key = (len(data['pos']), int(time_weights.shape[0]))
+        if key not in self.train_steps:
+            spec = {k: [tf.TensorSpec([None] * (x.shape.rank - 1) + [3], tf.float32) for x in batch[k]]
+                    for k in keys}
+            spec['pre'] = [tf.TensorSpec([], tf.int32)] * key[0]
+
+            def step(batch, time_weights):
+                log.info("tracing train step for batch size %d and window %d" % key)
+                return self.train_step(self.model, self.cfg, self.optimizer, batch, time_weights)
+
+            self.train_steps[key] = tf.function(step,
+                                                input_signature=[spec, tf.TensorSpec([key[1]], tf.float32)])
+
+        return self.train_steps[key](batch, time_weights)
+
     def train_step(self, model, cfg, optimizer, data, time_weights):
+        num_micro = min(self.option('grad_accum_steps', 1), len(data['pos']))
+        if num_micro > 1:
+            return self.accumulated_train_step(model, cfg, optimizer, data, time_weights, num_micro)
+        total_loss, gradients, pre_steps = self.train_gradients(model, cfg, data, time_weights)
+        self.apply_gradients(optimizer, cfg, gradients, model)
+        return total_loss, pre_steps
+
+    def train_gradients(self, model, cfg, data, time_weights, weight_decay=True):
+        """Returns the loss, its gradients and the warm-up steps of a batch."""
+        packed = self.pack_batch(data)
+        if packed is not None:
+            return self.packed_train_gradients(model, cfg, data, time_weights, *packed, weight_decay=weight_decay)
         in_positions, in_velocities, pre_steps = self.warmup_phase(model, data, cfg)
-        total_loss = self.calculate_loss(model, cfg, optimizer, data, in_positions, in_velocities, pre_steps,
-                                         time_weights)
+        total_loss, gradients = self.calculate_loss(model, cfg, data, in_positions, in_velocities, pre_steps,
+                                                    time_weights, weight_decay=weight_decay)
+        return total_loss, gradients, pre_steps
+
+    def accumulated_train_step(self, model, cfg, optimizer, data, time_weights, num_micro):
+        """
+        Train step which splits the batch into `num_micro` micro-batches.
+
+        The gradients of the micro-batches are weighted by their share of
+        the batch and summed, so they equal the gradients of the whole batch.
+        Weight decay is added and gradient clipping applied once on the
+        accumulated gradients, followed by a single optimizer update.
+        """
+        num = len(data['pos'])
+        bounds = np.linspace(0, num, num_micro + 1).astype(int)
+        total_loss, gradients, pre_steps = 0.0, None, []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            micro = {k: v[start:end] for k, v in data.items()}
+            loss, grads, pre = self.train_gradients(model, cfg, micro, time_weights, weight_decay=False)
+            w = (end - start) / num
+            grads = [None if g is None else w * tf.convert_to_tensor(g) for g in grads]
+            gradients = grads if gradients is None else [
+                a if b is None else (b if a is None else a + b) for a, b in zip(gradients, grads)
+            ]
+            total_loss += w * loss
+            pre_steps += list(pre)
+
+        if cfg.get("w_decay", 0) > 0:
+            with tf.GradientTape() as tape:
+                decay = self.apply_weight_decay(cfg, model, tf.zeros_like(total_loss))
+            total_loss += decay
+            gradients = [
+                d if g is None else g + d for g, d in zip(gradients, tape.gradient(decay, model.trainable_weights))
+            ]
+        self.apply_gradients(optimizer, cfg, gradients, model)
         return total_loss, pre_steps
 
+    def pack_batch(self, data):
+        """
+        Packs the samples of a train batch into one particle set.
+
+        Only done with `pack_train_batch`, in eager mode, for models which
+        support batching and whose losses accept per particle weights, and
+        if all samples have the same gravity.
+
+        Args:
+            data: A batch from the train loader.
+        Returns:
+            Returns the `SceneBatch`, the packed initial state and the
+            boundary context, or None if the batch is not packed.
+        """
+        if not self.cfg.get('pack_train_batch', False) or len(data['pos']) < 2 or not tf.executing_eagerly() or \
+                not getattr(self.model, 'supports_batching', False) or \
+                not all(getattr(l, 'particle_weights', False) for l in getattr(self.model, 'loss_fn', {}).values()):
+            return None
+        inputs = [[
+            tf.convert_to_tensor(data["pos"][b][0]),
+            tf.convert_to_tensor(data["vel"][b][0]),
+            self.particle_grav(data["grav"][b][0], data["pos"][b][0]), None,
+            tf.convert_to_tensor(data["box"][b][0]),
+            tf.convert_to_tensor(data["box_normals"][b][0])
+        ] for b in range(len(data['pos']))]
+        if len(group_by_grav(inputs)) > 1:
+            return None
+
+        axes = np.ones(3, dtype=bool)
+        if "scale" in self.model.transformation:
+            axes = np.array(self.model.transformation["scale"]) != 0
+        batch = SceneBatch(inputs, axes)
+        state = batch.pack(inputs)
+        boundary = self.boundary_context(state, tuple(str(x[0]) for x in data['scene_id']))
+        return batch, state, boundary
+
+    def packed_train_gradients(self, model, cfg, data, time_weights, batch, state, boundary, weight_decay=True):
+        """
+        Loss and gradients with one model call per time step for the whole batch.
+
+        Samples which finished or stopped their warm-up keep their state
+        through particle masks, so warm-up lengths and early stops are the
+        same as in `warmup_phase`. The loss of every step is computed on the
+        packed set with particle weights 1 / (B * N_b), so it is the mean of
+        the per sample losses like in `calculate_loss`.
+        """
+        num = len(data['pos'])
+        pre = [int(p) for p in data['pre']]
+        pre_steps = [0] * num
+        prev_err, prev_dens_err = [tf.constant(0.0)] * num, [tf.constant(0.0)] * num
+        active = np.array([p > 0 for p in pre])
+
+        pos, vel = state[:2]
+        for step in range(max(pre)):
+            if not active.any():
+                break
+            new_pos, new_vel = model([pos, vel] + state[2:], training=False, boundary=boundary)
+            samples = batch.unpack([new_pos, new_vel, None])
+            accept = active.copy()
+            for b in np.flatnonzero(active):
+                pre_steps[b] = step
+                signal, prev_err[b], prev_dens_err[b] = self.check_error_thresholds(
+                    samples[b][0], data, b, step, prev_err[b], prev_dens_err[b], cfg, model)
+                accept[b] = signal
+                active[b] = signal and step + 1 < pre[b]
+            mask = tf.constant(np.repeat(accept, batch.fluid_cnt)[:, None])
+            pos, vel = tf.where(mask, new_pos, pos), tf.where(mask, new_vel, vel)
+
+        def frames(key, offset):
+            return tf.concat([data[key][b][t + pre_steps[b] + offset] for b in range(num)], axis=0)
+
+        pre_particles = tf.constant(np.repeat(pre_steps, batch.fluid_cnt), tf.int32)
+        weights = tf.constant(np.repeat([1.0 / (num * n) for n in batch.fluid_cnt], batch.fluid_cnt), tf.float32)
+        with tf.GradientTape() as tape:
+            losses = []
+            for t in range(time_weights.shape[0]):
+                target = frames('pos', 1) + batch.fluid_shift
+                target_prev = frames('pos', 0) + batch.fluid_shift
+
+                # the targets are bound now, the step may be recomputed after the loop
+                def step(pos, vel, target=target, target_prev=target_prev):
+                    inputs = [pos, vel] + state[2:]
+                    pos, vel = model(inputs, training=True, boundary=boundary)
+                    loss = model.loss([pos, vel], [inputs, target, target_prev, pre_particles, weights])
+                    return pos, vel, tf.convert_to_tensor(list(loss.values()))
+
+                pos, vel, loss = self.recompute(step)(pos, vel)
+                losses.append(loss * time_weights[t])
+
+            total_loss = tf.reduce_sum(tf.stack(losses), axis=0) / tf.reduce_sum(time_weights)
+            if weight_decay:
+                total_loss = self.apply_weight_decay(cfg, model, total_loss)
+        gradients = tape.gradient(total_loss, model.trainable_weights)
+        return total_loss, gradients, pre_steps
+
     def warmup_phase(self, model, data, cfg):
         in_positions, in_velocities, pre_steps = [], [], []
         for batch_index in range(len(data['pos'])):
-            acc = data["grav"][batch_index][0]
+            acc = self.particle_grav(data["grav"][batch_index][0], data["pos"][batch_index][0])
             pr_pos = data["pos"][batch_index][0]
             pr_vel = data["vel"][batch_index][0]
-            step, prev_err, prev_dens_err = 0, 0.0, 0.0
+            step, prev_err, prev_dens_err = 0, tf.constant(0.0), tf.constant(0.0)
+            boundary = self.sample_boundary(data, batch_index)
 
             for step in range(data['pre'][batch_index]):
                 inputs = (pr_pos, pr_vel, acc, None, data["box"][batch_index][0], data["box_normals"][batch_index][0])
-                pos, vel = model(inputs, training=False)
+                pos, vel = model(inputs, training=False, boundary=boundary)
                 signal, prev_err, prev_dens_err = self.check_error_thresholds(pos, data, batch_index, step, prev_err,
                                                                               prev_dens_err, cfg, model)
                 if not signal:
@@ -444,6 +1106,17 @@ class Simulator(BasePipeline):
             in_velocities.append(pr_vel)
         return in_positions, in_velocities, pre_steps
 
+    def sample_boundary(self, data, batch_index):
+        """Returns the cached boundary context of a sample of a train batch."""
+        if self.boundary_cache is None or not tf.executing_eagerly():
+            return None
+        inputs = [
+            data["pos"][batch_index][0], data["vel"][batch_index][0],
+            self.particle_grav(data["grav"][batch_index][0], data["pos"][batch_index][0]), None,
+            data["box"][batch_index][0], data["box_normals"][batch_index][0]
+        ]
+        return self.boundary_context(inputs, data['scene_id'][batch_index][0])
+
     def check_error_thresholds(self, pos, data, batch_index, step, prev_err, prev_dens_err, cfg, model):
         max_err = cfg.get('max_err', None)
         max_dens_err = cfg.get('max_dens_err', None)
@@ -466,7 +1139,8 @@ class Simulator(BasePipeline):
             prev_dens_err = err
         return True, prev_err, prev_dens_err
 
-    def calculate_loss(self, model, cfg, optimizer, data, in_positions, in_velocities, pre_steps, time_weights):
+    def calculate_loss(self, model, cfg, data, in_positions, in_velocities, pre_steps, time_weights,
+                       weight_decay=True):
         with tf.GradientTape() as tape:
             loss_tensor_array = tf.TensorArray(tf.float32, size=tf.shape(time_weights)[0] * len(data['pos']),
                                                dynamic_size=True, clear_after_read=False)
@@ -474,32 +1148,51 @@ class Simulator(BasePipeline):
             for batch_index in range(len(data['pos'])):
                 pos, vel = in_positions[batch_index], in_velocities[batch_index]
                 pre = pre_steps[batch_index]
-                t = 0
+                boundary = self.sample_boundary(data, batch_index)
 
-                while t < tf.shape(time_weights)[0]:
-                    pos, vel, pre, t, loss_tensor_array = self.train_step_body(pos, vel, pre, t, loss_tensor_array,
-                                                                               model, data, batch_index, time_weights)
+                # the window length is static, so the loop is unrolled when traced
+                for t in range(time_weights.shape[0]):
+                    pos, vel, pre, _, loss_tensor_array = self.train_step_body(pos, vel, pre, t, loss_tensor_array,
+                                                                               model, data, batch_index, time_weights,
+                                                                               boundary=boundary)
 
             total_loss = tf.reduce_sum(loss_tensor_array.stack(), axis=0) / (
                     tf.reduce_sum(time_weights) * len(data['pos']))
-            total_loss = self.apply_weight_decay(cfg, model, total_loss)
-            gradients = tape.gradient(total_loss, model.trainable_weights)
-            self.apply_gradients(optimizer, cfg, gradients, model)
-        return total_loss
+            if weight_decay:
+                total_loss = self.apply_weight_decay(cfg, model, total_loss)
+        gradients = tape.gradient(total_loss, model.trainable_weights)
+        return total_loss, gradients
 
-    def train_step_body(self, pos, vel, pre, t, loss_array, model, data, batch_index, time_weights):
-        inputs = [pos, vel, data["grav"][batch_index][0], None, data["box"][batch_index][0],
-                  data["box_normals"][batch_index][0]]
+    def train_step_body(self, pos, vel, pre, t, loss_array, model, data, batch_index, time_weights, boundary=None):
         target_pos = data["pos"][batch_index]
         target_vel = data["vel"][batch_index]
-        pos, vel = model(inputs, training=True)
-        loss_list = [model.loss([pos, vel],
-                                [inputs, target_pos[t + pre + 1], target_pos[t + pre], pre])]
-        merged_loss = merge_dicts(loss_list, lambda x, y: x + y / len(loss_list))
-        loss_array = loss_array.write(t + batch_index * tf.shape(time_weights)[0],
-                                      tf.convert_to_tensor(list(merged_loss.values())) * time_weights[t])
+
+        def step(pos, vel):
+            inputs = [pos, vel, self.particle_grav(data["grav"][batch_index][0], pos), None,
+                      data["box"][batch_index][0], data["box_normals"][batch_index][0]]
+            pos, vel = model(inputs, training=True, boundary=boundary)
+            loss_list = [model.loss([pos, vel],
+                                    [inputs, target_pos[t + pre + 1], target_pos[t + pre], pre])]
+            merged_loss = merge_dicts(loss_list, lambda x, y: x + y / len(loss_list))
+            return pos, vel, tf.convert_to_tensor(list(merged_loss.values()))
+
+        pos, vel, loss = self.recompute(step)(pos, vel)
+        loss_array = loss_array.write(t + batch_index * tf.shape(time_weights)[0], loss * time_weights[t])
         return pos, vel, pre, t + 1, loss_array
 
+    def recompute(self, step):
+        """
+        Wraps a training step for gradient checkpointing if `recompute_steps` is set.
+
+        Only the inputs of the step (the particle states) are kept on the
+        tape, the activations of the model are recomputed during backprop.
+        Activation memory then no longer grows with the window length, at
+        the cost of a second forward pass per step.
+        """
+        if not self.option('recompute_steps', False):
+            return step
+        return tf.recompute_grad(step)
+
     def apply_weight_decay(self, cfg, model, total_loss):
         weight_decay = cfg.get("w_decay", 0)
         if weight_decay > 0:
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+import datasets.dataset_reader_physics as reader
+from datasets.dataset_reader_physics import ColumnarScene, Dataset, PhysicsSimDataFlow, write_scene
+
+
+def make_frames(num_frames=6, num_particles=5, num_box=4):
+    rng = np.random.RandomState(0)
+    box = rng.rand(num_box, 3).astype(np.float32)
+    box_normals = rng.rand(num_box, 3).astype(np.float32)
+    return [{
+        'pos': rng.rand(num_particles, 3).astype(np.float32),
+        'vel': rng.rand(num_particles, 3).astype(np.float32),
+        'grav': np.array([0.0, -9.81, 0.0], np.float32),
+        'm': rng.rand(num_particles).astype(np.float32),
+        'viscosity': rng.rand(num_particles).astype(np.float32),
+        'box': box,
+        'box_normals': box_normals,
+        'frame_id': i,
+        'scene_id': 'sim_0000',
+    } for i in range(num_frames)]
+
+
+def frame_window(frames, start, length, stride=1):
+    """Stacks a window of decoded frames, like the per-frame path did."""
+    frames = frames[start:start + (length - 1) * stride + 1:stride]
+    sample = {k: np.stack([f[k] for f in frames]) for k in reader.SCENE_FIELDS}
+    for k in reader.SCENE_STATIC_FIELDS:
+        sample[k] = frames[0][k][None]
+    return sample
+
+
+@pytest.fixture
+def scene_dir(tmp_path):
+    frames = make_frames()
+    write_scene(str(tmp_path / 'sim_0000.scene'), frames)
+    return str(tmp_path), frames
+
+
+def test_window_matches_frames(scene_dir):
+    path, frames = scene_dir
+    scene = Dataset(dataset_path=path)[0]
+    assert isinstance(scene, ColumnarScene)
+    for start, length, stride in [(0, 2, 1), (1, 3, 2), (2, 4, 1)]:
+        sample = scene.window(start, length, stride)
+        expected = frame_window(frames, start, length, stride)
+        for k, v in expected.items():
+            np.testing.assert_array_equal(sample[k], v)
+        np.testing.assert_array_equal(sample['frame_id'], np.arange(start, start + (length - 1) * stride + 1, stride))
+
+
+def test_load_matches_iteration(scene_dir):
+    path, _ = scene_dir
+    flow = PhysicsSimDataFlow(Dataset(dataset_path=path), window=2, pre_frames=1, stride=1)
+    for sample in flow:
+        loaded = flow.load(sample['ref'])
+        for k in reader.SCENE_FIELDS + reader.SCENE_STATIC_FIELDS + ['pre', 'frame_id']:
+            np.testing.assert_array_equal(loaded[k], sample[k])
+
+
+def test_rotation_matches_frames(scene_dir, monkeypatch):
+    path, frames = scene_dir
+    rot = reader.R.from_euler('xyz', [0.3, -0.7, 1.1]).as_matrix().astype(np.float32)
+    monkeypatch.setattr(reader, 'random_rotation_matrix', lambda **kwargs: rot)
+    dataset = Dataset(dataset_path=path)
+    flow = PhysicsSimDataFlow(dataset, window=2, augment={'rotate': None})
+
+    sample = flow.load((0, 1, 0, flow.window))
+    expected = frame_window(frames, 1, flow.window)
+    for k in ['pos', 'vel', 'grav', 'box', 'box_normals']:
+        np.testing.assert_allclose(sample[k], np.matmul(expected[k], rot), rtol=1e-6, atol=1e-6)
+
+    # the scene itself is not modified by the transform
+    np.testing.assert_array_equal(dataset[0].window(1, flow.window)['grav'], expected['grav'])
@@ -0,0 +1,67 @@
+import importlib.util
+import os
+
+# loaded from the file, the pipelines package imports tensorflow
+_spec = importlib.util.spec_from_file_location(
+    'pipelines_memory', os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pipelines',
+                                     'memory.py'))
+memory = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(memory)
+OOMController = memory.OOMController
+
+
+def run(oom, kind, size, fits):
+    """Mimics Simulator.run_guarded with a step that fits from level `fits` on."""
+    level = oom.start_level(kind, size)
+    while level < fits:
+        oom.failure(kind, size, level)
+        level += 1
+    oom.success(kind, size, level)
+    return level
+
+
+def test_starts_at_learned_level():
+    oom = OOMController(relax_every=100)
+    assert oom.start_level('train', 1000) == 0
+    assert run(oom, 'train', 1000, fits=2) == 2
+    assert len(oom.failures) == 2
+    # same bucket and larger inputs start at the level which succeeded
+    assert oom.start_level('train', 1000) == 2
+    assert oom.start_level('train', 1023) == 2
+    assert oom.start_level('train', 5000) == 2
+    # smaller inputs and other kinds of steps are not affected
+    assert oom.start_level('train', 100) == 0
+    assert oom.start_level('valid', 1000) == 0
+
+
+def test_no_repeated_failures():
+    oom = OOMController(relax_every=100)
+    run(oom, 'train', 1000, fits=1)
+    for _ in range(10):
+        assert run(oom, 'train', 1000, fits=1) == 1
+    assert len(oom.failures) == 1
+
+
+def test_relaxes_after_successes():
+    oom = OOMController(relax_every=3)
+    run(oom, 'train', 1000, fits=2)
+    run(oom, 'train', 1000, fits=2)
+    run(oom, 'train', 1000, fits=2)
+    # after relax_every successes one level lower is probed
+    assert oom.start_level('train', 1000) == 1
+    assert oom.start_level('train', 1000) == 2
+    # a probe which fits lowers the level of the bucket
+    oom = OOMController(relax_every=1)
+    run(oom, 'train', 1000, fits=2)
+    assert run(oom, 'train', 1000, fits=0) == 1
+    assert oom.stats() == {'failures': 2, 'levels': {'train': {9: 1}}}
+    assert run(oom, 'train', 1000, fits=0) == 0
+    assert oom.stats() == {'failures': 2, 'levels': {'train': {9: 0}}}
+
+
+def test_failed_probe_keeps_level():
+    oom = OOMController(relax_every=1)
+    run(oom, 'train', 1000, fits=2)
+    assert run(oom, 'train', 1000, fits=2) == 2
+    assert len(oom.failures) == 3
+    assert oom.start_level('train', 1000) == 1
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from datasets.dataset_reader_physics import ColumnarScene, write_scene
+from utils.msgpack_to_scene import verify_scene
+
+
+def make_scene(num_frames=4, num_particles=5, num_box=3):
+    rng = np.random.RandomState(0)
+    box = rng.rand(num_box, 3).astype(np.float32)
+    box_normals = rng.rand(num_box, 3).astype(np.float32)
+    return [{
+        'pos': rng.rand(num_particles, 3).astype(np.float32),
+        'vel': rng.rand(num_particles, 3).astype(np.float32),
+        'm': rng.rand(num_particles).astype(np.float32),
+        'viscosity': rng.rand(num_particles).astype(np.float32),
+        'box': box,
+        'box_normals': box_normals,
+        'frame_id': i,
+        'scene_id': 'sim_0000',
+    } for i in range(num_frames)]
+
+
+def test_convert_verify_roundtrip(tmp_path):
+    data = make_scene()
+    path = str(tmp_path / 'sim_0000.scene')
+    write_scene(path, data)
+    verify_scene(data, path)
+
+    scene = ColumnarScene.open(path)
+    assert scene.scene_id == 'sim_0000'
+    np.testing.assert_array_equal(scene.window(1, 2)['pos'], np.stack([data[1]['pos'], data[2]['pos']]))
+    np.testing.assert_array_equal(scene[0]['box'], data[0]['box'])
+
+
+def test_verify_detects_mismatch(tmp_path):
+    data = make_scene()
+    path = str(tmp_path / 'sim_0000.scene')
+    write_scene(path, data)
+    data[2]['pos'] = data[2]['pos'] + 1.0
+    with pytest.raises(AssertionError):
+        verify_scene(data, path)
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('open3d.ml.tf')
+
+from utils.tools.neighbor import NeighborList, Neighbors, drop_self
+
+
+def make_points(n=8, seed=0):
+    rng = np.random.RandomState(seed)
+    return tf.constant(rng.rand(n, 3).astype(np.float32)), tf.constant(rng.rand(n, 3).astype(np.float32) + 2.0)
+
+
+def test_verlet_list_rebuilds_after_diagonal_move():
+    skin = 0.1
+    pos, box = make_points()
+    neighbors = NeighborList(skin=skin)
+    neighbors(pos, box, 0.3)
+    assert neighbors.builds == 1
+
+    # every coordinate changes by less than skin / 2, the distance moved is larger
+    step = np.zeros(pos.shape, np.float32)
+    step[0] = 0.45 * skin
+    neighbors(pos + step, box, 0.3)
+    assert neighbors.builds == 2
+
+
+def test_verlet_list_reuses_after_small_move():
+    skin = 0.1
+    pos, box = make_points()
+    neighbors = NeighborList(skin=skin)
+    neighbors(pos, box, 0.3)
+
+    step = np.zeros(pos.shape, np.float32)
+    step[0] = 0.2 * skin
+    neighbors(pos + step, box, 0.3)
+    assert neighbors.builds == 1
+
+
+def test_drop_self_matches_coincident_points():
+    # query 0 coincides with point 2 of a different array, query 1 with none
+    neighbors = Neighbors(tf.constant([0, 2, 1, 2], tf.int32), tf.constant([0, 2, 4], tf.int64),
+                          tf.constant([0.01, 0.0, 0.02, 0.03]))
+    index, row_splits, distance = drop_self(neighbors)
+    np.testing.assert_array_equal(index.numpy(), [0, 1, 2])
+    np.testing.assert_array_equal(row_splits.numpy(), [0, 1, 3])
+    np.testing.assert_allclose(distance.numpy(), [0.01, 0.02, 0.03])
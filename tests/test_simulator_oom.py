@@ -0,0 +1,47 @@
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('open3d.ml.tf')
+
+from pipelines.memory import OOMController
+from pipelines.simulator import Simulator
+
+
+class Conv:
+    memory_budget = None
+
+
+class Model:
+    def __init__(self):
+        self.conv = Conv()
+        self._all_convs = [('conv', self.conv)]
+
+
+def make_simulator():
+    # only the state used by the memory mitigations
+    sim = Simulator.__new__(Simulator)
+    sim.cfg = {'oom_conv_budget': 128}
+    sim.model = Model()
+    sim.oom = OOMController()
+    sim.overrides = {}
+    return sim
+
+
+def test_chunk_retry_does_not_reuse_compiled_step():
+    sim = make_simulator()
+    data = {'grav': [[[0.0, -9.81, 0.0]]]}
+    calls = []
+
+    def run_step():
+        # mirrors the choice between the compiled and the eager train step of run_train
+        calls.append(('compiled' if sim.can_compile_train(data) else 'eager', sim.model.conv.memory_budget))
+        if len(calls) == 1:
+            raise tf.errors.ResourceExhaustedError(None, None, 'out of memory')
+        return len(calls)
+
+    assert sim.run_guarded('train', 1000, run_step, ['chunk']) == 2
+    assert calls == [('compiled', None), ('eager', 128)]
+    # the mitigations are undone after the step
+    assert sim.overrides == {}
+    assert sim.model.conv.memory_budget is None
+    assert sim.can_compile_train(data)
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('open3d.ml.tf')
+
+from pipelines.simulator import Simulator
+from utils.tools.losses import get_loss
+
+
+class LocalModel(tf.keras.Model):
+    """Per particle, translation invariant model, so scenes can be packed."""
+
+    supports_batching = True
+    transformation = {}
+
+    def __init__(self):
+        super().__init__()
+        self.dense = tf.keras.layers.Dense(3)
+        self.loss_fn = {'mse': get_loss('mse'), 'vel': get_loss('vel', fac=0.5)}
+
+    def call(self, inputs, training=True, boundary=None):
+        pos, vel, acc = inputs[:3]
+        vel = vel + 0.01 * acc + 0.1 * self.dense(vel)
+        return pos + 0.01 * vel, vel
+
+    def loss(self, results, data):
+        return {
+            n: l(data[1], results[0], input=data[0], target_prev=data[2], pre_steps=data[3],
+                 particle_weights=data[4] if len(data) > 4 else None) for n, l in self.loss_fn.items()
+        }
+
+
+def make_batch(counts=(4, 9), num_frames=4, num_box=5):
+    rng = np.random.RandomState(0)
+    data = {k: [] for k in ['pos', 'vel', 'grav', 'box', 'box_normals', 'pre', 'scene_id']}
+    for i, n in enumerate(counts):
+        data['pos'].append(rng.rand(num_frames, n, 3).astype(np.float32))
+        data['vel'].append(rng.rand(num_frames, n, 3).astype(np.float32))
+        data['grav'].append(np.tile(np.array([0.0, -9.81, 0.0], np.float32), (num_frames, 1)))
+        data['box'].append(rng.rand(1, num_box, 3).astype(np.float32))
+        data['box_normals'].append(rng.rand(1, num_box, 3).astype(np.float32))
+        data['pre'].append(0)
+        data['scene_id'].append(np.full(num_frames, 'sim_%04d' % i))
+    return data
+
+
+def make_simulator(model, pack):
+    # only the state used by the train step
+    sim = Simulator.__new__(Simulator)
+    sim.cfg = {'pack_train_batch': pack}
+    sim.model = model
+    sim.boundary_cache = None
+    sim.overrides = {}
+    return sim
+
+
+def test_packed_loss_matches_unpacked():
+    model = LocalModel()
+    data = make_batch()
+    model([tf.constant(data['pos'][0][0]), tf.constant(data['vel'][0][0]), tf.zeros_like(data['pos'][0][0])])
+    time_weights = tf.constant([1.0, 0.5, 0.25])
+
+    unpacked = make_simulator(model, pack=False)
+    assert unpacked.pack_batch(data) is None
+    loss, grads, _ = unpacked.train_gradients(model, unpacked.cfg, data, time_weights)
+
+    packed = make_simulator(model, pack=True)
+    assert packed.pack_batch(data) is not None
+    packed_loss, packed_grads, _ = packed.train_gradients(model, packed.cfg, data, time_weights)
+
+    np.testing.assert_allclose(packed_loss.numpy(), loss.numpy(), rtol=1e-4)
+    for g, p in zip(grads, packed_grads):
+        np.testing.assert_allclose(p.numpy(), g.numpy(), rtol=1e-3, atol=1e-6)
+
+
+def test_losses_without_particle_weights_are_not_packed():
+    model = LocalModel()
+    model.loss_fn['dense'] = get_loss('dense')
+    sim = make_simulator(model, pack=True)
+    assert sim.pack_batch(make_batch()) is None
@@ -28,6 +28,8 @@ import open3d.ml.tf as ml3d
 import tensorflow as tf
 import numpy as np
 
+from utils.tools.neighbor import budget_edges, map_receiver_chunks, slice_receivers
+
 __all__ = ['ContinuousConv', 'SparseConv', 'SparseConvTranspose']
 
 
@@ -146,6 +148,10 @@ class ContinuousConv(tf.keras.layers.Layer):
         sym_axis: The mirror axis used to generate the anti-symmetric kernel.
 
         circular: If True a circular kernel is used (i.e. rotational invariant).
+
+        memory_budget: Optional budget in MB for the per neighbor pair
+          intermediates. Larger neighborhoods are processed in chunks of
+          output points whose results are concatenated.
     """
     def __init__(
         self,
@@ -172,6 +178,7 @@ class ContinuousConv(tf.keras.layers.Layer):
         symmetric=False,
         sym_axis=2,
         circular=False,
+        memory_budget=None,
         **kwargs):
 
         from tensorflow.keras import activations, initializers, regularizers
@@ -196,6 +203,7 @@ class ContinuousConv(tf.keras.layers.Layer):
         self.symmetric = symmetric
         self.sym_axis = sym_axis
         self.circular = circular
+        self.memory_budget = memory_budget
 
         if offset is None:
             self.offset = tf.zeros(shape=(3, ))
@@ -428,7 +436,7 @@ class ContinuousConv(tf.keras.layers.Layer):
             'normalize': self.normalize,
         }
 
-        out_features = ml3d.ops.continuous_conv(**self._conv_values)
+        out_features = self._continuous_conv(self._conv_values)
 
         if self.symmetric:
             weights = tf.reshape(
@@ -451,7 +459,7 @@ class ContinuousConv(tf.keras.layers.Layer):
                 'interpolation': self.interpolation,
                 'normalize': self.normalize,
             }
-            w_values = ml3d.ops.continuous_conv(**c_val)
+            w_values = self._continuous_conv(c_val)
             res = tf.reshape(w_values,
                              (-1, kernel.shape[-2], kernel.shape[-1]))
             out_features += tf.squeeze(tf.expand_dims(inp_features, 1) @ res,
@@ -469,6 +477,49 @@ class ContinuousConv(tf.keras.layers.Layer):
 
         return out_features
 
+    def _continuous_conv(self, values):
+        """Calls the continuous_conv op in chunks of output points within the memory budget."""
+        # neighbor index, interpolation weights and gathered features per pair
+        max_edges = budget_edges(self.memory_budget,
+                                 4 * (values['inp_features'].shape[-1] + 16))
+        if max_edges is None:
+            return ml3d.ops.continuous_conv(**values)
+
+        neighbors_index = values['neighbors_index']
+        neighbors_row_splits = values['neighbors_row_splits']
+        per_pair_importance = values['neighbors_importance'].shape[0] != 0
+        extents = tf.broadcast_to(values['extents'],
+                                  [tf.shape(values['out_positions'])[0], 1])
+
+        def conv(start, end, filters, out_positions, extents, inp_positions,
+                 inp_features, inp_importance, neighbors_importance):
+            index, row_splits = slice_receivers(neighbors_index,
+                                                neighbors_row_splits, start,
+                                                end)
+            if per_pair_importance:
+                neighbors_importance = neighbors_importance[
+                    neighbors_row_splits[start]:neighbors_row_splits[end]]
+            return ml3d.ops.continuous_conv(
+                **dict(values,
+                       filters=filters,
+                       out_positions=out_positions[start:end],
+                       extents=extents[start:end],
+                       inp_positions=inp_positions,
+                       inp_features=inp_features,
+                       inp_importance=inp_importance,
+                       neighbors_index=index,
+                       neighbors_row_splits=row_splits,
+                       neighbors_importance=neighbors_importance))
+
+        return map_receiver_chunks(
+            conv,
+            neighbors_row_splits,
+            max_edges,
+            args=(tf.convert_to_tensor(values['filters']),
+                  values['out_positions'], extents, values['inp_positions'],
+                  values['inp_features'], values['inp_importance'],
+                  values['neighbors_importance']))
+
     def compute_output_shape(self, inp_features_shape):
         return tf.TensorShape((None, self.filters))
 
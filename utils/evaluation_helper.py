@@ -1,3 +1,7 @@
+import hashlib
+import math
+import os
+
 import numpy as np
 from scipy.spatial import distance_matrix
 from scipy.spatial import cKDTree
@@ -28,6 +32,138 @@ def chamfer_distance(pred, gt):
     return dist
 
 
+def _knn_edges(x, y, k, chunk):
+    """Union of the k nearest neighbor edges x -> y and y -> x.
+
+    Edges are returned in row major order (sorted by x index, then y index).
+    """
+    n, m = x.shape[0], y.shape[0]
+    keys = []
+    for src, dst, swap in ((x, y, False), (y, x, True)):
+        tree = cKDTree(dst)
+        kk = min(k, dst.shape[0])
+        for s in range(0, src.shape[0], chunk):
+            _, j = tree.query(src[s:s + chunk], kk)
+            j = j.reshape(-1, kk)
+            i = np.repeat(np.arange(s, s + j.shape[0]), kk)
+            keys.append(j.ravel() * m + i if swap else i * m + j.ravel())
+    keys = np.unique(np.concatenate(keys).astype(np.int64))
+    return keys // m, keys % m
+
+
+def _segment_logsumexp(vals, ptr):
+    mx = np.maximum.reduceat(vals, ptr)
+    cnt = np.diff(np.append(ptr, vals.shape[0]))
+    return mx + np.log(
+        np.add.reduceat(np.exp(vals - np.repeat(mx, cnt)), ptr))
+
+
+def sinkhorn_distance(x,
+                      y,
+                      k=16,
+                      blur=0.05,
+                      scaling=0.5,
+                      max_iter=200,
+                      tol=1e-4,
+                      chunk=65536):
+    """Entropic EMD approximation on a k-nearest-neighbor truncated cost.
+
+    Runs log-domain Sinkhorn iterations with uniform weights, restricted to
+    the k nearest neighbor pairs in both directions, so time and memory are
+    O((n + m) * k). The regularization is annealed geometrically (by
+    `scaling`) from the largest edge cost down to `blur` times the mean
+    particle spacing of `x`.
+
+    Returns:
+        The mean transport distance of the (approximately) optimal plan.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = x.shape[0], y.shape[0]
+
+    rows, cols = _knn_edges(x, y, k, chunk)
+    cost = np.linalg.norm(x[rows] - y[cols], axis=-1)
+    row_ptr = np.searchsorted(rows, np.arange(n))
+    by_col = np.lexsort((rows, cols))
+    col_ptr = np.searchsorted(cols[by_col], np.arange(m))
+
+    spacing = np.mean(cKDTree(x).query(x, 2)[0][:, 1]) if n > 1 else 0.0
+    eps_min = max(blur * spacing, 1e-12)
+    eps = max(np.max(cost), eps_min)
+
+    log_a, log_b = -np.log(n), -np.log(m)
+    f, g = np.zeros(n), np.zeros(m)
+    for it in range(max_iter):
+        f = eps * log_a - eps * _segment_logsumexp(
+            (g[cols] - cost) / eps, row_ptr)
+        g = eps * log_b - eps * _segment_logsumexp(
+            ((f[rows] - cost) / eps)[by_col], col_ptr)
+        if eps > eps_min:
+            eps = max(eps * scaling, eps_min)
+            continue
+        plan = np.exp((f[rows] + g[cols] - cost) / eps)
+        if np.sum(np.abs(np.add.reduceat(plan, row_ptr) - 1.0 / n)) < tol:
+            break
+
+    plan = np.exp((f[rows] + g[cols] - cost) / eps)
+    return np.sum(plan * cost) / np.sum(plan)
+
+
+def sliced_wasserstein_distance(x, y, num_proj=256, chunk=32, seed=0):
+    """Sliced Wasserstein-1 estimate of the EMD.
+
+    Points are projected onto random directions (spanning only the axes
+    with non-zero extent, so 2D scenes stored in 3D work) and the 1D
+    distances are computed by sorting. The result is divided by the mean
+    absolute projection of a unit vector, which makes it exact for
+    translations. Memory is O((n + m) * chunk).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n, m = x.shape[0], y.shape[0]
+
+    axes = np.ptp(np.concatenate((x, y), axis=0), axis=0) > 0
+    if not np.any(axes):
+        return 0.0
+    x, y = x[:, axes], y[:, axes]
+    dim = x.shape[1]
+
+    rng = np.random.default_rng(seed)
+    dirs = rng.normal(size=(num_proj, dim))
+    dirs /= np.linalg.norm(dirs, axis=-1, keepdims=True)
+
+    # quantile levels shared by both point sets
+    cnt = max(n, m)
+    q = (np.arange(cnt) + 0.5) / cnt
+    idx_x = np.floor(q * n).astype(np.int64)
+    idx_y = np.floor(q * m).astype(np.int64)
+
+    total = 0.0
+    for s in range(0, num_proj, chunk):
+        px = np.sort(x @ dirs[s:s + chunk].T, axis=0)[idx_x]
+        py = np.sort(y @ dirs[s:s + chunk].T, axis=0)[idx_y]
+        total += np.sum(np.mean(np.abs(px - py), axis=0))
+
+    mean_proj = math.gamma(dim / 2) / (math.sqrt(math.pi) *
+                                       math.gamma((dim + 1) / 2))
+    return total / num_proj / mean_proj
+
+
+def emd_distance(x, y, backend='sinkhorn', **kwargs):
+    """Mean transport distance between two point sets.
+
+    Backends: 'exact' (linear assignment, dense), 'sinkhorn' and 'sliced'.
+    """
+    if backend == 'exact':
+        return np.mean(optimal_assignment_distance(x, y))
+    elif backend == 'sinkhorn':
+        return sinkhorn_distance(x, y, **kwargs)
+    elif backend == 'sliced':
+        return sliced_wasserstein_distance(x, y, **kwargs)
+    else:
+        raise NotImplementedError(f"EMD backend '{backend}' is not implemented.")
+
+
 def compute_stats(x):
     return {
         'mean': np.mean(x),
@@ -51,25 +187,227 @@ def compare_dist(x, y, bin_size=25):
     max_v = np.percentile(np.concatenate((x, y), axis=0), 95, axis=0)
 
     bin_w = (max_v - min_v + 1e-6) / bin_cnt_per_dim
+    shape = (bin_cnt_per_dim + 1, ) * dim
+
+    def hist(val):
+        idx = np.clip(((np.asarray(val) - min_v) / bin_w).astype("int32"), 0,
+                      bin_cnt_per_dim)
+        flat = np.ravel_multi_index(tuple(idx.T), shape)
+        return np.bincount(flat, minlength=int(np.prod(shape))) + 1e-5
+
+    return entropy(hist(x), hist(y))
+
+
+def _poly6(r2, h):
+    return np.where(r2 <= h**2, 315 / (64 * np.pi * h**9) * (h**2 - r2)**3,
+                    0.0)
+
+
+def _pairs(tree_a, tree_b, radius):
+    """Pairs (i of a, j of b) closer than radius and their distances."""
+    if tree_a.n == 0 or tree_b.n == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    p = tree_a.sparse_distance_matrix(tree_b, radius, output_type='ndarray')
+    return p['i'], p['j'], p['v']
+
+
+def _kernel_sum(radius, *pairs):
+    return sum(
+        np.bincount(i, weights=_poly6(d**2, radius), minlength=n)
+        for i, d, n in pairs)
+
+
+def ground_truth_metrics(target_pos, box, radius):
+    """Ground truth side terms of the validation metrics.
+
+    These only depend on the data, so they can be computed once and reused
+    by every validation run (see `GroundTruthCache`).
+
+    Returns:
+        Dict with the boundary part of the ground truth densities
+        ('box_dens'), the max. ground truth density ('max_dens') and the
+        weights of the boundary weighted mse ('importance').
+    """
+    target_pos = np.asarray(target_pos)
+    box_tree = cKDTree(np.asarray(box).reshape(-1, 3))
+    frames, m = target_pos.shape[:2]
+
+    box_dens = np.zeros((frames, m))
+    max_dens = np.zeros(frames)
+    importance = np.zeros((frames, m))
+    for f in range(frames):
+        target_tree = cKDTree(target_pos[f])
+        tt_i, _, tt_d = _pairs(target_tree, target_tree, radius)
+        tb_i, _, tb_d = _pairs(target_tree, box_tree, radius)
+
+        box_dens[f] = _kernel_sum(radius, (tb_i, tb_d, m))
+        max_dens[f] = np.max(box_dens[f] +
+                             _kernel_sum(radius, (tt_i, tt_d, m)))
+
+        # see `boundary_loss`, coinciding points are not counted
+        num_fluid = np.bincount(tt_i[tt_d > 0], minlength=m)
+        num_solid = np.bincount(tb_i[tb_d > 0], minlength=m)
+        importance[f] = (1 + np.exp(-num_fluid)) * (1 + num_solid)
+    return {'box_dens': box_dens, 'max_dens': max_dens, 'importance': importance}
+
+
+def sequence_metrics(target_pos,
+                     target_vel,
+                     pos,
+                     vel,
+                     box,
+                     radius,
+                     full=True,
+                     emd_backend=None,
+                     emd_kwargs=None,
+                     emd_check_size=0,
+                     gt=None):
+    """Validation metrics for the evaluated frames of one sequence.
+
+    Computes the same metrics as the former per-frame code in
+    `Simulator.run_valid` (mse, chamfer, density, max. density, EMD,
+    velocity histogram KL and boundary weighted mse), but from one set of
+    KD-trees per frame which is shared by all metrics; the boundary tree is
+    built once per sequence. Only numpy and scipy are used, so sequences can
+    be evaluated in worker processes.
+
+    Args:
+        target_pos, target_vel, pos, vel: Arrays of shape [frames, N, 3].
+        box: Boundary particles of the scene.
+        radius: Radius of the density kernel and the boundary weights.
+        full: Compute all metrics, otherwise only mse and chamfer.
+        emd_backend: Backend of `emd_distance`, None skips the EMD.
+        emd_kwargs: Arguments of the EMD backend.
+        emd_check_size: Compare the EMD against the exact solver for scenes
+            up to this size.
+        gt: Result of `ground_truth_metrics`, computed if not given.
+
+    Returns:
+        List with one metric dict per frame, list of relative EMD errors and
+        the ground truth terms (None if `full` is False).
+    """
+    target_pos = np.asarray(target_pos)
+    pos = np.asarray(pos)
+    box = np.asarray(box)
+    if box.shape[0] > 0:
+        pos = np.clip(pos, np.min(box, axis=0), np.max(box, axis=0))
+    box_tree = cKDTree(box.reshape(-1, 3))
+    if full and gt is None:
+        gt = ground_truth_metrics(target_pos, box, radius)
+
+    mse = np.mean(distance(target_pos, pos), axis=-1)
+
+    metrics, emd_errors = [], []
+    for f in range(pos.shape[0]):
+        tp, p = target_pos[f], pos[f]
+        target_tree, tree = cKDTree(tp), cKDTree(p)
+        loss = {}
+        loss['mse_val'] = mse[f]
+        loss['chamfer_val'] = np.mean(
+            target_tree.query(p)[0].astype(np.float32))
+
+        if full:
+            # prediction side pairs, shared by all metrics
+            pt_i, pt_j, pt_d = _pairs(tree, target_tree, radius)
+            pp_i, _, pp_d = _pairs(tree, tree, radius)
+            pb_i, _, pb_d = _pairs(tree, box_tree, radius)
+            n, m = p.shape[0], tp.shape[0]
+
+            # see `density_loss` for the definition of both metrics
+            pred_dens = _kernel_sum(radius, (pt_i, pt_d, n), (pb_i, pb_d, n))
+            gt_dens = gt['box_dens'][f] + _kernel_sum(radius,
+                                                      (pt_j, pt_d, m))
+            loss['dens_val'] = np.mean(
+                np.maximum(pred_dens - np.max(gt_dens) - 0.01, 0.0))
+
+            rest_dens = np.max(
+                _kernel_sum(radius, (pp_i, pp_d, n), (pb_i, pb_d, n)))
+            loss['max_dens_val'] = np.abs(gt['max_dens'][f] -
+                                          rest_dens) / rest_dens
+
+            loss['chamfer_val_2'] = np.mean(
+                tree.query(tp)[0].astype(np.float32))
+
+            if emd_backend is not None:
+                loss['emd'] = emd_distance(tp, p, emd_backend,
+                                           **(emd_kwargs or {}))
+                if emd_backend != 'exact' and m == n <= emd_check_size:
+                    exact = emd_distance(tp, p, 'exact')
+                    emd_errors.append(
+                        abs(loss['emd'] - exact) / max(exact, 1e-12))
+
+            loss['vel_diff_val'] = compare_dist(target_vel[f], vel[f])
+            loss['vel_diff_val_2'] = compare_dist(vel[f], target_vel[f])
+
+            loss['weight_mse_val'] = np.mean(
+                gt['importance'][f] * np.sum((p - tp)**2, axis=-1))
+
+        metrics.append(loss)
+    return metrics, emd_errors, gt
+
+
+class GroundTruthCache:
+    """Cache of `ground_truth_metrics`, in memory and optionally on disk.
+
+    Entries are keyed by the dataset path, the kernel radius and window and
+    the content of the evaluated ground truth frames, so changing any of them
+    invalidates the cached terms.
+
+    Args:
+        cache_dir: Directory of the on-disk cache, None keeps the terms in
+            memory only.
+    """
+
+    version = 1
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, dataset_path, radius, window, target_pos, box):
+        h = hashlib.blake2b(digest_size=16)
+        h.update(repr((self.version, str(dataset_path), float(radius),
+                       str(window), target_pos.shape)).encode())
+        h.update(np.ascontiguousarray(target_pos, dtype=np.float32).tobytes())
+        h.update(np.ascontiguousarray(box, dtype=np.float32).tobytes())
+        return h.hexdigest()
 
-    #bins = np.zeros((bin_cnt_per_dim + 1, ) * dim)
-    binsx = np.zeros((bin_cnt_per_dim + 1, ) * dim) + 1e-5
-    binsy = np.zeros((bin_cnt_per_dim + 1, ) * dim) + 1e-5
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
 
-    def to_idx(val):
-        return tuple(
-            np.clip(((val - min_v) / bin_w).astype("int32"), 0,
-                    bin_cnt_per_dim))
+    def get(self, key):
+        gt = self.entries.get(key)
+        if gt is None and self.cache_dir is not None and os.path.exists(
+                self._path(key)):
+            with np.load(self._path(key)) as f:
+                gt = {k: f[k] for k in f.files}
+            self.entries[key] = gt
+        if gt is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return gt
 
-    for v in x:
-        binsx[to_idx(np.array(v))] += 1
-        #bins[to_idx(np.array(v))] += 1
-    for v in y:
-        binsy[to_idx(np.array(v))] += 1
-        #bins[to_idx(np.array(v))] -= 1
+    def put(self, key, gt):
+        if key in self.entries:
+            return
+        self.entries[key] = gt
+        if self.cache_dir is not None:
+            tmp = self._path(key) + '.%d.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                np.savez(f, **gt)
+            os.replace(tmp, self._path(key))
 
-    return entropy(np.reshape(binsx, -1), np.reshape(binsy, -1))
-    #return np.sum(np.abs(bins)) / cnt
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries)
+        }
 
 
 def merge_dicts(dicts, op, start_val=0):
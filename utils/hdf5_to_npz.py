@@ -39,13 +39,19 @@ def save_npz(folder, name, *args, **kwargs):
     np.savez(os.path.join(folder, str(name) + '.npz'), **kwargs)
 
 
-def write_npz(dst, data):
+def init_npz(dst, bnd):
+    """Creates the (empty) gt and pred folders of `write_npz`."""
     gt_folder = os.path.join(dst, 'gt_npz')
     pred_folder = os.path.join(dst, 'pred_npz')
     reset_folder(gt_folder)
     reset_folder(pred_folder)
-    save_npz(gt_folder, 'box', box=data['bnd'])
-    save_npz(pred_folder, 'box', box=data['bnd'])
+    save_npz(gt_folder, 'box', box=bnd)
+    save_npz(pred_folder, 'box', box=bnd)
+    return gt_folder, pred_folder
+
+
+def write_npz(dst, data):
+    gt_folder, pred_folder = init_npz(dst, data['bnd'])
     for i in range(data['gt'].shape[0]):
         save_npz(gt_folder, 'fluid_{0:04d}'.format(i), pos=data['gt'][i])
     for i in range(data['pred'].shape[0]):
@@ -0,0 +1,61 @@
+import argparse
+import os
+import sys
+from glob import glob
+
+import numpy as np
+import zstandard as zstd
+import msgpack
+import msgpack_numpy
+
+msgpack_numpy.patch()
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from datasets.dataset_reader_physics import write_scene, ColumnarScene
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert msgpack.zst scenes to memory-mapped columnar scenes')
+    parser.add_argument('--data_path', help='dataset dir, sub-dirs (train/valid/test) are converted as well')
+    parser.add_argument('--out_path', help='output dir, defaults to data_path')
+    parser.add_argument('--verify', default=False, action='store_true', help='compare the written scenes')
+    return parser.parse_args()
+
+
+def load_msgpack(path):
+    decompressor = zstd.ZstdDecompressor()
+    with open(path, 'rb') as f:
+        return msgpack.unpackb(decompressor.decompress(f.read()), raw=False)
+
+
+def verify_scene(data, path):
+    scene = ColumnarScene.open(path)
+    assert len(scene) == len(data)
+    for i, frame in enumerate(data):
+        for k in ['pos', 'vel', 'grav', 'm', 'viscosity']:
+            if frame.get(k, None) is not None:
+                assert np.allclose(scene[i][k], np.asarray(frame[k], dtype=np.float32)), (path, i, k)
+        assert scene[i]['frame_id'] == frame['frame_id'], (path, i)
+
+
+def main():
+    args = parse_args()
+    out_path = args.out_path if args.out_path is not None else args.data_path
+
+    files = sorted(glob(os.path.join(args.data_path, '**', '*.msgpack.zst'), recursive=True))
+    for src in files:
+        dst = os.path.join(out_path, os.path.relpath(src, args.data_path))
+        dst = dst[:-len('.msgpack.zst')] + '.scene'
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+
+        data = load_msgpack(src)
+        for frame in data[1:]:
+            assert frame['pos'].shape == data[0]['pos'].shape, "Particle count must be constant: %s" % src
+        print('writing', dst)
+        write_scene(dst, data)
+        if args.verify:
+            verify_scene(data, dst)
+
+
+if __name__ == '__main__':
+    main()
@@ -48,7 +48,20 @@ def get_window_func(typ, fac=1.0, **kwargs):
     return func
 
 
+def particle_mean(x, weights=None):
+    """Mean over the particles (first axis), or the sum weighted by per particle `weights`.
+
+    With weights 1 / (B * N_b) for the particles of sample b this is the
+    mean of the per sample means of a batch packed into one particle set.
+    """
+    if weights is None:
+        return tf.reduce_mean(x)
+    x = tf.reshape(x, [tf.shape(x)[0], -1])
+    return tf.reduce_sum(weights * tf.reduce_mean(x, axis=-1))
+
+
 def get_loss(typ, fac=1.0, **kwargs):
+    """Returns a loss function, losses with `particle_weights` set accept per particle weights."""
     if typ == "mse":
 
         def f(target, pred, **kw):
@@ -56,8 +69,9 @@ def get_loss(typ, fac=1.0, **kwargs):
                            tf.cast(kw.get("pre_steps"), tf.float32))
             diff = (tf.reduce_sum(
                 (target - pred) ** 2, axis=-1) + 1e-9) ** kwargs.get("gamma", 0.5)
-            return fac * tf.reduce_mean(pre_f * diff)
+            return fac * particle_mean(pre_f * diff, kw.get("particle_weights"))
 
+        f.particle_weights = True
         return f
     elif typ == "weighted_mse":
 
@@ -89,8 +103,10 @@ def get_loss(typ, fac=1.0, **kwargs):
 
             scale = -kwargs.get("scale", 1.0)
             diff = (tf.reduce_sum(((target - pred) * scale) ** 2, axis=-1) + 1e-9) ** kwargs.get("gamma", 0.5)
-            return fac * tf.reduce_mean(pre_f * fluid_importance * solid_importance * diff)
+            return fac * particle_mean(pre_f * fluid_importance * solid_importance * diff,
+                                       kw.get("particle_weights"))
 
+        f.particle_weights = True
         return f
     elif typ == "dense":
         win = get_window_func(kwargs.pop("win", None))
@@ -103,8 +119,9 @@ def get_loss(typ, fac=1.0, **kwargs):
             diff = (tf.reduce_sum(
                 ((target - prev) - (pred - inp)) ** 2, axis=-1) +
                     1e-9) ** kwargs.get("gamma", 0.5)
-            return fac * tf.reduce_mean(diff)
+            return fac * particle_mean(diff, kw.get("particle_weights"))
 
+        f.particle_weights = True
         return f
     elif typ == "weighted_vel":
 
@@ -116,14 +133,16 @@ def get_loss(typ, fac=1.0, **kwargs):
             diff = (tf.reduce_sum(
                 ((target - prev) - (pred - inp)) ** 2, axis=-1) +
                     1e-9) ** kwargs.get("gamma", 0.5)
-            return fac * tf.reduce_mean(importance * diff)
+            return fac * particle_mean(importance * diff, kw.get("particle_weights"))
 
+        f.particle_weights = True
         return f
     elif typ == "momentum":
 
         def f(target, pred, **kw):
-            return fac * tf.reduce_mean(kw.get("pos_correction"))
+            return fac * particle_mean(kw.get("pos_correction"), kw.get("particle_weights"))
 
+        f.particle_weights = True
         return f
     elif typ == "chamfer":
         return partial(chamfer_distance, **kargs)
@@ -1,4 +1,9 @@
+from collections import namedtuple
+
 import tensorflow as tf
+import open3d.ml.tf as ml3d
+
+Neighbors = namedtuple('Neighbors', ['neighbors_index', 'neighbors_row_splits', 'neighbors_distance'])
 
 
 def reduce_subarrays_sum_multi(values, row_splits):
@@ -8,15 +13,110 @@ def reduce_subarrays_sum_multi(values, row_splits):
     return sum
 
 
-def combine_nns(fluid_nns, solid_nns):
+def aggregate_basis(features, basis, row_splits):
+    """Per receiver sums of basis weighted neighbor features.
+
+    Convolutions of the form sum_e sum_k basis[e, k] * features[e] @ W[k]
+    can apply the kernel W after this aggregation, as one dense matmul on
+    [N, K * C_in], instead of materializing an [E, C_in, C_out] tensor. Each
+    basis function is aggregated separately, so the largest intermediate is
+    [E, C_in].
+
+    Args:
+        features: Gathered neighbor features [E, C_in].
+        basis: Basis values of the edges [E, K].
+        row_splits: Row splits of the edges per receiver [N + 1].
+    Returns:
+        Aggregated features [N, K, C_in].
+    """
+    segment_ids = tf.ragged.row_splits_to_segment_ids(tf.cast(row_splits, tf.int32))
+    num_segments = tf.shape(row_splits)[0] - 1
+    return tf.stack([
+        tf.math.unsorted_segment_sum(basis[:, k:k + 1] * features, segment_ids, num_segments)
+        for k in range(basis.shape[-1])
+    ], axis=1)
+
+
+def apply_basis_kernel(aggregated, kernel):
+    """Applies a [K, C_in, C_out] kernel to the output of `aggregate_basis`."""
+    k, c_in, c_out = kernel.shape
+    return tf.matmul(tf.reshape(aggregated, [-1, k * c_in]), tf.reshape(kernel, [k * c_in, c_out]))
+
+
+def budget_edges(memory_budget, edge_bytes):
+    """Number of edges per chunk for a memory budget in MB, None for no limit."""
+    if not memory_budget:
+        return None
+    return max(int(memory_budget * 2 ** 20 // edge_bytes), 1)
+
+
+def receiver_chunks(row_splits, max_edges):
+    """Splits the receivers into consecutive ranges of about `max_edges` edges.
+
+    A new chunk starts at the first receiver whose edges begin past the next
+    multiple of `max_edges`, so a chunk exceeds the budget by at most the
+    degree of its last receiver.
+
+    Returns:
+        Receiver offsets of the chunks [C + 1].
+    """
+    row_splits = tf.cast(row_splits, tf.int64)
+    num_receivers = tf.shape(row_splits, out_type=tf.int64)[0] - 1
+    chunk = row_splits[:-1] // max_edges
+    starts = tf.where(chunk[1:] != chunk[:-1])[:, 0] + 1
+    return tf.concat([tf.zeros([1], tf.int64), starts, [num_receivers]], axis=0)
+
+
+def slice_receivers(neighbors_index, row_splits, start, end):
+    """Neighbors of the receivers [start, end) with row splits starting at 0."""
+    row_splits = row_splits[start:end + 1]
+    return neighbors_index[row_splits[0]:row_splits[-1]], row_splits - row_splits[0]
+
+
+def map_receiver_chunks(fn, row_splits, max_edges, args=(), dtype=tf.float32):
+    """Concatenates `fn(start, end, *args)` over receiver chunks of about `max_edges` edges.
+
+    `fn` must return the outputs of the receivers [start, end). Eager calls
+    loop in python and recompute each chunk in the backward pass, so only
+    one chunk of edge intermediates is alive at a time; traced calls use a
+    while loop. Gradients flow to `args`, tensors captured by `fn` are
+    treated as constants when recomputing. With `max_edges` None `fn` is
+    called once for all receivers.
+    """
+    num_receivers = tf.shape(row_splits)[0] - 1
+    if max_edges is None:
+        return fn(0, num_receivers, *args)
+    bounds = receiver_chunks(row_splits, max_edges)
+    if tf.executing_eagerly():
+        bounds = bounds.numpy()
+        if len(bounds) == 2:
+            return fn(0, num_receivers, *args)
+        return tf.concat([
+            tf.recompute_grad(lambda *x, s=bounds[i], e=bounds[i + 1]: fn(s, e, *x))(*args)
+            for i in range(len(bounds) - 1)
+        ], axis=0)
+
+    num_chunks = tf.shape(bounds)[0] - 1
+    outputs = tf.TensorArray(dtype, size=num_chunks, infer_shape=False)
+
+    def body(i, outputs):
+        return i + 1, outputs.write(i, fn(bounds[i], bounds[i + 1], *args))
+
+    _, outputs = tf.while_loop(lambda i, _: i < num_chunks, body, [0, outputs])
+    return outputs.concat()
+
+
+def combine_nns(fluid_nns, solid_nns, num_fluid=None):
     # 拆分两个邻居搜索的结果
     fluid_index, fluid_row_splits, fluid_distance = fluid_nns
     solid_index, solid_row_splits, solid_distance = solid_nns
     fluid_segment_ids = tf.ragged.row_splits_to_segment_ids(fluid_row_splits)
     solid_segment_ids = tf.ragged.row_splits_to_segment_ids(solid_row_splits)
+    if num_fluid is None:
+        num_fluid = tf.shape(fluid_row_splits)[0] - 1
 
     # 合并neighbors_index，neighbors_distance，以及segment_ids
-    combined_index = tf.concat([fluid_index, solid_index + (tf.shape(fluid_row_splits)[0] - 1)], axis=0)
+    combined_index = tf.concat([fluid_index, solid_index + tf.cast(num_fluid, solid_index.dtype)], axis=0)
     combined_distance = tf.concat([fluid_distance, solid_distance], axis=0)
     combined_ids = tf.concat([fluid_segment_ids, solid_segment_ids], axis=0)
 
@@ -47,3 +147,109 @@ def neighbors_mask(neighbors, mask):
     # 更新neighbors，使其包含过滤后的tensor
     neighbors_filtered = (neighbors_index_filtered, neighbors_row_splits_filtered, neighbors_distance_filtered)
     return neighbors_filtered
+
+
+def filter_neighbors(neighbors, keep):
+    """Drops the neighbor entries where `keep` is False."""
+    neighbors_index, neighbors_row_splits, neighbors_distance = neighbors
+    segment_ids = tf.ragged.row_splits_to_segment_ids(neighbors_row_splits)
+    counts = tf.math.unsorted_segment_sum(tf.cast(keep, neighbors_row_splits.dtype), segment_ids,
+                                          num_segments=tf.shape(neighbors_row_splits)[0] - 1)
+    neighbors_row_splits = tf.concat([tf.zeros([1], neighbors_row_splits.dtype), tf.cumsum(counts)], axis=0)
+    return Neighbors(tf.boolean_mask(neighbors_index, keep), neighbors_row_splits,
+                     tf.boolean_mask(neighbors_distance, keep))
+
+
+def slice_neighbors(neighbors, num_queries):
+    """Restricts the neighbors to the first `num_queries` query points."""
+    neighbors_index, neighbors_row_splits, neighbors_distance = neighbors
+    neighbors_row_splits = neighbors_row_splits[:num_queries + 1]
+    return Neighbors(neighbors_index[:neighbors_row_splits[-1]], neighbors_row_splits,
+                     neighbors_distance[:neighbors_row_splits[-1]])
+
+
+def drop_self(neighbors):
+    """Removes the neighbors at the position of their query point.
+
+    Like `ignore_query_point` of the radius search, points are dropped by
+    distance 0, not by index, so this also holds if queries and points are
+    different arrays.
+    """
+    return filter_neighbors(neighbors, neighbors[2] > 0)
+
+
+def within_radius(neighbors, points, queries, radius):
+    """Keeps the neighbors within `radius` and updates their (squared) distances."""
+    neighbors_index, neighbors_row_splits, _ = neighbors
+    diff = tf.gather(points, neighbors_index) - tf.repeat(
+        queries, neighbors_row_splits[1:] - neighbors_row_splits[:-1], axis=0)
+    distance = tf.reduce_sum(diff ** 2, axis=-1)
+    return filter_neighbors(Neighbors(neighbors_index, neighbors_row_splits, distance), distance <= radius ** 2)
+
+
+class NeighborList:
+    """Shared fixed radius neighbor lists of the particles [fluid; boundary].
+
+    Queries are the first `num_queries` particles, the neighbors (including
+    the query itself) are returned separately for fluid and boundary
+    particles. With a Verlet skin the search uses `radius + skin` and is
+    only repeated when a particle moved more than `skin / 2` since the last
+    search; in between the cached lists are filtered by the current
+    distances. With `skin = 0` every call searches, but all consumers of
+    the same positions can still share the result.
+    """
+
+    def __init__(self, skin=0.0):
+        self.skin = skin
+        self.search = ml3d.layers.FixedRadiusSearch(return_distances=True)
+        self.builds = 0
+        self.state = None
+
+    def is_valid(self, pos, box, radius, num_queries):
+        if self.state is None or self.skin <= 0 or not tf.executing_eagerly():
+            return False
+        ref_pos, ref_box, ref_radius, ref_queries, _, _ = self.state
+        if ref_radius != radius or ref_queries < num_queries or ref_pos.shape != pos.shape or \
+                ref_box.shape != box.shape:
+            return False
+        # largest distance moved, two particles approach each other by at most twice that
+        disp = tf.reduce_max(tf.norm(pos - ref_pos, axis=-1)) if pos.shape[0] > 0 else 0.0
+        if box is not ref_box and box.shape[0] > 0:
+            disp = tf.maximum(disp, tf.reduce_max(tf.norm(box - ref_box, axis=-1)))
+        return float(disp) <= 0.5 * self.skin
+
+    def __call__(self, pos, box, radius, num_queries=None, hash_table=None):
+        all_pos = tf.concat([pos, box], axis=0)
+        if num_queries is None:
+            num_queries = tf.shape(all_pos)[0]
+        if tf.executing_eagerly():
+            num_queries = int(num_queries)
+        queries = all_pos[:num_queries]
+
+        if self.is_valid(pos, box, radius, num_queries):
+            fluid_nns, solid_nns = self.state[-2:]
+            fluid_nns = slice_neighbors(fluid_nns, num_queries)
+            solid_nns = slice_neighbors(solid_nns, num_queries)
+        else:
+            # the hash table of the boundary is built for the exact radius
+            fluid_nns = self.search(pos, queries, radius + self.skin)
+            solid_nns = self.search(box, queries, radius + self.skin,
+                                    hash_table=hash_table if self.skin <= 0 else None)
+            self.builds += 1
+            if self.skin <= 0:
+                return Neighbors(*fluid_nns), Neighbors(*solid_nns)
+            if tf.executing_eagerly():
+                self.state = (pos, box, radius, num_queries, fluid_nns, solid_nns)
+
+        return within_radius(fluid_nns, pos, queries, radius), within_radius(solid_nns, box, queries, radius)
+
+    def lookup(self, pos, box, radius, num_queries=None):
+        """Returns the neighbors if the cached lists still cover them, otherwise None."""
+        if self.state is None or self.skin <= 0 or not tf.executing_eagerly():
+            return None
+        if num_queries is None:
+            num_queries = int(pos.shape[0]) + int(box.shape[0])
+        num_queries = int(num_queries)
+        if not self.is_valid(pos, box, radius, num_queries):
+            return None
+        return self(pos, box, radius, num_queries)
@@ -26,6 +26,7 @@
 
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/util/work_sharder.h"
 REGISTER_OP("NnDistance")
 	.Input("xyz1: float32")
 	.Input("xyz2: float32")
@@ -44,12 +45,14 @@ REGISTER_OP("NnDistanceGrad")
 	.Output("grad_xyz2: float32");
 using namespace tensorflow;
 
-static void nnsearch(int b,int n,int m,const float * xyz1,const float * xyz2,float * dist,int * idx){
-	for (int i=0;i<b;i++){
-		for (int j=0;j<n;j++){
-			float x1=xyz1[(i*n+j)*3+0];
-			float y1=xyz1[(i*n+j)*3+1];
-			float z1=xyz1[(i*n+j)*3+2];
+static void nnsearch(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,float * dist,int * idx){
+	auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+	Shard(worker_threads.num_threads,worker_threads.workers,(int64)b*n,(int64)m*10,[&](int64 start,int64 limit){
+		for (int64 ij=start;ij<limit;ij++){
+			int i=ij/n;
+			float x1=xyz1[ij*3+0];
+			float y1=xyz1[ij*3+1];
+			float z1=xyz1[ij*3+2];
 			double best=0;
 			int besti=0;
 			for (int k=0;k<m;k++){
@@ -62,10 +65,10 @@ static void nnsearch(int b,int n,int m,const float * xyz1,const float * xyz2,flo
 					besti=k;
 				}
 			}
-			dist[i*n+j]=best;
-			idx[i*n+j]=besti;
+			dist[ij]=best;
+			idx[ij]=besti;
 		}
-	}
+	});
 }
 
 class NnDistanceOp : public OpKernel{
@@ -102,8 +105,8 @@ class NnDistanceOp : public OpKernel{
 			int * idx1=&(idx1_flat(0));
 			float * dist2=&(dist2_flat(0));
 			int * idx2=&(idx2_flat(0));
-			nnsearch(b,n,m,xyz1,xyz2,dist1,idx1);
-			nnsearch(b,m,n,xyz2,xyz1,dist2,idx2);
+			nnsearch(context,b,n,m,xyz1,xyz2,dist1,idx1);
+			nnsearch(context,b,m,n,xyz2,xyz1,dist2,idx2);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistance").Device(DEVICE_CPU), NnDistanceOp);
@@ -153,7 +156,10 @@ class NnDistanceGradOp : public OpKernel{
 				grad_xyz1[i]=0;
 			for (int i=0;i<b*m*3;i++)
 				grad_xyz2[i]=0;
-			for (int i=0;i<b;i++){
+			// scattered updates only touch points of the same batch item
+			auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+			Shard(worker_threads.num_threads,worker_threads.workers,b,(int64)(n+m)*20,[&](int64 start,int64 limit){
+			for (int i=start;i<limit;i++){
 				for (int j=0;j<n;j++){
 					float x1=xyz1[(i*n+j)*3+0];
 					float y1=xyz1[(i*n+j)*3+1];
@@ -187,10 +193,12 @@ class NnDistanceGradOp : public OpKernel{
 					grad_xyz1[(i*n+j2)*3+2]-=(g*(z1-z2));
 				}
 			}
+			});
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistanceGrad").Device(DEVICE_CPU), NnDistanceGradOp);
 
+#if GOOGLE_CUDA
 void NmDistanceKernelLauncher(int b,int n,const float * xyz,int m,const float * xyz2,float * result,int * result_i,float * result2,int * result2_i);
 class NnDistanceGpuOp : public OpKernel{
 	public:
@@ -278,3 +286,4 @@ class NnDistanceGradGpuOp : public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistanceGrad").Device(DEVICE_GPU), NnDistanceGradGpuOp);
+#endif
@@ -28,7 +28,13 @@
 #include "tensorflow/core/framework/op_kernel.h"
 #include "tensorflow/core/framework/shape_inference.h"
 #include "tensorflow/core/framework/common_shape_fns.h"
+#include "tensorflow/core/platform/mutex.h"
+#include "tensorflow/core/util/work_sharder.h"
+#include <algorithm>
+#include <vector>
+#if GOOGLE_CUDA
 #include <cuda_runtime.h>
+#endif
 
 using namespace tensorflow;
 
@@ -83,6 +89,147 @@ REGISTER_OP("GatherPointGrad")
     return Status::OK();
   });
 
+// CPU kernels follow the semantics of the CUDA kernels in sampling.cu: the
+// first sample is point 0 and ties in the farthest point search resolve to the
+// lowest index.
+static void farthestpointsampling_cpu(OpKernelContext * context,int b,int n,int m,const float * inp,int * out){
+  auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+  std::vector<float> temp(n);
+  for (int i=0;i<b;i++){
+    const float * dataset=inp+i*n*3;
+    int * idxs=out+i*m;
+    if (m<=0)
+      continue;
+    std::fill(temp.begin(),temp.end(),1e38f);
+    int old=0;
+    idxs[0]=old;
+    for (int j=1;j<m;j++){
+      float x1=dataset[old*3+0];
+      float y1=dataset[old*3+1];
+      float z1=dataset[old*3+2];
+      float best=-1;
+      int besti=0;
+      mutex mu;
+      Shard(worker_threads.num_threads,worker_threads.workers,n,10,[&](int64 start,int64 limit){
+        float lbest=-1;
+        int lbesti=0;
+        for (int k=start;k<limit;k++){
+          float x2=dataset[k*3+0]-x1;
+          float y2=dataset[k*3+1]-y1;
+          float z2=dataset[k*3+2]-z1;
+          float d2=std::min(x2*x2+y2*y2+z2*z2,temp[k]);
+          temp[k]=d2;
+          if (d2>lbest){
+            lbest=d2;
+            lbesti=k;
+          }
+        }
+        mutex_lock l(mu);
+        if (lbest>best || (lbest==best && lbesti<besti)){
+          best=lbest;
+          besti=lbesti;
+        }
+      });
+      old=besti;
+      idxs[j]=old;
+    }
+  }
+}
+
+class FarthestPointSampleOp: public OpKernel{
+  public:
+    explicit FarthestPointSampleOp(OpKernelConstruction* context):OpKernel(context){}
+    void Compute(OpKernelContext * context)override{
+      const Tensor& inp_tensor=context->input(0);
+      const Tensor& n_point=context->input(1);
+      int m=n_point.scalar<int>()();
+      OP_REQUIRES(context,inp_tensor.dims()==3 && inp_tensor.shape().dim_size(2)==3,errors::InvalidArgument("FarthestPointSample expects (batch_size,num_points,3) inp shape"));
+      int b=inp_tensor.shape().dim_size(0);
+      int n=inp_tensor.shape().dim_size(1);
+      OP_REQUIRES(context,m>=0 && (n>0 || m==0),errors::InvalidArgument("FarthestPointSample expects 0<=npoint and a non-empty inp"));
+      auto inp_flat=inp_tensor.flat<float>();
+      const float * inp=inp_flat.data();
+      Tensor * out_tensor=NULL;
+      OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,m},&out_tensor));
+      auto out_flat=out_tensor->flat<int>();
+      int * out=out_flat.data();
+      farthestpointsampling_cpu(context,b,n,m,inp,out);
+    }
+};
+REGISTER_KERNEL_BUILDER(Name("FarthestPointSample").Device(DEVICE_CPU),FarthestPointSampleOp);
+
+class GatherPointOp: public OpKernel{
+  public:
+    explicit GatherPointOp(OpKernelConstruction * context):OpKernel(context){}
+    void Compute(OpKernelContext * context)override{
+      const Tensor& inp_tensor=context->input(0);
+      OP_REQUIRES(context,inp_tensor.dims()==3,errors::InvalidArgument("GatherPoint expects (batch_size,num_points,ch) inp shape"));
+      int b=inp_tensor.shape().dim_size(0);
+      int n=inp_tensor.shape().dim_size(1);
+      int ch=inp_tensor.shape().dim_size(2);
+      const Tensor& idx_tensor=context->input(1);
+      OP_REQUIRES(context,idx_tensor.dims()==2 && idx_tensor.shape().dim_size(0)==b,errors::InvalidArgument("GatherPoint expects (batch_size,num_result) idx shape"));
+      int m=idx_tensor.shape().dim_size(1);
+      auto inp_flat=inp_tensor.flat<float>();
+      const float * inp=inp_flat.data();
+      auto idx_flat=idx_tensor.flat<int>();
+      const int * idx=idx_flat.data();
+      Tensor * out_tensor=NULL;
+      OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,m,ch},&out_tensor));
+      auto out_flat=out_tensor->flat<float>();
+      float * out=out_flat.data();
+      auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+      Shard(worker_threads.num_threads,worker_threads.workers,(int64)b*m,ch,[&](int64 start,int64 limit){
+        for (int64 ij=start;ij<limit;ij++){
+          int i=ij/m;
+          int a=idx[ij];
+          for (int c=0;c<ch;c++)
+            out[ij*ch+c]=inp[((int64)i*n+a)*ch+c];
+        }
+      });
+    }
+};
+REGISTER_KERNEL_BUILDER(Name("GatherPoint").Device(DEVICE_CPU),GatherPointOp);
+
+class GatherPointGradOp: public OpKernel{
+  public:
+    explicit GatherPointGradOp(OpKernelConstruction * context):OpKernel(context){}
+    void Compute(OpKernelContext * context)override{
+      const Tensor& inp_tensor=context->input(0);
+      OP_REQUIRES(context,inp_tensor.dims()==3,errors::InvalidArgument("GatherPointGradOp expects (batch_size,num_points,ch) inp"));
+      int b=inp_tensor.shape().dim_size(0);
+      int n=inp_tensor.shape().dim_size(1);
+      int ch=inp_tensor.shape().dim_size(2);
+      const Tensor& idx_tensor=context->input(1);
+      OP_REQUIRES(context,idx_tensor.dims()==2 && idx_tensor.shape().dim_size(0)==b,errors::InvalidArgument("GatherPointGradOp expects (batch_size,num_result) idx shape"));
+      int m=idx_tensor.shape().dim_size(1);
+      auto idx_flat=idx_tensor.flat<int>();
+      const int * idx=idx_flat.data();
+      const Tensor& out_g_tensor=context->input(2);
+      OP_REQUIRES(context,out_g_tensor.dims()==3 && out_g_tensor.shape().dim_size(0)==b && out_g_tensor.shape().dim_size(1)==m && out_g_tensor.shape().dim_size(2)==ch,errors::InvalidArgument("GatherPointGradOp expects (batch_size,num_result,ch) out_g shape"));
+      auto out_g_flat=out_g_tensor.flat<float>();
+      const float * out_g=out_g_flat.data();
+      Tensor * inp_g_tensor=NULL;
+      OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,n,ch},&inp_g_tensor));
+      auto inp_g_flat=inp_g_tensor->flat<float>();
+      float * inp_g=inp_g_flat.data();
+      std::fill(inp_g,inp_g+(int64)b*n*ch,0.0f);
+      // each shard owns whole (batch, channel) columns, so the scatter-add
+      // needs no atomics and sums in a fixed order
+      auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+      Shard(worker_threads.num_threads,worker_threads.workers,(int64)b*ch,(int64)m*2,[&](int64 start,int64 limit){
+        for (int64 ic=start;ic<limit;ic++){
+          int i=ic/ch;
+          int c=ic%ch;
+          for (int j=0;j<m;j++)
+            inp_g[((int64)i*n+idx[i*m+j])*ch+c]+=out_g[((int64)i*m+j)*ch+c];
+        }
+      });
+    }
+};
+REGISTER_KERNEL_BUILDER(Name("GatherPointGrad").Device(DEVICE_CPU),GatherPointGradOp);
+
+#if GOOGLE_CUDA
 void probsampleLauncher(int b,int n,int m,const float * inp_p,const float * inp_r,float * temp,int * out);
 class ProbSampleGpuOp: public OpKernel{
   public:
@@ -203,4 +350,4 @@ class GatherPointGradGpuOp: public OpKernel{
     }
 };
 REGISTER_KERNEL_BUILDER(Name("GatherPointGrad").Device(DEVICE_GPU),GatherPointGradGpuOp);
-
+#endif
@@ -26,6 +26,7 @@
 
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/util/work_sharder.h"
 #include <algorithm>
 #include <vector>
 #include <math.h>
@@ -110,84 +111,97 @@ void approxmatch_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,flo
 		match+=n*m;
 	}
 }
-void approxmatch_cpu_dyn(int b,int n,int m,const float * xyz1,const float * xyz2,float * match, const int * cn, const int * cm){
+// CPU kernels below parallelize within a batch item: every pass only writes
+// one row (k) or one column (l) of the match matrix, and sums are taken in
+// the same order as in the serial version.
+void approxmatch_cpu_dyn(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,float * match, const int * cn, const int * cm){
+	auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
 	for (int i=0;i<b;i++){
-		int factorl=std::max(cn[i],cm[i])/cn[i];
-		int factorr=std::max(cn[i],cm[i])/cm[i];
+		int ni=cn[i],mi=cm[i];
+		int factorl=std::max(ni,mi)/ni;
+		int factorr=std::max(ni,mi)/mi;
 		std::vector<double> saturatedl(n,double(factorl)),saturatedr(m,double(factorr));
-		std::vector<double> weight(n*m);
-		for (int j=0;j<n*m;j++){
+		std::vector<double> weight(n*m,0);
+		std::vector<double> ss(m);
+		for (int j=0;j<n*m;j++)
 			match[j]=0;
-			weight[j] = 0;
-		}
 		for (int j=8;j>=-2;j--){
-			//printf("i=%d j=%d\n",i,j);
 			double level=-powf(4.0,j);
 			if (j==-2)
 				level=0;
-			for (int k=0;k<cn[i];k++){
-				double x1=xyz1[k*3+0];
-				double y1=xyz1[k*3+1];
-				double z1=xyz1[k*3+2];
-				for (int l=0;l<cm[i];l++){
-					double x2=xyz2[l*3+0];
-					double y2=xyz2[l*3+1];
-					double z2=xyz2[l*3+2];
-					weight[l*n+k]=expf(level*((x1-x2)*(x1-x2)+(y1-y2)*(y1-y2)+(z1-z2)*(z1-z2)))*saturatedr[l];
+			Shard(worker_threads.num_threads,worker_threads.workers,ni,(int64)mi*40,[&](int64 start,int64 limit){
+				for (int k=start;k<limit;k++){
+					double x1=xyz1[k*3+0];
+					double y1=xyz1[k*3+1];
+					double z1=xyz1[k*3+2];
+					double s=1e-9;
+					for (int l=0;l<mi;l++){
+						double x2=xyz2[l*3+0];
+						double y2=xyz2[l*3+1];
+						double z2=xyz2[l*3+2];
+						weight[l*n+k]=expf(level*((x1-x2)*(x1-x2)+(y1-y2)*(y1-y2)+(z1-z2)*(z1-z2)))*saturatedr[l];
+						s+=weight[l*n+k];
+					}
+					for (int l=0;l<mi;l++)
+						weight[l*n+k]=weight[l*n+k]/s*saturatedl[k];
 				}
-			}
-			std::vector<double> ss(m,1e-9);
-			for (int k=0;k<cn[i];k++){
-				double s=1e-9;
-				for (int l=0;l<cm[i];l++){
-					s+=weight[l*n+k];
+			});
+			Shard(worker_threads.num_threads,worker_threads.workers,mi,(int64)ni*2,[&](int64 start,int64 limit){
+				for (int l=start;l<limit;l++){
+					double s=1e-9;
+					for (int k=0;k<ni;k++)
+						s+=weight[l*n+k];
+					ss[l]=std::min(saturatedr[l]/s,1.0);
 				}
-				for (int l=0;l<cm[i];l++){
-					weight[l*n+k]=weight[l*n+k]/s*saturatedl[k];
+			});
+			Shard(worker_threads.num_threads,worker_threads.workers,ni,(int64)mi*3,[&](int64 start,int64 limit){
+				for (int k=start;k<limit;k++){
+					double s=0;
+					for (int l=0;l<mi;l++){
+						weight[l*n+k]*=ss[l];
+						s+=weight[l*n+k];
+					}
+					saturatedl[k]=std::max(saturatedl[k]-s,0.0);
 				}
-				for (int l=0;l<cm[i];l++)
-					ss[l]+=weight[l*n+k];
-			}
-			for (int l=0;l<cm[i];l++){
-				double s=ss[l];
-				double r=std::min(saturatedr[l]/s,1.0);
-				ss[l]=r;
-			}
-			std::vector<double> ss2(m,0);
-			for (int k=0;k<cn[i];k++){
-				double s=0;
-				for (int l=0;l<cm[i];l++){
-					weight[l*n+k]*=ss[l];
-					s+=weight[l*n+k];
-					ss2[l]+=weight[l*n+k];
+			});
+			Shard(worker_threads.num_threads,worker_threads.workers,mi,(int64)ni*3,[&](int64 start,int64 limit){
+				for (int l=start;l<limit;l++){
+					double s=0;
+					for (int k=0;k<ni;k++){
+						s+=weight[l*n+k];
+						match[l*n+k]+=weight[l*n+k];
+					}
+					saturatedr[l]=std::max(saturatedr[l]-s,0.0);
 				}
-				saturatedl[k]=std::max(saturatedl[k]-s,0.0);
-			}
-			for (int k=0;k<n*m;k++)
-				match[k]+=weight[k];
-			for (int l=0;l<cm[i];l++){
-				saturatedr[l]=std::max(saturatedr[l]-ss2[l],0.0);
-			}
+			});
 		}
 		xyz1+=n*3;
 		xyz2+=m*3;
 		match+=n*m;
 	}
 }
-void matchcost_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * cost){
+void matchcost_cpu(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * cost){
+	auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
+	std::vector<double> partial(m);
 	for (int i=0;i<b;i++){
-		double s=0;
-		for (int k=0;k<n;k++)
-			for (int l=0;l<m;l++){
-				float x1=xyz1[k*3+0];
-				float y1=xyz1[k*3+1];
-				float z1=xyz1[k*3+2];
+		Shard(worker_threads.num_threads,worker_threads.workers,m,(int64)n*10,[&](int64 start,int64 limit){
+			for (int l=start;l<limit;l++){
 				float x2=xyz2[l*3+0];
 				float y2=xyz2[l*3+1];
 				float z2=xyz2[l*3+2];
-				float d=sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1))*match[l*n+k];
-				s+=d;
+				double s=0;
+				for (int k=0;k<n;k++){
+					float x1=xyz1[k*3+0];
+					float y1=xyz1[k*3+1];
+					float z1=xyz1[k*3+2];
+					s+=sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1))*match[l*n+k];
+				}
+				partial[l]=s;
 			}
+		});
+		double s=0;
+		for (int l=0;l<m;l++)
+			s+=partial[l];
 		cost[0]=s;
 		xyz1+=n*3;
 		xyz2+=m*3;
@@ -195,34 +209,51 @@ void matchcost_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,const
 		cost+=1;
 	}
 }
-void matchcostgrad_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * grad1,float * grad2){
+void matchcostgrad_cpu(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * grad1,float * grad2){
+	auto worker_threads=*(context->device()->tensorflow_cpu_worker_threads());
 	for (int i=0;i<b;i++){
-		for (int k=0;k<n;k++)
-			grad1[k*3+0]=0;
-		for (int l=0;l<m;l++){
-			float sx=0,sy=0,sz=0;
-			for (int k=0;k<n;k++){
+		// grad1 and grad2 are computed in separate passes, so that every
+		// shard owns the rows it writes to
+		Shard(worker_threads.num_threads,worker_threads.workers,n,(int64)m*20,[&](int64 start,int64 limit){
+			for (int k=start;k<limit;k++){
 				float x1=xyz1[k*3+0];
 				float y1=xyz1[k*3+1];
 				float z1=xyz1[k*3+2];
+				float sx=0,sy=0,sz=0;
+				for (int l=0;l<m;l++){
+					float x2=xyz2[l*3+0];
+					float y2=xyz2[l*3+1];
+					float z2=xyz2[l*3+2];
+					float d=std::max(sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1)),1e-20f);
+					sx-=match[l*n+k]*((x2-x1)/d);
+					sy-=match[l*n+k]*((y2-y1)/d);
+					sz-=match[l*n+k]*((z2-z1)/d);
+				}
+				grad1[k*3+0]=sx;
+				grad1[k*3+1]=sy;
+				grad1[k*3+2]=sz;
+			}
+		});
+		Shard(worker_threads.num_threads,worker_threads.workers,m,(int64)n*20,[&](int64 start,int64 limit){
+			for (int l=start;l<limit;l++){
 				float x2=xyz2[l*3+0];
 				float y2=xyz2[l*3+1];
 				float z2=xyz2[l*3+2];
-				float d=std::max(sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1)),1e-20f);
-				float dx=match[l*n+k]*((x2-x1)/d);
-				float dy=match[l*n+k]*((y2-y1)/d);
-				float dz=match[l*n+k]*((z2-z1)/d);
-				grad1[k*3+0]-=dx;
-				grad1[k*3+1]-=dy;
-				grad1[k*3+2]-=dz;
-				sx+=dx;
-				sy+=dy;
-				sz+=dz;
+				float sx=0,sy=0,sz=0;
+				for (int k=0;k<n;k++){
+					float x1=xyz1[k*3+0];
+					float y1=xyz1[k*3+1];
+					float z1=xyz1[k*3+2];
+					float d=std::max(sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1)),1e-20f);
+					sx+=match[l*n+k]*((x2-x1)/d);
+					sy+=match[l*n+k]*((y2-y1)/d);
+					sz+=match[l*n+k]*((z2-z1)/d);
+				}
+				grad2[l*3+0]=sx;
+				grad2[l*3+1]=sy;
+				grad2[l*3+2]=sz;
 			}
-			grad2[l*3+0]=sx;
-			grad2[l*3+1]=sy;
-			grad2[l*3+2]=sz;
-		}
+		});
 		xyz1+=n*3;
 		xyz2+=m*3;
 		match+=n*m;
@@ -230,6 +261,7 @@ void matchcostgrad_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,c
 		grad2+=m*3;
 	}
 }
+#if GOOGLE_CUDA
 void approxmatchLauncher(int b,int n,int m,const float * xyz1,const float * xyz2,float * match,float * temp);
 void approxmatchLauncherDyn(int b,int n,int m,const float * xyz1,const float * xyz2,float * match,float * temp,const int * cn, const int * cm);
 void matchcostLauncher(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * out);
@@ -277,6 +309,7 @@ class ApproxMatchGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("ApproxMatch").Device(DEVICE_GPU), ApproxMatchGpuOp);
+#endif
 class ApproxMatchOp: public OpKernel{
 	public:
 		explicit ApproxMatchOp(OpKernelConstruction* context):OpKernel(context){}
@@ -310,10 +343,11 @@ class ApproxMatchOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,m,n},&match_tensor));
 			auto match_flat=match_tensor->flat<float>();
 			float * match=&(match_flat(0));
-			approxmatch_cpu_dyn(b,n,m,xyz1,xyz2,match,cn,cm);
+			approxmatch_cpu_dyn(context,b,n,m,xyz1,xyz2,match,cn,cm);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("ApproxMatch").Device(DEVICE_CPU), ApproxMatchOp);
+#if GOOGLE_CUDA
 class MatchCostGpuOp: public OpKernel{
 	public:
 		explicit MatchCostGpuOp(OpKernelConstruction* context):OpKernel(context){}
@@ -344,6 +378,7 @@ class MatchCostGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCost").Device(DEVICE_GPU), MatchCostGpuOp);
+#endif
 class MatchCostOp: public OpKernel{
 	public:
 		explicit MatchCostOp(OpKernelConstruction* context):OpKernel(context){}
@@ -370,11 +405,12 @@ class MatchCostOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b},&cost_tensor));
 			auto cost_flat=cost_tensor->flat<float>();
 			float * cost=&(cost_flat(0));
-			matchcost_cpu(b,n,m,xyz1,xyz2,match,cost);
+			matchcost_cpu(context,b,n,m,xyz1,xyz2,match,cost);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCost").Device(DEVICE_CPU), MatchCostOp);
 
+#if GOOGLE_CUDA
 class MatchCostGradGpuOp: public OpKernel{
 	public:
 		explicit MatchCostGradGpuOp(OpKernelConstruction* context):OpKernel(context){}
@@ -409,6 +445,7 @@ class MatchCostGradGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCostGrad").Device(DEVICE_GPU), MatchCostGradGpuOp);
+#endif
 class MatchCostGradOp: public OpKernel{
 	public:
 		explicit MatchCostGradOp(OpKernelConstruction* context):OpKernel(context){}
@@ -439,7 +476,7 @@ class MatchCostGradOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(1,TensorShape{b,m,3},&grad2_tensor));
 			auto grad2_flat=grad2_tensor->flat<float>();
 			float * grad2=&(grad2_flat(0));
-			matchcostgrad_cpu(b,n,m,xyz1,xyz2,match,grad1,grad2);
+			matchcostgrad_cpu(context,b,n,m,xyz1,xyz2,match,grad1,grad2);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCostGrad").Device(DEVICE_CPU), MatchCostGradOp);